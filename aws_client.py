@@ -0,0 +1,210 @@
+"""
+This module is a minimal AWS API client (SigV4 signed query and json protocols) for the native collector engine
+"""
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ElementTree
+
+API_VERSIONS = {'monitoring': '2010-08-01', 'sts': '2011-06-15'}
+RETRYABLE_ERRORS = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+# Temporary credentials are refreshed this many seconds before they expire
+CREDENTIALS_REFRESH_SECONDS = 300
+CONTAINER_CREDENTIALS_ENDPOINT = 'http://169.254.170.2'
+INSTANCE_METADATA_ENDPOINT = 'http://169.254.169.254'
+METADATA_TIMEOUT = 2
+
+
+class AwsError(Exception):
+    def __init__(self, status, code, message) -> None:
+        super().__init__(f'{code} ({status}): {message}')
+        self.status = status
+        self.code = code
+
+
+class AwsClient:
+    def __init__(self, region, accessKey=None, secretKey=None, sessionToken=None, endpoint=None, timeout=30,
+                 retries=3) -> None:
+        self.region = region
+        self.accessKey = accessKey or os.environ.get('AWS_ACCESS_KEY_ID', '')
+        self.secretKey = secretKey or os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+        self.sessionToken = sessionToken or os.environ.get('AWS_SESSION_TOKEN', '')
+        # Without static keys, temporary credentials are fetched from the default chain (web identity, container,
+        # instance profile) and refreshed before their expiration
+        self.fetchCredentials = None if self.accessKey else self.fetchDefaultCredentials
+        self.expiration = None
+        self.credentialsLock = threading.Lock()
+        # A single endpoint for every service, used to test against a local stub
+        self.endpoint = endpoint or os.environ.get('AWS_ENDPOINT_URL', '')
+        self.timeout = timeout
+        self.retries = retries
+        # Requests sent per action and namespace, reported as cloudwatch_requests_total
+        self.requests = {}
+        self.requestsLock = threading.Lock()
+
+    # Returns a client using the temporary credentials of an assumed role, assumed again before they expire
+    def assumeRole(self, roleArn, sessionName='logzio-cloudwatch-metrics'):
+        client = AwsClient(self.region, endpoint=self.endpoint, timeout=self.timeout, retries=self.retries)
+        client.fetchCredentials = lambda: parse_sts_credentials(
+            self.query('sts', 'AssumeRole', {'RoleArn': roleArn, 'RoleSessionName': sessionName}))
+        client.getCredentials()
+        return client
+
+    # Returns the access key, secret key and session token to sign with, fetching them again before they expire
+    def getCredentials(self) -> tuple:
+        with self.credentialsLock:
+            refreshAt = self.expiration and self.expiration - datetime.timedelta(seconds=CREDENTIALS_REFRESH_SECONDS)
+            if self.fetchCredentials is not None and (refreshAt is None or
+                                                      datetime.datetime.now(datetime.timezone.utc) >= refreshAt):
+                self.accessKey, self.secretKey, self.sessionToken, self.expiration = self.fetchCredentials()
+            return self.accessKey, self.secretKey, self.sessionToken
+
+    # Fetches temporary credentials like the AWS SDKs do without static keys: from a web identity token (EKS service
+    # accounts), the container credentials endpoint (ECS tasks) or the instance profile (EC2 instances)
+    def fetchDefaultCredentials(self) -> tuple:
+        try:
+            tokenFile = os.environ.get('AWS_WEB_IDENTITY_TOKEN_FILE')
+            if tokenFile and os.environ.get('AWS_ROLE_ARN'):
+                with open(tokenFile) as token:
+                    params = {'RoleArn': os.environ['AWS_ROLE_ARN'], 'WebIdentityToken': token.read().strip(),
+                              'RoleSessionName': os.environ.get('AWS_ROLE_SESSION_NAME', 'logzio-cloudwatch-metrics')}
+                return parse_sts_credentials(self.query('sts', 'AssumeRoleWithWebIdentity', params, signed=False))
+            relativeUri = os.environ.get('AWS_CONTAINER_CREDENTIALS_RELATIVE_URI')
+            fullUri = os.environ.get('AWS_CONTAINER_CREDENTIALS_FULL_URI')
+            if relativeUri or fullUri:
+                headers = {}
+                if os.environ.get('AWS_CONTAINER_AUTHORIZATION_TOKEN'):
+                    headers['Authorization'] = os.environ['AWS_CONTAINER_AUTHORIZATION_TOKEN']
+                url = CONTAINER_CREDENTIALS_ENDPOINT + relativeUri if relativeUri else fullUri
+                return parse_json_credentials(fetch_endpoint(url, headers=headers))
+            if os.environ.get('AWS_EC2_METADATA_DISABLED', '').lower() != 'true':
+                # IMDSv2: a session token, then the credentials of the instance profile role
+                token = fetch_endpoint(f'{INSTANCE_METADATA_ENDPOINT}/latest/api/token', 'PUT',
+                                       {'X-aws-ec2-metadata-token-ttl-seconds': '21600'}).decode()
+                headers = {'X-aws-ec2-metadata-token': token}
+                url = f'{INSTANCE_METADATA_ENDPOINT}/latest/meta-data/iam/security-credentials/'
+                role = fetch_endpoint(url, headers=headers).decode().splitlines()[0]
+                return parse_json_credentials(fetch_endpoint(url + role, headers=headers))
+        except (OSError, KeyError, ValueError, IndexError) as e:
+            raise AwsError(0, 'NoCredentials', f'Failed to fetch credentials: {e}')
+        raise AwsError(0, 'NoCredentials', 'No AWS credentials found')
+
+    def getEndpoint(self, service) -> str:
+        if self.endpoint:
+            return self.endpoint
+        return f'https://{service}.{self.region}.amazonaws.com/'
+
+    # Calls a query protocol API (cloudwatch, sts), returns the parsed xml result
+    def query(self, service, action, params, namespace='', signed=True) -> ElementTree.Element:
+        body = urllib.parse.urlencode(dict(params, Action=action, Version=API_VERSIONS[service])).encode()
+        headers = {'content-type': 'application/x-www-form-urlencoded; charset=utf-8'}
+        response = self.send(service, action, body, headers, namespace, signed)
+        return parse_xml(response)
+
+    # Calls a json protocol API (tagging), returns the parsed json result
+    def callJson(self, service, target, payload) -> dict:
+        body = json.dumps(payload).encode()
+        headers = {'content-type': 'application/x-amz-json-1.1', 'x-amz-target': target}
+        response = self.send(service, target.split('.')[-1], body, headers)
+        return json.loads(response)
+
+    # Sends a signed request, retrying throttled and failed requests with exponential backoff
+    def send(self, service, action, body, headers, namespace='', signed=True) -> bytes:
+        url = self.getEndpoint(service)
+        for attempt in range(self.retries + 1):
+            with self.requestsLock:
+                self.requests[(action, namespace)] = self.requests.get((action, namespace), 0) + 1
+            request = urllib.request.Request(url, data=body, method='POST',
+                                             headers=self.sign(url, service, body, headers) if signed else headers)
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return response.read()
+            except urllib.error.HTTPError as e:
+                error = parse_error(e.code, e.read())
+                if attempt == self.retries or (error.code not in RETRYABLE_ERRORS and e.code < 500):
+                    raise error
+            except urllib.error.URLError as e:
+                if attempt == self.retries:
+                    raise AwsError(0, 'ConnectionError', str(e.reason))
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+
+    # Returns the request headers with a SigV4 signature
+    def sign(self, url, service, body, headers, now=None) -> dict:
+        accessKey, secretKey, sessionToken = self.getCredentials()
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        amzDate = now.strftime('%Y%m%dT%H%M%SZ')
+        dateStamp = now.strftime('%Y%m%d')
+        parsedUrl = urllib.parse.urlparse(url)
+        headers = dict(headers, host=parsedUrl.netloc)
+        headers['x-amz-date'] = amzDate
+        if sessionToken:
+            headers['x-amz-security-token'] = sessionToken
+        signedHeaders = ';'.join(sorted(headers))
+        canonicalHeaders = ''.join(f'{key}:{headers[key].strip()}\n' for key in sorted(headers))
+        canonicalRequest = '\n'.join(['POST', parsedUrl.path or '/', '', canonicalHeaders, signedHeaders,
+                                      hashlib.sha256(body).hexdigest()])
+        scope = f'{dateStamp}/{self.region}/{service}/aws4_request'
+        stringToSign = '\n'.join(['AWS4-HMAC-SHA256', amzDate, scope,
+                                  hashlib.sha256(canonicalRequest.encode()).hexdigest()])
+        key = f'AWS4{secretKey}'.encode()
+        for part in (dateStamp, self.region, service, 'aws4_request'):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, stringToSign.encode(), hashlib.sha256).hexdigest()
+        headers['authorization'] = (f'AWS4-HMAC-SHA256 Credential={accessKey}/{scope}, '
+                                    f'SignedHeaders={signedHeaders}, Signature={signature}')
+        return headers
+
+
+# parse_xml parses an API response and drops the xml namespaces from the tags
+def parse_xml(text):
+    root = ElementTree.fromstring(text)
+    for element in root.iter():
+        element.tag = element.tag.split('}')[-1]
+    return root
+
+
+# parse_expiration parses the expiration of temporary credentials
+def parse_expiration(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+# parse_sts_credentials returns the credentials and expiration of an AssumeRole or AssumeRoleWithWebIdentity result
+def parse_sts_credentials(result):
+    credentials = result.find('.//Credentials')
+    return (credentials.findtext('AccessKeyId'), credentials.findtext('SecretAccessKey'),
+            credentials.findtext('SessionToken'), parse_expiration(credentials.findtext('Expiration')))
+
+
+# parse_json_credentials returns the credentials and expiration of a container or instance metadata response
+def parse_json_credentials(text):
+    credentials = json.loads(text)
+    return (credentials['AccessKeyId'], credentials['SecretAccessKey'], credentials.get('Token', ''),
+            parse_expiration(credentials['Expiration']))
+
+
+# fetch_endpoint returns the body of a credentials endpoint response
+def fetch_endpoint(url, method='GET', headers=None):
+    request = urllib.request.Request(url, method=method, headers=headers or {})
+    with urllib.request.urlopen(request, timeout=METADATA_TIMEOUT) as response:
+        return response.read()
+
+
+# parse_error returns the AwsError of a failed query or json protocol response
+def parse_error(status, text):
+    try:
+        root = parse_xml(text)
+        return AwsError(status, root.findtext('.//Code'), root.findtext('.//Message'))
+    except ElementTree.ParseError:
+        pass
+    try:
+        error = json.loads(text)
+        return AwsError(status, error.get('__type', '').split('#')[-1], error.get('message', error.get('Message')))
+    except ValueError:
+        return AwsError(status, 'Unknown', text[:200].decode(errors='replace'))
@@ -0,0 +1,217 @@
+"""
+This module benchmarks config loading, validation and configuration generation, and compares runs to a baseline
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import input_validator as iv
+import yaml_io
+from builder import Builder
+from config import Config
+from namespace_catalog import NamespaceCatalog, get_catalog
+
+DEFAULT_BASELINE_PATH = './benchmark_baseline.json'
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_REPEAT = 5
+TEST_CONFIG_PATH = './testdata/test-config.yml'
+# Environment variables applied while loading the config, exercising every override
+ENV_OVERRIDES = {
+    'SCRAPE_INTERVAL': '300', 'LOGZIO_REGION': 'eu', 'TOKEN': 'fakeXamgZErKKkMhmzdVZDhuZcpGKXeo',
+    'P8S_LOGZIO_NAME': 'benchmark',
+    'REMOTE_TIMEOUT': '60', 'SCRAPE_TIMEOUT': '60', 'LOG_LEVEL': 'info', 'LOGZIO_LOG_LEVEL': 'info',
+    'DELAY_SECONDS': '600', 'RANGE_SECONDS': '600', 'PERIOD_SECONDS': '300', 'SET_TIMESTAMP': 'false',
+    'AWS_REGION': 'us-east-1', 'AWS_NAMESPACES': 'AWS/EC2,AWS/RDS', 'CUSTOM_CONFIG': 'false',
+    'AWS_REGIONS': 'us-east-1,us-east-2,eu-west-1', 'SHARDS': '2', 'NAMESPACE_TIERS': 'AWS/Billing=normal',
+}
+# Size of the synthetic catalog: namespaces and metrics per namespace
+SYNTHETIC_NAMESPACES = 20
+SYNTHETIC_METRICS = 250
+
+
+@contextlib.contextmanager
+def environment(variables):
+    previous = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+# write_synthetic_catalog writes namespace files with thousands of metrics, returns their directory
+def write_synthetic_catalog(directory, namespaces=SYNTHETIC_NAMESPACES, metrics=SYNTHETIC_METRICS):
+    for n in range(namespaces):
+        entries = [{
+            'aws_namespace': f'Synthetic/Namespace{n}',
+            'aws_metric_name': f'Metric{m}',
+            'aws_dimensions': ['ResourceId'],
+            'aws_statistics': ['Average', 'Maximum'],
+        } for m in range(metrics)]
+        with open(os.path.join(directory, f'Synthetic{n}.yml'), 'w') as namespaceFile:
+            yaml_io.dump(entries, namespaceFile)
+    return directory
+
+
+# write_custom_config writes a custom cloudwatch exporter configuration with every metric of a catalog
+def write_custom_config(path, pathToNameSpaces):
+    catalog = get_catalog(pathToNameSpaces)
+    with open(path, 'w') as customFile:
+        yaml_io.dump({'region': 'us-east-1', 'metrics': [metric for namespace in catalog.namespaces()
+                                                         for metric in catalog.getMetrics(namespace)]}, customFile)
+    return path
+
+
+class Benchmarks:
+    def __init__(self, workDir, repeat=DEFAULT_REPEAT) -> None:
+        self.workDir = workDir
+        self.repeat = repeat
+        self.syntheticPath = write_synthetic_catalog(tempfile.mkdtemp(dir=workDir)) + '/'
+        self.allNamespaces = get_catalog().namespaces()
+        self.customConfigPath = write_custom_config(os.path.join(workDir, 'custom-cloudwatch.yml'), self.syntheticPath)
+
+    # Returns a builder writing to the work directory
+    def createBuilder(self) -> Builder:
+        builder = Builder(TEST_CONFIG_PATH, otelConfigPath=os.path.join(self.workDir, 'otel-config.yml'),
+                          cloudwatchConfigPath=os.path.join(self.workDir, 'cloudwatch.yml'))
+        builder.logger.setLevel(logging.WARNING)
+        return builder
+
+    def configInit(self) -> None:
+        with environment(ENV_OVERRIDES):
+            Config(TEST_CONFIG_PATH)
+
+    def configValidate(self) -> None:
+        with environment(ENV_OVERRIDES):
+            config = Config(TEST_CONFIG_PATH)
+        config.cloudwatch['aws_namespaces'] = ','.join(self.allNamespaces)
+        config.validate()
+
+    def validateNamespacesLarge(self) -> None:
+        # Every namespace, repeated, plus unsupported ones
+        namespaces = (self.allNamespaces + [f'Custom/Namespace{i}' for i in range(100)]) * 20
+        iv.is_valid_aws_namespaces(','.join(namespaces))
+
+    def updateCloudwatchAllNamespaces(self) -> None:
+        builder = self.createBuilder()
+        builder.config.cloudwatch['aws_namespaces'] = self.allNamespaces
+        builder.updateCloudwatchConfiguration()
+
+    def updateOtelAllNamespaces(self) -> None:
+        builder = self.createBuilder()
+        builder.config.cloudwatch['aws_namespaces'] = self.allNamespaces
+        builder.config.cloudwatch['regions'] = ['us-east-1', 'us-east-2', 'eu-west-1']
+        builder.updateCloudwatchConfiguration()
+        builder.updateOtelConfiguration()
+
+    def compileSyntheticCatalog(self) -> None:
+        NamespaceCatalog.compile(self.syntheticPath, NamespaceCatalog.hashSources(self.syntheticPath))
+
+    def updateCloudwatchSyntheticCatalog(self) -> None:
+        builder = self.createBuilder()
+        builder.config.cloudwatch['aws_namespaces'] = get_catalog(self.syntheticPath).namespaces()
+        builder.updateCloudwatchConfiguration(self.syntheticPath)
+
+    def updateCustomConfigLarge(self) -> None:
+        builder = Builder(TEST_CONFIG_PATH, otelConfigPath=os.path.join(self.workDir, 'otel-config.yml'),
+                          cloudwatchConfigPath=self.customConfigPath)
+        builder.logger.setLevel(logging.WARNING)
+        builder.config.cloudwatch['custom_config'] = 'true'
+        builder.config.cloudwatch['aws_namespaces'] = []
+        builder.updateCustomCloudwatchConfiguration(self.syntheticPath)
+        builder.planCloudwatchConfiguration(self.syntheticPath)
+
+    def cases(self) -> dict:
+        return {
+            'config_init': self.configInit,
+            'config_validate': self.configValidate,
+            'validate_namespaces_large': self.validateNamespacesLarge,
+            'update_cloudwatch_all_namespaces': self.updateCloudwatchAllNamespaces,
+            'update_otel_all_namespaces': self.updateOtelAllNamespaces,
+            'compile_synthetic_catalog': self.compileSyntheticCatalog,
+            'update_cloudwatch_synthetic_catalog': self.updateCloudwatchSyntheticCatalog,
+            'update_custom_config_large': self.updateCustomConfigLarge,
+        }
+
+    # Runs every case (or the selected ones) and returns the best and median duration in seconds
+    def run(self, selected=None) -> dict:
+        results = {}
+        for name, case in self.cases().items():
+            if selected and name not in selected:
+                continue
+            # Warm up: compiles the catalog artifacts and fills the caches a running container would have
+            case()
+            durations = []
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                case()
+                durations.append(time.perf_counter() - started)
+            durations.sort()
+            results[name] = {'best': durations[0], 'median': durations[len(durations) // 2]}
+        return results
+
+
+# compare_results returns the regressions of a run: cases whose best duration exceeds the baseline by more than the
+# threshold (a ratio, 0.5 is 50% slower)
+def compare_results(baseline, results, threshold=DEFAULT_THRESHOLD):
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['best'] / baseline[name]['best'] if baseline[name]['best'] else 1
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def format_results(results, baseline=None) -> str:
+    lines = [f'{"benchmark":<40}{"best (ms)":>12}{"median (ms)":>14}{"baseline (ms)":>16}{"change":>10}']
+    for name, result in results.items():
+        line = f'{name:<40}{result["best"] * 1000:>12.2f}{result["median"] * 1000:>14.2f}'
+        if baseline and name in baseline:
+            change = (result['best'] / baseline[name]['best'] - 1) * 100 if baseline[name]['best'] else 0
+            line += f'{baseline[name]["best"] * 1000:>16.2f}{change:>+9.1f}%'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save', metavar='PATH', help='store the results as a JSON baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results to the baseline and fail on regressions')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='JSON baseline to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed slowdown before a case is a regression, as a ratio')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('cases', nargs='*', help='cases to run, all by default')
+    args = parser.parse_args()
+    logging.basicConfig(level='WARNING')
+    workDir = tempfile.mkdtemp()
+    try:
+        benchmarkResults = Benchmarks(workDir, args.repeat).run(args.cases)
+    finally:
+        shutil.rmtree(workDir)
+    baselineResults = None
+    if args.compare:
+        with open(args.baseline) as baselineFile:
+            baselineResults = json.load(baselineFile)['results']
+    print(format_results(benchmarkResults, baselineResults))
+    if args.save:
+        with open(args.save, 'w') as baselineFile:
+            json.dump({'python': sys.version.split()[0], 'results': benchmarkResults}, baselineFile, indent=2,
+                      sort_keys=True)
+    if baselineResults is not None:
+        regressions = compare_results(baselineResults, benchmarkResults, args.threshold)
+        for name, ratio in regressions.items():
+            print(f'Regression: {name} is {ratio:.2f}x the baseline')
+        sys.exit(1 if regressions else 0)
@@ -1,17 +1,81 @@
 import logging
+import argparse
+import copy
+import cProfile
+import hashlib
+import io
+import json
 import os
-from config import Config
+import pstats
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
 import yaml
+from config import Config, ConfigError, DEFAULT_TIER, ENV_OVERRIDES
+from namespace_catalog import get_catalog
+from metric_merger import DEFAULT_STATISTICS, STATISTICS_KEYS, merge_metrics, merge_statistics, metric_key
+from planner import Planner
+from aws_client import AwsClient
+from tag_discovery import TagDiscovery
+import jvm_sizing
+from window_optimizer import RESOLUTION_KEYS, WINDOW_KEYS, optimize_window, check_window
+from supervisor import Supervisor, DEFAULT_INTERVAL, DEFAULT_MAX_BACKOFF, DEFAULT_STOP_TIMEOUT
 import subprocess
+import input_validator as iv
+import telemetry
+import yaml_io
+
+EXPORTER_JAR = 'cloudwatch_exporter-0.14.3-jar-with-dependencies.jar'
+NATIVE_COMMAND = 'python3 collector.py {{port}}'
+COLLECTOR_BINARY = './otelcontribcol_linux_amd64_55'
+# Modules whose code shapes the generated configuration, part of the generation stamp
+GENERATOR_MODULES = ('builder.py', 'config.py', 'input_validator.py', 'yaml_io.py', 'planner.py', 'metric_merger.py',
+                     'tag_discovery.py', 'jvm_sizing.py', 'window_optimizer.py')
+# Exporter metrics of the dashboard metric set, shipped even if metric_include doesn't match them
+EXPORTER_METRICS = '^cloudwatch_(exporter_.*|requests_total|scrape_duration_seconds)$'
+COLLECTOR_TELEMETRY_ADDRESS = '0.0.0.0:8888'
+SELF_SCRAPE_INTERVAL = 60
+DEFAULT_PROFILE_PATH = './config_files/generate.prof'
+# Number of functions logged by the profile mode
+PROFILE_TOP = 30
+# Invalid custom configuration entries logged one by one, the others are only counted
+MAX_REPORTED_ENTRIES = 20
+# Suffix of the exporter configuration generated from a custom configuration with a single job
+GENERATED_SUFFIX = 'generated'
 
 
 class Builder:
     def __init__(self, configPath, otelConfigPath="./config_files/otel-config.yml",
-                 cloudwatchConfigPath="./config_files/cloudwatch.yml") -> None:
-        self.config = Config(configPath)
+                 cloudwatchConfigPath="./config_files/cloudwatch.yml", otelTemplatePath="./templates/otel-config.yml",
+                 cloudwatchTemplatePath="./templates/cloudwatch.yml") -> None:
+        self.configPath = configPath
+        # Phase timings, exposed as metrics
+        self.telemetry = telemetry.Telemetry()
+        with self.telemetry.span('config_load'):
+            self.config = Config(configPath)
         self.logger = self.createLogger()
         self.otelConfigPath = otelConfigPath
         self.cloudwatchConfigPath = cloudwatchConfigPath
+        self.otelTemplatePath = otelTemplatePath
+        self.cloudwatchTemplatePath = cloudwatchTemplatePath
+        # Records the inputs and outputs of the last generation, so an unchanged restart skips it
+        self.stampPath = os.path.join(os.path.dirname(otelConfigPath), '.builder-stamp.json')
+        # Metrics of the generated exporter configuration, None for a streamed custom configuration
+        self.metrics = None
+        # Plan of the last streamed custom configuration
+        self.customPlan = None
+        # Exporter processes to run, one per target
+        self.jobs = None
+        # Pristine configuration templates, read once
+        self.templates = {}
+        # Tag discovery, kept across reloads so its cache stays warm
+        self.discovery = None
+        # cgroup filesystem of the container, read to size the exporter JVMs
+        self.cgroupPath = jvm_sizing.CGROUP_PATH
 
     # Initialize logger
     def createLogger(self) -> logging.Logger:
@@ -30,83 +94,871 @@ class Builder:
     # Takes dict representation of of yaml and dump it to a yaml file
     @staticmethod
     def dumpAndCloseFile(moduleYaml, moduleFile) -> None:
-        yaml.preserve_quotes = True
         moduleFile.seek(0)
-        yaml.dump(moduleYaml, moduleFile)
+        yaml_io.dump(moduleYaml, moduleFile)
         moduleFile.truncate()
         moduleFile.close()
 
+    # Returns a copy of a configuration template. Templates are read once and never written, so the generated
+    # configuration only depends on the config, the namespace catalog and the templates
+    def loadTemplate(self, path) -> dict:
+        if path not in self.templates:
+            self.templates[path] = yaml_io.load_file(path)
+        return copy.deepcopy(self.templates[path])
+
+    # Returns the sha256 of a file, None if it doesn't exist
+    @staticmethod
+    def hashFile(path):
+        try:
+            with open(path, 'rb') as hashedFile:
+                return hashlib.sha256(hashedFile.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    # Writes a configuration atomically, only if its content changed. Returns True if the file was written.
+    # The yaml is streamed to a temporary file and hashed on the way
+    def writeConfiguration(self, path, values) -> bool:
+        tmpPath = f'{path}.tmp'
+        with self.telemetry.span('yaml_dump', logging.DEBUG, path=path), \
+                open(tmpPath, 'w', encoding='utf-8') as tmpFile:
+            contentHash = yaml_io.dump_hashed(values, tmpFile)
+        return self.replaceConfiguration(tmpPath, path, contentHash)
+
+    # Moves a written temporary file over a configuration, unless it has the same content. Returns True if it moved
+    def replaceConfiguration(self, tmpPath, path, contentHash) -> bool:
+        if self.hashFile(path) == contentHash:
+            os.remove(tmpPath)
+            self.logger.debug(f'{path} is unchanged')
+            return False
+        os.replace(tmpPath, path)
+        return True
+
+    # Collects the metrics of the selected namespaces and coalesces duplicates
+    def buildMetrics(self, metrics, pathToNameSpaces='./cw_namespaces/') -> list:
+        metrics = list(metrics or [])
+        with self.telemetry.span('namespaces', namespaces=len(self.config.cloudwatch['aws_namespaces'])):
+            catalog = get_catalog(pathToNameSpaces)
+            for namespace in self.config.cloudwatch['aws_namespaces']:
+                metrics.extend(catalog.getMetrics(namespace))
+                self.logger.info(f'{namespace} was added to cloudwatch exporter configuration')
+        metricsCount = len(metrics)
+        metrics, savedRequests = merge_metrics(metrics)
+        if savedRequests:
+            self.logger.info(f'Merged {metricsCount - len(metrics)} duplicate metrics, '
+                             f'saving at least {savedRequests} exporter requests per scrape')
+        return metrics
+
+    # Estimates the cloudwatch API cost of the exporter configuration
+    def planCloudwatchConfiguration(self, pathToNameSpaces='./cw_namespaces/') -> dict:
+        if self.metrics is not None:
+            metrics = self.metrics
+        elif self.config.cloudwatch['custom_config'] == 'true':
+            if self.customPlan is not None:
+                return self.customPlan
+            return self.streamCustomConfiguration(False, pathToNameSpaces)
+        else:
+            metrics = self.optimizeWindows(self.buildMetrics([], pathToNameSpaces))
+        return Planner(self.config).plan(metrics)
+
+    # Warns or refuses to start when the estimated requests exceed the budget
+    def checkBudget(self, plan) -> bool:
+        error = Planner(self.config).checkBudget(plan)
+        if error is None:
+            return True
+        if self.config.cloudwatch['budget_action'] == 'fail':
+            self.logger.error(error)
+            return False
+        self.logger.warning(error)
+        return True
+
     # Takes user input and applies it to cloudwatch exporter
     def updateCloudwatchConfiguration(self, pathToNameSpaces='./cw_namespaces/') -> None:
         self.logger.info('Adding cloudwatch exporter configuration')
-        with open(self.cloudwatchConfigPath, 'r+') as cloudwatchFile:
-            values = yaml.safe_load(cloudwatchFile)
-            # Add global settings
-            values["period_seconds"] = self.config.cloudwatch['period_seconds']
-            values["range_seconds"] = self.config.cloudwatch['range_seconds']
-            values["delay_seconds"] = self.config.cloudwatch['delay_seconds']
-            values["region"] = self.config.cloudwatch['region']
-            if self.config.cloudwatch['role_arn'] != '':
-                values["role_arn"] = self.config.cloudwatch['role_arn']
-            # Add metrics
-            for namespace in self.config.cloudwatch['aws_namespaces']:
-                namespace = namespace.split('AWS/')[-1]
-                with open('{}{}.yml'.format(pathToNameSpaces, namespace), 'r+') as namespaceFile:
-                    namespaceYaml = yaml.safe_load(namespaceFile)
-                    if namespaceYaml not in values['metrics']:
-                        values['metrics'].extend(namespaceYaml)
-                self.logger.info(f'AWS/{namespace} was added to cloudwatch exporter configuration')
-            self.dumpAndCloseFile(values, cloudwatchFile)
+        values = self.loadTemplate(self.cloudwatchTemplatePath)
+        # Add global settings
+        values["period_seconds"] = self.config.cloudwatch['period_seconds']
+        values["range_seconds"] = self.config.cloudwatch['range_seconds']
+        values["delay_seconds"] = self.config.cloudwatch['delay_seconds']
+        values["region"] = self.config.cloudwatch['region']
+        if self.config.cloudwatch['role_arn'] != '':
+            values["role_arn"] = self.config.cloudwatch['role_arn']
+        # Add metrics
+        values['metrics'] = self.optimizeWindows(self.dropStatistics(self.buildMetrics(values['metrics'],
+                                                                                       pathToNameSpaces)))
+        self.metrics = values['metrics']
+        self.jobs = self.buildJobs(values)
+        if self.jobs[0]['name'] is None:
+            self.writeConfiguration(self.cloudwatchConfigPath, self.jobs[0]['values'])
+        self.writeJobs()
         self.logger.info('Cloudwatch exporter configuration ready')
-        self.logger.debug(f'Cloudwatch exporter configuration:\n{yaml.dump(values)}')
+        yaml_io.debug_dump(self.logger, 'Cloudwatch exporter configuration', values)
+
+    # Applies the targets to a mounted custom cloudwatch exporter configuration, merged with the selected namespaces.
+    # The configuration is streamed, so the memory doesn't grow with its size
+    def updateCustomCloudwatchConfiguration(self, pathToNameSpaces='./cw_namespaces/') -> None:
+        self.logger.info('Adding custom cloudwatch exporter configuration')
+        self.metrics = None
+        self.customPlan = self.streamCustomConfiguration(True, pathToNameSpaces)
+        self.logger.info('Cloudwatch exporter configuration ready')
+
+    # Validates and plans a custom configuration entry by entry. When write is set, the valid entries are spilled to
+    # a file per tier on the way and the jobs are written from them. Returns the plan
+    def streamCustomConfiguration(self, write=True, pathToNameSpaces='./cw_namespaces/') -> dict:
+        values = {}
+        report = dict.fromkeys(('entries', 'invalid', 'dropped', 'merged', 'uncatalogued', 'selected'), 0)
+        spills = {}
+        spillDir = tempfile.mkdtemp(prefix='custom-config-') if write else None
+        try:
+            metrics = self.iterCustomMetrics(values, report, pathToNameSpaces)
+            if write:
+                metrics = self.spillMetrics(metrics, spillDir, spills)
+            plan = Planner(self.config).plan(metrics)
+            self.logCustomReport(values, report, plan)
+            if write:
+                self.jobs = self.writeCustomJobs(values, spills)
+        finally:
+            for spill in spills.values():
+                spill['file'].close()
+            if spillDir is not None:
+                shutil.rmtree(spillDir, ignore_errors=True)
+        return plan
+
+    # Yields the valid entries of a custom configuration without their dropped statistics, then the metrics of the
+    # selected namespaces. Entries with the same key as a selected metric are merged into it. The other top level
+    # keys are collected in values, the counts in report
+    def iterCustomMetrics(self, values, report, pathToNameSpaces='./cw_namespaces/'):
+        catalog = get_catalog(pathToNameSpaces)
+        dropped = set(self.config.cloudwatch['drop_statistics'])
+        selected = {}
+        for metric in self.dropStatistics(self.buildMetrics([], pathToNameSpaces)):
+            selected[metric_key({key: value for key, value in metric.items() if key not in RESOLUTION_KEYS})] = metric
+        catalogMetrics = {}
+        with open(self.cloudwatchConfigPath, 'r', encoding='utf-8') as customFile:
+            for position, metric in enumerate(yaml_io.iter_entries(customFile, 'metrics', values)):
+                report['entries'] += 1
+                try:
+                    iv.is_valid_custom_metric(metric)
+                except (TypeError, ValueError) as e:
+                    report['invalid'] += 1
+                    if report['invalid'] <= MAX_REPORTED_ENTRIES:
+                        self.logger.error(f'Skipping entry {position} of the custom configuration: {e}')
+                    continue
+                namespace = metric['aws_namespace'].strip()
+                if namespace not in catalogMetrics:
+                    catalogMetrics[namespace] = set(catalog.metricNames(namespace)) \
+                        if catalog.hasNamespace(namespace) else set()
+                if metric['aws_metric_name'] not in catalogMetrics[namespace]:
+                    report['uncatalogued'] += 1
+                metric = self.dropMetricStatistics(metric, dropped)
+                if metric is None:
+                    report['dropped'] += 1
+                    continue
+                selectedMetric = selected.get(metric_key(metric))
+                if selectedMetric is not None:
+                    merge_statistics(selectedMetric, metric)
+                    report['merged'] += 1
+                    continue
+                yield metric
+        report['selected'] = len(selected)
+        yield from self.optimizeWindows(selected.values())
+
+    # Spills metrics to a JSON lines file per tier, with their estimated requests and series, and passes them through
+    def spillMetrics(self, metrics, spillDir, spills):
+        planner = Planner(self.config)
+        for metric in metrics:
+            tier = self.config.getMetricTier(metric)
+            if tier not in spills:
+                spillPath = os.path.join(spillDir, f'tier{len(spills)}.jsonl')
+                spills[tier] = {'file': open(spillPath, 'w+', encoding='utf-8'), 'metrics': 0, 'requests': 0}
+            metricPlan = planner.planMetric(metric)
+            spill = spills[tier]
+            spill['metrics'] += 1
+            spill['requests'] += metricPlan['requests']
+            spill['file'].write(json.dumps([metricPlan['requests'], metricPlan['series'],
+                                            {key: value for key, value in metric.items() if key != 'tier'}],
+                                           default=str) + '\n')
+            yield metric
+
+    # Logs the outcome of the validation of a custom configuration and checks its top level settings
+    def logCustomReport(self, values, report, plan) -> None:
+        targets = self.config.getTargets(values)
+        for key in ('region', 'role_arn'):
+            replacements = list(dict.fromkeys(target[key] for target in targets))
+            if values.get(key) and values[key] not in replacements:
+                self.logger.warning(f'{key} {values[key]} of the custom configuration is replaced by {replacements}')
+        try:
+            iv.is_valid_window(values)
+        except (TypeError, ValueError) as e:
+            report['invalid'] += 1
+            self.logger.error(f'Invalid request window in the custom configuration: {e}')
+        if report['invalid'] > MAX_REPORTED_ENTRIES:
+            self.logger.error(f'{report["invalid"] - MAX_REPORTED_ENTRIES} more invalid entries were skipped')
+        self.logger.info(f'Custom configuration: {report["entries"]} entries, {report["invalid"]} invalid, '
+                         f'{report["dropped"]} left without statistics, {report["merged"]} merged into '
+                         f'{report["selected"]} metrics of the selected namespaces, {report["uncatalogued"]} not in '
+                         f'the namespace catalog. {plan["metrics"]} metrics, estimated {plan["requests"]} requests and '
+                         f'{plan["series"]} series per scrape')
+
+    # Writes the jobs of a streamed custom configuration from its spill files, one tier at a time. The shards are
+    # distributed across tiers by their estimated requests as in buildJobs, a metric goes to the least loaded shard
+    # of its tier. A single job is written next to the custom configuration, which is never modified
+    def writeCustomJobs(self, values, spills) -> list:
+        targets = self.config.getTargets(values)
+        shards = self.config.getShardCount(self.cgroupPath)
+        totalCost = sum(spill['requests'] for spill in spills.values()) or 1
+        tiers = sorted(spills) or [DEFAULT_TIER]
+        tierShards = {tier: max(min(round(shards * spills[tier]['requests'] / totalCost), spills[tier]['metrics']), 1)
+                      if tier in spills else 1 for tier in tiers}
+        root, ext = os.path.splitext(self.cloudwatchConfigPath)
+        jobs = []
+        for target in targets:
+            for tier in tiers:
+                for shard in range(tierShards[tier]):
+                    name = self.getJobName(target, len(targets), tier, len(tiers),
+                                           shard if tierShards[tier] > 1 else None)
+                    jobs.append({
+                        'name': name,
+                        'path': f'{root}-{name or GENERATED_SUFFIX}{ext}',
+                        'labels': {'region': target['region'], 'account': target['account']} if len(targets) > 1
+                        else {},
+                        'scrape_interval': self.config.getTierSettings(tier)['scrape_interval'],
+                        'series': 0,
+                        'target': target,
+                        'tier': tier,
+                        'shard': shard
+                    })
+        discovery = self.getTagDiscovery()
+        for tier in tiers:
+            self.writeCustomTier(values, [job for job in jobs if job['tier'] == tier], spills.get(tier), discovery)
+        if discovery is not None:
+            discovery.save()
+        return [{key: value for key, value in job.items() if key not in ('target', 'tier', 'shard')} for job in jobs]
+
+    # Writes the jobs of a tier from its spill file
+    def writeCustomTier(self, values, jobs, spill, discovery) -> None:
+        shards = max(job['shard'] for job in jobs) + 1
+        writers = {}
+        try:
+            for job in jobs:
+                jobFile = open(f'{job["path"]}.tmp', 'w', encoding='utf-8')
+                writers[(job['target']['name'], job['shard'])] = (job, jobFile,
+                                                                  yaml_io.SequenceWriter(jobFile, 'metrics'))
+            if spill is not None:
+                if shards > 1:
+                    self.logger.info(f'Split {spill["metrics"]} {jobs[0]["tier"]} tier metrics into {shards} shards')
+                targets = list(dict.fromkeys(job['target']['name'] for job in jobs))
+                loads = [0] * shards
+                spill['file'].seek(0)
+                for line in spill['file']:
+                    requests, series, metric = json.loads(line)
+                    shard = loads.index(min(loads))
+                    loads[shard] += requests
+                    for target in targets:
+                        job, _, writer = writers[(target, shard)]
+                        metrics = [metric] if discovery is None else \
+                            discovery.applyToMetrics([metric], job['target']['region'], job['target']['role_arn'])
+                        for jobMetric in metrics:
+                            writer.append(jobMetric)
+                        job['series'] += series
+            for job, jobFile, writer in writers.values():
+                contentHash = writer.close(self.getJobValues(values, job['target'], job['tier']))
+                jobFile.close()
+                if self.replaceConfiguration(f'{job["path"]}.tmp', job['path'], contentHash):
+                    self.logger.info(f'Cloudwatch exporter configuration for {job["name"] or "default"} job written '
+                                     f'to {job["path"]}')
+        finally:
+            for _, jobFile, _ in writers.values():
+                jobFile.close()
+
+    # Removes the statistics listed in drop_statistics from a metric, returns None if it has none left
+    @staticmethod
+    def dropMetricStatistics(metric, dropped):
+        if not dropped:
+            return metric
+        metric = dict(metric)
+        if not any(key in metric for key in STATISTICS_KEYS):
+            metric['aws_statistics'] = list(DEFAULT_STATISTICS)
+        for key in STATISTICS_KEYS:
+            if key in metric:
+                metric[key] = [statistic for statistic in metric[key] or [] if statistic not in dropped]
+                if not metric[key]:
+                    del metric[key]
+        if metric.get('aws_statistics') or metric.get('aws_extended_statistics'):
+            return metric
+        return None
+
+    # Removes the statistics listed in drop_statistics, metrics left without statistics are dropped
+    def dropStatistics(self, metrics) -> list:
+        dropped = set(self.config.cloudwatch['drop_statistics'])
+        if not dropped:
+            return metrics
+        kept = [metric for metric in (self.dropMetricStatistics(metric, dropped) for metric in metrics)
+                if metric is not None]
+        self.logger.info(f'Dropped {sorted(dropped)} statistics, {len(metrics) - len(kept)} metrics left without '
+                         f'statistics were removed')
+        return kept
+
+    # Splits the exporter configuration into one job per target (region and account), scrape tier and shard.
+    # A single job keeps the default receiver and configuration file
+    def buildJobs(self, values) -> list:
+        targets = self.config.getTargets()
+        planner = Planner(self.config)
+        # Group metrics by tier
+        tiers = {}
+        for metric in values['metrics']:
+            tiers.setdefault(self.config.getMetricTier(metric), []).append(
+                {key: value for key, value in metric.items() if key != 'tier'})
+        if not tiers:
+            tiers[DEFAULT_TIER] = []
+        # Distribute the shards across tiers by their estimated requests
+        shards = self.config.getShardCount(self.cgroupPath)
+        costs = {tier: sum(planner.planMetric(metric)['requests'] for metric in tierMetrics)
+                 for tier, tierMetrics in tiers.items()}
+        totalCost = sum(costs.values()) or 1
+        groups = []
+        for tier, tierMetrics in sorted(tiers.items()):
+            tierShards = planner.shardMetrics(tierMetrics, max(round(shards * costs[tier] / totalCost), 1))
+            if len(tierShards) > 1:
+                shardRequests = [sum(planner.planMetric(metric)['requests'] for metric in shardMetrics)
+                                 for shardMetrics in tierShards]
+                self.logger.info(f'Split {len(tierMetrics)} {tier} tier metrics into {len(tierShards)} shards, '
+                                 f'estimated requests per shard: {shardRequests}')
+            for shard, shardMetrics in enumerate(tierShards):
+                groups.append((tier, shard if len(tierShards) > 1 else None, shardMetrics))
+        jobs = []
+        root, ext = os.path.splitext(self.cloudwatchConfigPath)
+        discovery = self.getTagDiscovery()
+        for target in targets:
+            for tier, shard, metrics in groups:
+                name = self.getJobName(target, len(targets), tier, len(tiers), shard)
+                if discovery is not None:
+                    metrics = discovery.applyToMetrics(metrics, target['region'], target['role_arn'])
+                jobs.append({
+                    'name': name,
+                    'path': f'{root}-{name}{ext}' if name else self.cloudwatchConfigPath,
+                    'labels': {'region': target['region'], 'account': target['account']} if len(targets) > 1 else {},
+                    'scrape_interval': self.config.getTierSettings(tier)['scrape_interval'],
+                    'values': dict(self.getJobValues(values, target, tier), metrics=metrics)
+                })
+        if discovery is not None:
+            discovery.save()
+        return jobs
+
+    # Returns the name of a job from its target, tier and shard, None for a single job
+    @staticmethod
+    def getJobName(target, targets, tier, tiers, shard):
+        nameParts = [target['name']] if targets > 1 else []
+        if tiers > 1:
+            nameParts.append(tier)
+        if shard is not None:
+            nameParts.append(f'shard{shard}')
+        return '-'.join(nameParts) or None
+
+    # Returns the exporter settings of a job: the configuration with the region and role of its target and the
+    # request window of its tier
+    def getJobValues(self, values, target, tier) -> dict:
+        jobValues = dict(values, region=target['region'])
+        if tier != DEFAULT_TIER:
+            settings = self.config.getTierSettings(tier)
+            for key in WINDOW_KEYS:
+                jobValues[key] = settings[key]
+        if self.config.cloudwatch['engine'] == 'native' and self.config.cloudwatch['max_series_per_metric']:
+            jobValues['max_series_per_metric'] = self.config.cloudwatch['max_series_per_metric']
+        jobValues.pop('role_arn', None)
+        if target['role_arn'] != '':
+            jobValues['role_arn'] = target['role_arn']
+        return jobValues
+
+    # Sets the request window of the metrics with a known resolution, so each scrape fetches one fresh datapoint with
+    # the fewest datapoints and requests. Metrics with an explicit window keep it. Warns once per namespace and
+    # problem when a window can't provide a fresh datapoint on every scrape
+    def optimizeWindows(self, metrics) -> list:
+        optimize = self.config.cloudwatch['optimize_windows'] == 'true'
+        problems = {}
+        optimized = []
+        for metric in metrics:
+            resolution = metric.get('resolution_seconds')
+            publishDelay = metric.get('publish_delay_seconds', 0)
+            metric = {key: value for key, value in metric.items() if key not in RESOLUTION_KEYS}
+            optimized.append(metric)
+            if resolution is None or any(key in metric for key in WINDOW_KEYS):
+                continue
+            settings = self.config.getTierSettings(self.config.getMetricTier(metric))
+            window = {key: settings[key] for key in WINDOW_KEYS}
+            if optimize:
+                window = optimize_window(resolution, publishDelay, settings)
+                metric.update({key: value for key, value in window.items() if value != settings[key]})
+            problem = check_window(resolution, publishDelay, window, settings['scrape_interval'])
+            if problem is not None:
+                problems.setdefault((metric['aws_namespace'], problem), []).append(metric['aws_metric_name'])
+        for (namespace, problem), names in problems.items():
+            self.logger.warning(f'{len(names)} {namespace} metrics ({", ".join(names[:3])}'
+                                f'{", ..." if len(names) > 3 else ""}): {problem}')
+        return optimized
+
+    # Returns the tag discovery if it's enabled
+    def getTagDiscovery(self):
+        if self.config.cloudwatch['tag_discovery'] != 'true':
+            self.discovery = None
+            return None
+        if self.discovery is None:
+            self.discovery = TagDiscovery(cachePath=os.path.join(os.path.dirname(self.otelConfigPath),
+                                                                 '.tag-discovery.json'),
+                                          clientFactory=self.createAwsClient)
+        self.discovery.ttl = self.config.cloudwatch['tag_discovery_ttl']
+        return self.discovery
+
+    def createAwsClient(self, region) -> AwsClient:
+        return AwsClient(region, self.config.otel.get('AWS_ACCESS_KEY_ID') or None,
+                         self.config.otel.get('AWS_SECRET_ACCESS_KEY') or None)
+
+    # Writes the exporter configuration of every generated job
+    def writeJobs(self) -> None:
+        for job in self.jobs:
+            if job['name'] is None:
+                continue
+            if self.writeConfiguration(job['path'], job['values']):
+                self.logger.info(f'Cloudwatch exporter configuration for {job["name"]} written to {job["path"]}')
 
     # Takes user input and applies it to open telemetry collector
     def updateOtelConfiguration(self) -> None:
         self.logger.info('Adding opentelemtry collector configuration')
-        with open(self.otelConfigPath, 'r+') as otelFile:
-            values = yaml.safe_load(otelFile)
-            # Update receiver
-            values['receivers']['prometheus_exec']['scrape_interval'] = f"{self.config.otel['scrape_interval']}s"
-            values['receivers']['prometheus_exec']['scrape_timeout'] = f"{self.config.otel['scrape_timeout']}s"
-            values['receivers']['prometheus_exec']['env'] = []
-            if self.config.otel['AWS_ACCESS_KEY_ID'] != "" and self.config.otel['AWS_SECRET_ACCESS_KEY'] != "":
-                values['receivers']['prometheus_exec']['env'].append(
-                    {
-                        "name": "AWS_ACCESS_KEY_ID",
-                        "value": self.config.otel['AWS_ACCESS_KEY_ID']
-                    }
-                )
-                values['receivers']['prometheus_exec']['env'].append(
-                    {
-                        "name": "AWS_SECRET_ACCESS_KEY",
-                        "value": self.config.otel['AWS_SECRET_ACCESS_KEY']
-                    }
-                )
-            # Update exporter
-            values['exporters']['prometheusremotewrite']['endpoint'] = self.config.getListenerUrl()
-            values['exporters']['prometheusremotewrite']['timeout'] = f"{self.config.otel['remote_timeout']}s"
-            values['exporters']['prometheusremotewrite']['headers'][
-                'Authorization'] = f"Bearer {self.config.otel['token']}"
-            values['exporters']['prometheusremotewrite']['external_labels']['p8s_logzio_name'] = self.config.otel[
-                'p8s_logzio_name']
-            # Update service
-            values['service']['telemetry']['logs']['level'] = self.config.otel['log_level']
-            self.dumpAndCloseFile(values, otelFile)
+        values = self.loadTemplate(self.otelTemplatePath)
+        # Update receiver
+        values['receivers']['prometheus_exec']['scrape_interval'] = f"{self.config.otel['scrape_interval']}s"
+        values['receivers']['prometheus_exec']['scrape_timeout'] = f"{self.config.otel['scrape_timeout']}s"
+        values['receivers']['prometheus_exec']['env'] = []
+        if self.config.otel['AWS_ACCESS_KEY_ID'] != "" and self.config.otel['AWS_SECRET_ACCESS_KEY'] != "":
+            values['receivers']['prometheus_exec']['env'].append(
+                {
+                    "name": "AWS_ACCESS_KEY_ID",
+                    "value": self.config.otel['AWS_ACCESS_KEY_ID']
+                }
+            )
+            values['receivers']['prometheus_exec']['env'].append(
+                {
+                    "name": "AWS_SECRET_ACCESS_KEY",
+                    "value": self.config.otel['AWS_SECRET_ACCESS_KEY']
+                }
+            )
+        # Update exporter
+        values['exporters']['prometheusremotewrite']['endpoint'] = self.config.getListenerUrl()
+        values['exporters']['prometheusremotewrite']['timeout'] = f"{self.config.otel['remote_timeout']}s"
+        values['exporters']['prometheusremotewrite']['headers'][
+            'Authorization'] = f"Bearer {self.config.otel['token']}"
+        values['exporters']['prometheusremotewrite']['external_labels']['p8s_logzio_name'] = self.config.otel[
+            'p8s_logzio_name']
+        self.updateRemoteWrite(values)
+        self.addCardinalityProcessors(values)
+        self.addSelfTelemetry(values)
+        # Add a receiver and a pipeline per job
+        if self.jobs is not None and self.jobs[0]['name'] is None:
+            self.setJobInterval(values['receivers']['prometheus_exec'], self.jobs[0])
+            values['receivers']['prometheus_exec']['exec'] = self.getExecCommand(self.jobs[0])
+            self.jobs[0]['port'] = values['receivers']['prometheus_exec']['port']
+        elif self.jobs is not None:
+            self.addJobPipelines(values)
+        # Update service
+        values['service']['telemetry']['logs']['level'] = self.config.otel['log_level']
+        self.writeConfiguration(self.otelConfigPath, values)
         self.logger.info('Opentelemtry collector configuration ready')
-        self.logger.debug(f'Opentelemtry collector configuration:\n{yaml.dump(values)}')
+        yaml_io.debug_dump(self.logger, 'Opentelemtry collector configuration', values)
+
+    # Returns the command that runs a job with the configured collection engine
+    def getExecCommand(self, job) -> str:
+        path = os.path.normpath(job['path'])
+        if self.config.cloudwatch['engine'] == 'native':
+            return f"{NATIVE_COMMAND} {path} --concurrency {self.config.cloudwatch['native_concurrency']}"
+        options = ' '.join(self.sizeJvm(job)['options'])
+        return f'java {options} -jar {EXPORTER_JAR} {{{{port}}}} {path}'
+
+    # Sizes the JVM of a job's exporter from the container limits, shared by every exporter, and its estimated series
+    def sizeJvm(self, job) -> dict:
+        limits = jvm_sizing.read_cgroup_limits(self.cgroupPath)
+        # Jobs of a streamed custom configuration count their series while they are written
+        series = job['series'] if 'series' in job else Planner(self.config).plan(job['values']['metrics'])['series']
+        sizing = jvm_sizing.size_jvm(series, len(self.jobs), limits, self.config.cloudwatch['jvm_heap_mb'],
+                                     self.config.cloudwatch['jvm_gc'], self.config.cloudwatch['jvm_options'].split())
+        memory = f"{limits['memory_mb']}MB" if limits['memory_mb'] else 'unlimited'
+        cpus = f"{limits['cpus']:g}" if limits['cpus'] else 'unlimited'
+        self.logger.info(f'Exporter JVM of {job["name"] or "default"} job: {sizing["heap_mb"]}MB heap for {series} '
+                         f'estimated series, {sizing["gc"]} GC (container memory {memory}, cpus {cpus}, '
+                         f'{len(self.jobs)} exporters)')
+        if not self.config.cloudwatch['jvm_heap_mb'] and sizing['estimated_heap_mb'] > sizing['heap_mb']:
+            self.logger.warning(f'Exporter of {job["name"] or "default"} job may need {sizing["estimated_heap_mb"]}MB '
+                                f'heap, over the {sizing["max_heap_mb"]}MB its share of the memory limit allows. '
+                                f'Raise the memory limit or add shards')
+        return sizing
+
+    # Applies the batching, queueing, retry and write-ahead log settings of the remote write pipeline.
+    # prometheusremotewrite always compresses with snappy, so compression isn't configurable
+    def updateRemoteWrite(self, values) -> None:
+        otel = self.config.otel
+        exporter = values['exporters']['prometheusremotewrite']
+        exporter['remote_write_queue'] = {
+            'enabled': otel['queue_enabled'] == 'true',
+            'queue_size': otel['queue_size'],
+            'num_consumers': otel['queue_consumers']
+        }
+        exporter['retry_on_failure'] = {
+            'enabled': otel['retry_enabled'] == 'true',
+            'initial_interval': f"{otel['retry_initial_interval']}s",
+            'max_interval': f"{otel['retry_max_interval']}s",
+            'max_elapsed_time': f"{otel['retry_max_elapsed_time']}s"
+        }
+        if otel['wal_directory'] != '':
+            exporter['wal'] = {
+                'directory': otel['wal_directory'],
+                'buffer_size': otel['wal_buffer_size'],
+                'truncate_frequency': f"{otel['wal_truncate_frequency']}s"
+            }
+        batch = {'send_batch_size': otel['batch_send_size'], 'timeout': f"{otel['batch_timeout']}s"}
+        if otel['batch_max_size']:
+            batch['send_batch_max_size'] = otel['batch_max_size']
+        if not values.get('processors'):
+            values['processors'] = {}
+        values['processors']['batch'] = batch
+        pipeline = values['service']['pipelines']['metrics']
+        pipeline['processors'] = list(pipeline.get('processors') or []) + ['batch']
+
+    # Adds the processors that filter metrics and drop labels before remote write to the pipeline
+    def addCardinalityProcessors(self, values) -> None:
+        processors = {}
+        metricFilter = {}
+        if self.config.otel['metric_include']:
+            metricNames = list(self.config.otel['metric_include'])
+            if self.config.otel['self_telemetry'] == 'true':
+                metricNames.append(EXPORTER_METRICS)
+            metricFilter['include'] = {'match_type': 'regexp', 'metric_names': metricNames}
+        if self.config.otel['metric_exclude']:
+            metricFilter['exclude'] = {'match_type': 'regexp', 'metric_names': self.config.otel['metric_exclude']}
+        if metricFilter:
+            processors['filter/cardinality'] = {'metrics': metricFilter}
+        if self.config.otel['label_exclude']:
+            processors['transform/cardinality'] = {'metrics': {'queries': [
+                f'delete_key(attributes, "{label}")' for label in self.config.otel['label_exclude']]}}
+        if not processors:
+            return
+        if not values.get('processors'):
+            values['processors'] = {}
+        values['processors'].update(processors)
+        pipeline = values['service']['pipelines']['metrics']
+        pipeline['processors'] = list(processors) + list(pipeline.get('processors') or [])
+
+    # Exposes the collector's own metrics and scrapes them, with builder's phase metrics, into a separate pipeline
+    # that bypasses the cardinality processors
+    def addSelfTelemetry(self, values) -> None:
+        if self.config.otel['self_telemetry'] != 'true':
+            return
+        serviceTelemetry = values['service'].setdefault('telemetry', {})
+        serviceTelemetry['metrics'] = {'level': 'detailed', 'address': COLLECTOR_TELEMETRY_ADDRESS}
+        values['receivers']['prometheus/self'] = {'config': {'scrape_configs': [{
+            'job_name': job,
+            'scrape_interval': f'{SELF_SCRAPE_INTERVAL}s',
+            'static_configs': [{'targets': [target]}]
+        } for job, target in (('otel-collector', f'localhost:{COLLECTOR_TELEMETRY_ADDRESS.rsplit(":", 1)[1]}'),
+                              ('builder', f"localhost:{self.config.otel['telemetry_port']}"))]}}
+        processors = ['batch'] if 'batch' in (values.get('processors') or {}) else []
+        values['service']['pipelines']['metrics/self'] = {
+            'receivers': ['prometheus/self'],
+            'processors': processors,
+            'exporters': ['prometheusremotewrite']
+        }
+
+    # Returns the receivers that scrape cloudwatch
+    def getScrapeReceivers(self) -> list:
+        if not self.jobs or self.jobs[0]['name'] is None:
+            return ['prometheus_exec']
+        return [f'prometheus_exec/{job["name"]}' for job in self.jobs]
+
+    # Sets the scrape interval of a job's tier on its receiver
+    def setJobInterval(self, receiver, job) -> None:
+        receiver['scrape_interval'] = f"{job['scrape_interval']}s"
+        receiver['scrape_timeout'] = f"{min(self.config.otel['scrape_timeout'], job['scrape_interval'])}s"
+
+    # Replaces the default receiver and pipeline with one receiver per job, labeled with its region and account.
+    # All the pipelines share the same exporters
+    def addJobPipelines(self, values) -> None:
+        baseReceiver = values['receivers'].pop('prometheus_exec')
+        basePipeline = values['service']['pipelines'].pop('metrics')
+        if not values.get('processors'):
+            values['processors'] = {}
+        for i, job in enumerate(self.jobs):
+            receiver = copy.deepcopy(baseReceiver)
+            receiver['exec'] = self.getExecCommand(job)
+            receiver['port'] = baseReceiver['port'] + i
+            job['port'] = receiver['port']
+            self.setJobInterval(receiver, job)
+            values['receivers'][f'prometheus_exec/{job["name"]}'] = receiver
+            processors = list(basePipeline.get('processors') or [])
+            if job['labels']:
+                values['processors'][f'metricstransform/{job["name"]}'] = {
+                    'transforms': [{
+                        'include': '.*',
+                        'match_type': 'regexp',
+                        'action': 'update',
+                        'operations': [{'action': 'add_label', 'new_label': label, 'new_value': value}
+                                       for label, value in job['labels'].items()]
+                    }]
+                }
+                # Labels are added before batching
+                processors.insert(processors.index('batch') if 'batch' in processors else len(processors),
+                                  f'metricstransform/{job["name"]}')
+            values['service']['pipelines'][f'metrics/{job["name"]}'] = {
+                'receivers': [f'prometheus_exec/{job["name"]}'],
+                'processors': processors,
+                'exporters': list(basePipeline['exporters'])
+            }
+            self.logger.info(f'Added receiver for {job["name"]} on port {receiver["port"]}')
+
+    # Validates the configuration and generates the exporter and collector configurations.
+    # Returns False if the estimated requests exceed the budget
+    def generate(self, force=False) -> bool:
+        # Invalid configurations, including invalid environment overrides, fail even if the inputs are unchanged
+        with self.telemetry.span('validate'):
+            self.config.cloudwatch['aws_namespaces'], removedNamespaces = self.config.validate()
+        if removedNamespaces:
+            self.logger.warning(f'{removedNamespaces} namespaces are unsupported')
+        discovery = self.getTagDiscovery()
+        with self.telemetry.span('stamp_check'):
+            inputsHash = self.hashInputs()
+            unchanged = not force and (discovery is None or not discovery.isStale()) and \
+                self.loadStamp(self.getStampKey(inputsHash))
+        if unchanged:
+            self.logger.info('Configuration is unchanged since the last generation, skipping it')
+            return True
+        with self.telemetry.span('cloudwatch_configuration'):
+            if self.config.cloudwatch["custom_config"] == "false":
+                self.updateCloudwatchConfiguration()
+            else:
+                self.updateCustomCloudwatchConfiguration()
+        with self.telemetry.span('plan'):
+            plan = self.planCloudwatchConfiguration()
+        self.logger.info(f'Estimated {plan["requests"]} cloudwatch requests and {plan["series"]} series per scrape')
+        if not self.checkBudget(plan):
+            return False
+        with self.telemetry.span('otel_configuration'):
+            self.updateOtelConfiguration()
+        self.writeStamp(self.getStampKey(inputsHash))
+        return True
+
+    # Generates the configurations under cProfile, writes the stats to a file and logs the slowest functions.
+    # The generation stamp is ignored, so the profile always covers a full generation
+    def profileGenerate(self, path=DEFAULT_PROFILE_PATH) -> bool:
+        profiler = cProfile.Profile()
+        generated = profiler.runcall(self.generate, True)
+        profiler.dump_stats(path)
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        self.logger.info(f'Generation profile written to {path}\n{stats.getvalue()}')
+        return generated
+
+    # Starts a collector process and measures its startup in the background
+    def startCollector(self, command) -> subprocess.Popen:
+        process = subprocess.Popen(command)
+        if self.config.otel['self_telemetry'] == 'true':
+            threading.Thread(target=self.telemetry.measureStartup, args=(self.getScrapeReceivers(), time.time()),
+                             daemon=True).start()
+        return process
+
+    # Returns the key of a generation: its inputs and the resources found by tag discovery
+    def getStampKey(self, inputsHash) -> str:
+        if self.discovery is None:
+            return inputsHash
+        return hashlib.sha256(f'{inputsHash}:{self.discovery.hash()}'.encode()).hexdigest()
+
+    # Returns a hash of everything the generated configuration depends on: the config (with env overrides),
+    # the namespace catalog, the templates and the generator code
+    def hashInputs(self, pathToNameSpaces='./cw_namespaces/') -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'otel': self.config.otel, 'cloudwatch': self.config.cloudwatch}, sort_keys=True,
+                                 default=str).encode())
+        # The raw environment overrides, since invalid values are left out of the settings
+        digest.update(json.dumps({variable: os.environ.get(variable) for variable, _, _, _ in ENV_OVERRIDES},
+                                 sort_keys=True).encode())
+        digest.update(get_catalog(pathToNameSpaces).hash.encode())
+        digest.update(json.dumps(jvm_sizing.read_cgroup_limits(self.cgroupPath), sort_keys=True).encode())
+        # The effective shard count, auto shards fall back to the cpu count without a cgroup cpu limit
+        digest.update(str(self.config.getShardCount(self.cgroupPath)).encode())
+        templates = [self.otelTemplatePath, self.cloudwatchTemplatePath]
+        if self.config.cloudwatch['custom_config'] == 'true':
+            templates.append(self.cloudwatchConfigPath)
+        modules = [os.path.join(os.path.dirname(os.path.abspath(__file__)), module) for module in GENERATOR_MODULES]
+        for path in templates + modules:
+            digest.update(f'{path}:{self.hashFile(path)}'.encode())
+        return digest.hexdigest()
+
+    # Loads the jobs of the last generation if it had the same inputs and its outputs weren't modified since
+    def loadStamp(self, inputsHash) -> bool:
+        try:
+            with open(self.stampPath, 'r') as stampFile:
+                stamp = json.load(stampFile)
+        except (FileNotFoundError, ValueError):
+            return False
+        if stamp.get('inputs') != inputsHash:
+            return False
+        if any(self.hashFile(path) != outputHash for path, outputHash in stamp['outputs'].items()):
+            return False
+        self.jobs = stamp['jobs']
+        return True
+
+    # Records the inputs and outputs of a generation
+    def writeStamp(self, inputsHash) -> None:
+        jobs = [{key: value for key, value in job.items() if key != 'values'} for job in self.jobs]
+        outputs = {path: self.hashFile(path) for path in [self.otelConfigPath] + [job['path'] for job in jobs]}
+        tmpPath = f'{self.stampPath}.tmp'
+        with open(tmpPath, 'w') as stampFile:
+            json.dump({'inputs': inputsHash, 'outputs': outputs, 'jobs': jobs}, stampFile)
+        os.replace(tmpPath, self.stampPath)
+
+    # Returns the content of the generated configuration files
+    def readGeneratedFiles(self) -> dict:
+        paths = [self.otelConfigPath] + [job['path'] for job in self.jobs or []]
+        files = {}
+        for path in paths:
+            with open(path, 'r') as generatedFile:
+                files[path] = generatedFile.read()
+        return files
+
+    # Returns a hash of the watched inputs: the configuration file and the optional env file
+    def readWatchedInputs(self, envFilePath) -> str:
+        digest = hashlib.sha256()
+        for path in [self.configPath, envFilePath]:
+            if path and os.path.exists(path):
+                with open(path, 'rb') as inputFile:
+                    digest.update(inputFile.read())
+        return digest.hexdigest()
+
+    # Applies KEY=VALUE lines of an env file to the environment
+    @staticmethod
+    def loadEnvFile(envFilePath) -> None:
+        if not envFilePath or not os.path.exists(envFilePath):
+            return
+        with open(envFilePath, 'r') as envFile:
+            for line in envFile:
+                line = line.strip()
+                if line and not line.startswith('#') and '=' in line:
+                    key, value = line.split('=', 1)
+                    os.environ[key.strip()] = value.strip()
+
+    # Regenerates the configurations after an input change and returns what has to be applied:
+    # 'collector' if the collector configuration changed, otherwise the jobs whose exporter configuration changed.
+    # Invalid configurations are rejected and the running configuration is kept. Without reloadConfig, the current
+    # configuration is regenerated, to refresh the resources found by tag discovery
+    def reload(self, envFilePath=None, reloadConfig=True):
+        before = self.readGeneratedFiles()
+        previous = (self.config, self.metrics, self.jobs)
+        try:
+            if reloadConfig:
+                self.loadEnvFile(envFilePath)
+                with self.telemetry.span('config_load'):
+                    self.config = Config(self.configPath)
+            with self.telemetry.span('generate'):
+                generated = self.generate()
+        except (KeyError, TypeError, ValueError, yaml.YAMLError) as e:
+            self.logger.error(f'Invalid configuration, keeping the running configuration: {e}')
+            generated = False
+        except OSError as e:
+            self.logger.error(f'Failed to read the configuration, keeping the running configuration: {e}')
+            generated = False
+        if not generated:
+            for path, content in before.items():
+                with open(path, 'w') as generatedFile:
+                    generatedFile.write(content)
+            self.config, self.metrics, self.jobs = previous
+            return []
+        after = self.readGeneratedFiles()
+        if before.get(self.otelConfigPath) != after[self.otelConfigPath]:
+            return 'collector'
+        return [job for job in self.jobs if before.get(job['path']) != after[job['path']]]
+
+    # Asks a running exporter to reload its configuration file
+    def reloadExporter(self, job) -> None:
+        try:
+            request = urllib.request.Request(f'http://localhost:{job["port"]}/-/reload', data=b'', method='POST')
+            urllib.request.urlopen(request, timeout=10).close()
+            self.logger.info(f'Reloaded cloudwatch exporter configuration of {job["name"] or "default"} job')
+        except OSError as e:
+            self.logger.error(f'Failed to reload cloudwatch exporter on port {job["port"]}: {e}')
+
+    # Returns the ports of the exporters run by the collector
+    def getExporterPorts(self) -> list:
+        return [job['port'] for job in self.jobs or [] if job.get('port')]
+
+    # Watches the configuration and applies changes to the collector run by the supervisor: changed exporter
+    # configurations are reloaded in place, and the collector is restarted only when its own configuration changed.
+    # Without watchConfig, only the resources found by tag discovery are refreshed on their ttl.
+    # Returns the collector's exit code once the supervisor is stopped
+    def watch(self, supervisor, interval=10, envFilePath=None, watchConfig=True) -> int:
+        supervisor.start()
+        inputs = self.readWatchedInputs(envFilePath) if watchConfig else None
+        while not supervisor.stopped.wait(interval):
+            supervisor.check()
+            currentInputs = self.readWatchedInputs(envFilePath) if watchConfig else None
+            if currentInputs != inputs:
+                inputs = currentInputs
+                self.logger.info('Configuration changed, reloading')
+            elif self.discovery is not None and self.discovery.isStale():
+                self.logger.info('Refreshing the resources found by tag discovery')
+            else:
+                continue
+            changes = self.reload(envFilePath, watchConfig)
+            if changes == 'collector':
+                self.logger.info('Opentelemetry collector configuration changed, restarting the collector')
+                supervisor.restart('reload')
+            elif changes:
+                for job in changes:
+                    self.reloadExporter(job)
+            else:
+                self.logger.info('Generated configuration is unchanged')
+        return supervisor.shutdown()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plan', action='store_true', help='print the estimated cloudwatch API cost and exit')
+    parser.add_argument('--watch', action='store_true',
+                        help='watch config.yml and apply changes without restarting the container')
+    parser.add_argument('--profile', nargs='?', const=DEFAULT_PROFILE_PATH, metavar='PATH',
+                        help=f'profile the generation with cProfile and write the stats to PATH '
+                             f'(default {DEFAULT_PROFILE_PATH})')
+    args = parser.parse_args()
     builder = Builder('./config_files/config.yml')
-    builder.config.cloudwatch['aws_namespaces'], removed_namespaces = builder.config.validate()
-    if removed_namespaces:
-        builder.logger.warning(f'{removed_namespaces} namespaces are unsupported')
-    if builder.config.cloudwatch["custom_config"] == "false":
-        builder.updateCloudwatchConfiguration()
-    else:
-        builder.logger.info('Adding custom cloudwatch exporter configuration')
-        with open(builder.cloudwatchConfigPath, 'r+') as cloudwatchFile:
-            builder.logger.debug(f'Cloudwatch exporter configuration:\n{yaml.dump(yaml.safe_load(cloudwatchFile))}')
-    builder.updateOtelConfiguration()
-    os.system('chmod +x ./otelcontribcol_linux_amd64_55')
-    subprocess.call(['./otelcontribcol_linux_amd64_55', '--config', './config_files/otel-config.yml'])
+    if builder.config.otel['self_telemetry'] == 'true':
+        try:
+            telemetryServer = telemetry.serve(builder.telemetry, builder.config.otel['telemetry_port'])
+            threading.Thread(target=telemetryServer.serve_forever, daemon=True).start()
+        except (OSError, TypeError) as e:
+            builder.logger.error(f'Failed to serve builder metrics: {e}')
+    profilePath = args.profile or os.environ.get('PROFILE_GENERATION')
+    try:
+        if args.plan:
+            builder.config.cloudwatch['aws_namespaces'], removed_namespaces = builder.config.validate()
+            if removed_namespaces:
+                builder.logger.warning(f'{removed_namespaces} namespaces are unsupported')
+            plan = builder.planCloudwatchConfiguration()
+            print(Planner.formatPlan(plan))
+            sys.exit(0 if builder.checkBudget(plan) else 1)
+        with builder.telemetry.span('generate'):
+            generated = builder.profileGenerate(profilePath) if profilePath else builder.generate()
+        if not generated:
+            sys.exit(1)
+    except ConfigError as e:
+        builder.logger.error(e)
+        sys.exit(1)
+    os.chmod(COLLECTOR_BINARY, 0o755)
+    collectorCommand = [COLLECTOR_BINARY, '--config', './config_files/otel-config.yml']
+    collectorSupervisor = Supervisor(lambda: builder.startCollector(collectorCommand), builder.getExporterPorts,
+                                     telemetry=builder.telemetry,
+                                     maxBackoff=int(os.environ.get('SUPERVISOR_MAX_BACKOFF', DEFAULT_MAX_BACKOFF)),
+                                     stopTimeout=int(os.environ.get('SUPERVISOR_STOP_TIMEOUT', DEFAULT_STOP_TIMEOUT)))
+    # Forward SIGTERM to the collector, so it flushes the queued remote write data before the container stops
+    for stopSignal in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(stopSignal, lambda signum, frame: collectorSupervisor.stop())
+    if args.watch or os.environ.get('WATCH_CONFIG') == 'true':
+        sys.exit(builder.watch(collectorSupervisor, int(os.environ.get('WATCH_INTERVAL', 10)),
+                               os.environ.get('WATCH_ENV_FILE')))
+    if builder.discovery is not None:
+        sys.exit(builder.watch(collectorSupervisor, int(os.environ.get('SUPERVISOR_INTERVAL', DEFAULT_INTERVAL)),
+                               watchConfig=False))
+    sys.exit(collectorSupervisor.run(int(os.environ.get('SUPERVISOR_INTERVAL', DEFAULT_INTERVAL))))
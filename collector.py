@@ -0,0 +1,307 @@
+"""
+This module is a native collector engine: it batches cloudwatch GetMetricData queries and exposes prometheus metrics
+"""
+import argparse
+import asyncio
+import datetime
+import http.server
+import logging
+import re
+import threading
+import time
+from aws_client import AwsClient
+from metric_merger import metric_statistics
+from tag_discovery import TagDiscovery, selection_key
+import yaml_io
+
+MAX_QUERIES_PER_REQUEST = 500
+DEFAULT_CONCURRENCY = 8
+
+logger = logging.getLogger(__name__)
+
+
+# to_snake_case converts a cloudwatch name the same way cloudwatch exporter does
+def to_snake_case(name):
+    return re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+
+
+def safe_name(name):
+    return re.sub(r'[^a-zA-Z0-9:_]', '_', name)
+
+
+def escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def is_true(value):
+    return value is True or str(value).lower() == 'true'
+
+
+class Collector:
+    def __init__(self, values, client=None, concurrency=DEFAULT_CONCURRENCY) -> None:
+        self.values = values
+        self.baseClient = client
+        self.client = self.createClient(values)
+        self.concurrency = concurrency
+        self.tagDiscovery = TagDiscovery()
+        self.scrapeLock = threading.Lock()
+        # Series left out of the last scrape by max_series_per_metric
+        self.cappedSeries = 0
+
+    def createClient(self, values) -> AwsClient:
+        client = self.baseClient or AwsClient(values['region'])
+        if values.get('role_arn'):
+            client = client.assumeRole(values['role_arn'])
+        return client
+
+    # Replaces the configuration between scrapes, the client is recreated if the region or role changed
+    def reload(self, values) -> None:
+        with self.scrapeLock:
+            if (values['region'], values.get('role_arn')) != (self.values['region'], self.values.get('role_arn')):
+                self.client = self.createClient(values)
+            self.values = values
+
+    # Returns a setting of a metric entry, falling back to the global setting
+    def getSetting(self, metric, key, default=None):
+        return metric.get(key, self.values.get(key, default))
+
+    async def call(self, semaphore, action, params, namespace):
+        async with semaphore:
+            return await asyncio.to_thread(self.client.query, 'monitoring', action, params, namespace)
+
+    # Checks a dimension set against the entry's aws_dimension_select and aws_dimension_select_regex
+    @staticmethod
+    def isSelected(metric, dimensions) -> bool:
+        for name, values in (metric.get('aws_dimension_select') or {}).items():
+            if dimensions.get(name) not in values:
+                return False
+        for name, patterns in (metric.get('aws_dimension_select_regex') or {}).items():
+            if not any(re.fullmatch(pattern, dimensions.get(name, '')) for pattern in patterns):
+                return False
+        return True
+
+    # Resolves the tag selections of the metrics to resource ids with GetResources, once per selection and scrape like
+    # cloudwatch exporter. Returns the ids by selection key
+    async def resolveTagSelections(self, semaphore, metrics) -> dict:
+        tagSelects = {}
+        for metric in metrics:
+            tagSelect = metric.get('aws_tag_select')
+            if tagSelect and tagSelect.get('resource_id_dimension'):
+                tagSelects.setdefault(selection_key(self.values['region'], '', tagSelect), tagSelect)
+
+        async def fetch(tagSelect):
+            async with semaphore:
+                return set(await asyncio.to_thread(self.tagDiscovery.fetch, self.client, tagSelect))
+        ids = await asyncio.gather(*[fetch(tagSelect) for tagSelect in tagSelects.values()])
+        return dict(zip(tagSelects, ids))
+
+    # Lists the dimension sets of a metric entry, following every page. Entries with a tag selection keep only the
+    # dimension sets of the resolved resources
+    async def listMetrics(self, semaphore, metric, tagIds=None) -> list:
+        dimensionNames = metric.get('aws_dimensions') or []
+        if not dimensionNames:
+            return [[]]
+        namespace = metric['aws_namespace'].strip()
+        params = {'Namespace': namespace, 'MetricName': metric['aws_metric_name']}
+        for i, name in enumerate(dimensionNames, 1):
+            params[f'Dimensions.member.{i}.Name'] = name
+        tagSelect = metric.get('aws_tag_select') or {}
+        resourceIdDimension = tagSelect.get('resource_id_dimension')
+        resourceIds = (tagIds or {}).get(selection_key(self.values['region'], '', tagSelect)) \
+            if resourceIdDimension else None
+        dimensionSets = []
+        nextToken = None
+        while True:
+            pageParams = dict(params, NextToken=nextToken) if nextToken else params
+            result = await self.call(semaphore, 'ListMetrics', pageParams, namespace)
+            for member in result.iterfind('.//Metrics/member'):
+                dimensions = {d.findtext('Name'): d.findtext('Value') for d in member.iterfind('Dimensions/member')}
+                # Only metrics with exactly the configured dimensions, like cloudwatch exporter
+                if sorted(dimensions) != sorted(dimensionNames) or not self.isSelected(metric, dimensions):
+                    continue
+                if resourceIds is not None and dimensions.get(resourceIdDimension) not in resourceIds:
+                    continue
+                dimensionSets.append([(name, dimensions[name]) for name in dimensionNames])
+            nextToken = result.findtext('.//NextToken')
+            if not nextToken:
+                return dimensionSets
+
+    # Fetches a batch of up to 500 queries, returns the latest datapoint of every query
+    async def getMetricData(self, semaphore, namespace, queries, start, end) -> dict:
+        params = {'StartTime': format_time(start), 'EndTime': format_time(end), 'ScanBy': 'TimestampDescending'}
+        for i, query in enumerate(queries, 1):
+            prefix = f'MetricDataQueries.member.{i}.'
+            params[f'{prefix}Id'] = f'q{i}'
+            params[f'{prefix}MetricStat.Metric.Namespace'] = namespace
+            params[f'{prefix}MetricStat.Metric.MetricName'] = query['metric']['aws_metric_name']
+            for j, (name, value) in enumerate(query['dimensions'], 1):
+                params[f'{prefix}MetricStat.Metric.Dimensions.member.{j}.Name'] = name
+                params[f'{prefix}MetricStat.Metric.Dimensions.member.{j}.Value'] = value
+            params[f'{prefix}MetricStat.Period'] = str(query['period'])
+            params[f'{prefix}MetricStat.Stat'] = query['stat']
+        datapoints = {}
+        nextToken = None
+        while True:
+            pageParams = dict(params, NextToken=nextToken) if nextToken else params
+            result = await self.call(semaphore, 'GetMetricData', pageParams, namespace)
+            for member in result.iterfind('.//MetricDataResults/member'):
+                position = int(member.findtext('Id')[1:]) - 1
+                points = zip([t.text for t in member.iterfind('Timestamps/member')],
+                             [float(v.text) for v in member.iterfind('Values/member')])
+                for timestamp, value in points:
+                    if position not in datapoints or timestamp > datapoints[position][0]:
+                        datapoints[position] = (timestamp, value)
+            nextToken = result.findtext('.//NextToken')
+            if not nextToken:
+                return {id(queries[position]): point for position, point in datapoints.items()}
+
+    # Collects every configured metric, returns the samples
+    async def collect(self) -> list:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        metrics = self.values.get('metrics') or []
+        tagIds = await self.resolveTagSelections(semaphore, metrics)
+        dimensionSets = await asyncio.gather(*[self.listMetrics(semaphore, metric, tagIds) for metric in metrics])
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        # Group queries by namespace and time window, each group is batched separately
+        groups = {}
+        self.cappedSeries = 0
+        maxSeries = self.values.get('max_series_per_metric') or 0
+        for metric, metricDimensionSets in zip(metrics, dimensionSets):
+            stats = metric_statistics(metric)
+            # Every statistic of a dimension set is a series
+            if maxSeries and stats and len(metricDimensionSets) * len(stats) > maxSeries:
+                maxDimensionSets = max(maxSeries // len(stats), 1)
+                self.cappedSeries += (len(metricDimensionSets) - maxDimensionSets) * len(stats)
+                logger.warning(f'{metric["aws_namespace"]} {metric["aws_metric_name"]} has '
+                               f'{len(metricDimensionSets) * len(stats)} series, capped to '
+                               f'{maxDimensionSets * len(stats)}')
+                metricDimensionSets = metricDimensionSets[:maxDimensionSets]
+            period = self.getSetting(metric, 'period_seconds', 60)
+            end = now - datetime.timedelta(seconds=self.getSetting(metric, 'delay_seconds', 600))
+            start = end - datetime.timedelta(seconds=self.getSetting(metric, 'range_seconds', 600))
+            group = groups.setdefault((metric['aws_namespace'].strip(), start, end), [])
+            for dimensions in metricDimensionSets:
+                group.extend({'metric': metric, 'dimensions': dimensions, 'stat': stat, 'period': period}
+                             for stat in stats)
+        batches = [(namespace, queries[i:i + MAX_QUERIES_PER_REQUEST], start, end)
+                   for (namespace, start, end), queries in groups.items()
+                   for i in range(0, len(queries), MAX_QUERIES_PER_REQUEST)]
+        results = {}
+        for batchResult in await asyncio.gather(*[self.getMetricData(semaphore, *batch) for batch in batches]):
+            results.update(batchResult)
+        samples = []
+        for namespace, queries, _, _ in batches:
+            for query in queries:
+                if id(query) in results:
+                    samples.append(self.buildSample(namespace, query, *results[id(query)]))
+        return samples
+
+    # Returns the sample of a query, named and labeled like cloudwatch exporter
+    def buildSample(self, namespace, query, timestamp, value) -> dict:
+        metric = query['metric']
+        name = f'{safe_name(to_snake_case(namespace))}_{safe_name(to_snake_case(metric["aws_metric_name"]))}' \
+               f'_{safe_name(to_snake_case(query["stat"]))}'
+        labels = {'job': safe_name(to_snake_case(namespace)), 'instance': ''}
+        for dimensionName, dimensionValue in query['dimensions']:
+            labels[safe_name(to_snake_case(dimensionName))] = dimensionValue
+        sample = {'name': name, 'labels': labels, 'value': value, 'timestamp': None,
+                  'help': f'CloudWatch metric {namespace} {metric["aws_metric_name"]} Statistic: {query["stat"]}'}
+        if is_true(self.getSetting(metric, 'set_timestamp', True)):
+            parsed = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+            sample['timestamp'] = int(parsed.timestamp() * 1000)
+        return sample
+
+    # Runs a scrape and renders the prometheus text exposition
+    def scrape(self) -> str:
+        with self.scrapeLock:
+            started = time.time()
+            error = 0
+            try:
+                samples = asyncio.run(self.collect())
+            except Exception as e:
+                logger.error(f'Scrape failed: {e}')
+                samples = []
+                error = 1
+            return self.render(samples, time.time() - started, error)
+
+    def render(self, samples, duration, error) -> str:
+        lines = []
+        byName = {}
+        for sample in samples:
+            byName.setdefault(sample['name'], []).append(sample)
+        for name, nameSamples in byName.items():
+            lines.append(f'# HELP {name} {nameSamples[0]["help"]}')
+            lines.append(f'# TYPE {name} gauge')
+            for sample in nameSamples:
+                labels = ','.join(f'{k}="{escape_label_value(v)}"' for k, v in sample['labels'].items())
+                timestamp = f' {sample["timestamp"]}' if sample['timestamp'] is not None else ''
+                lines.append(f'{name}{{{labels}}} {sample["value"]}{timestamp}')
+        lines.append('# HELP cloudwatch_requests_total API requests made to CloudWatch')
+        lines.append('# TYPE cloudwatch_requests_total counter')
+        for (action, namespace), count in sorted(self.client.requests.items()):
+            lines.append(f'cloudwatch_requests_total{{action="{action[0].lower() + action[1:]}",'
+                         f'namespace="{namespace}"}} {float(count)}')
+        lines.append('# HELP cloudwatch_scrape_duration_seconds Time this CloudWatch scrape took, in seconds.')
+        lines.append('# TYPE cloudwatch_scrape_duration_seconds gauge')
+        lines.append(f'cloudwatch_scrape_duration_seconds {duration}')
+        lines.append('# HELP cloudwatch_exporter_scrape_error Non-zero if this scrape failed.')
+        lines.append('# TYPE cloudwatch_exporter_scrape_error gauge')
+        lines.append(f'cloudwatch_exporter_scrape_error {float(error)}')
+        lines.append('# HELP cloudwatch_exporter_series_capped Series left out of the scrape by max_series_per_metric.')
+        lines.append('# TYPE cloudwatch_exporter_series_capped gauge')
+        lines.append(f'cloudwatch_exporter_series_capped {float(self.cappedSeries)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Serves the collector's metrics over http. A POST to /-/reload re-reads the configuration file, like cloudwatch
+# exporter
+def serve(collector, port, configPath=None) -> http.server.ThreadingHTTPServer:
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != '/-/reload' or configPath is None:
+                self.send_error(404)
+                return
+            try:
+                collector.reload(yaml_io.load_file(configPath))
+            except Exception as e:
+                logger.error(f'Failed to reload {configPath}: {e}')
+                self.send_error(500, str(e))
+                return
+            logger.info(f'Reloaded {configPath}')
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = collector.scrape().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return http.server.ThreadingHTTPServer(('', port), MetricsHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int)
+    parser.add_argument('config')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s\t\t%(levelname)s\t[%(name)s]\t%(filename)s:%(lineno)d\t%(message)s',
+                        level='INFO')
+    collectorConfig = yaml_io.load_file(args.config)
+    server = serve(Collector(collectorConfig, concurrency=args.concurrency), args.port, args.config)
+    logger.info(f'Serving {len(collectorConfig.get("metrics") or [])} metrics on port {args.port}')
+    server.serve_forever()
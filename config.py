@@ -1,72 +1,326 @@
+import math
+import os
 from os import environ
-import yaml
 import input_validator as iv
+import jvm_sizing
+import yaml_io
+
+DEFAULT_TIER = 'normal'
+
+
+class ConfigError(ValueError):
+    def __init__(self, errors) -> None:
+        super().__init__('Invalid configuration:\n' + '\n'.join(f'  - {error}' for error in errors))
+        self.errors = errors
+
+
+# to_shards keeps auto as is
+def to_shards(value):
+    return int(value) if value.isdigit() else value
+
+
+# to_list parses a comma separated list
+def to_list(value):
+    return Config.splitList(value)
+
+
+# to_mapping parses a comma separated list of key=value items
+def to_mapping(value):
+    mapping = {}
+    for item in Config.splitList(value):
+        if '=' not in item:
+            raise ValueError(f'{item} should be in the key=value form')
+        key, mappedValue = item.split('=', 1)
+        mapping[key] = mappedValue
+    return mapping
+
+
+# Settings that are optional in config.yml: section, key and default
+DEFAULTS = (
+    # Scrape cost planner
+    ('cloudwatch', 'plan_resources_per_metric', 1),
+    ('cloudwatch', 'max_requests_per_scrape', 0),
+    ('cloudwatch', 'budget_action', 'warn'),
+    # Multi region and multi account targets
+    ('cloudwatch', 'regions', []),
+    ('cloudwatch', 'role_arns', []),
+    # Exporter shards
+    ('cloudwatch', 'shards', 1),
+    # Collection engine
+    ('cloudwatch', 'engine', 'exporter'),
+    ('cloudwatch', 'native_concurrency', 8),
+    # Scrape tiers
+    ('cloudwatch', 'tiers', {}),
+    ('cloudwatch', 'namespace_tiers', {}),
+    # Tag discovery
+    ('cloudwatch', 'tag_discovery', 'false'),
+    ('cloudwatch', 'tag_discovery_ttl', 3600),
+    # Cardinality limits
+    ('otel', 'metric_include', []),
+    ('otel', 'metric_exclude', []),
+    ('otel', 'label_exclude', []),
+    ('cloudwatch', 'drop_statistics', []),
+    ('cloudwatch', 'max_series_per_metric', 0),
+    # Remote write
+    ('otel', 'batch_send_size', 8192),
+    ('otel', 'batch_max_size', 0),
+    ('otel', 'batch_timeout', 1),
+    ('otel', 'queue_enabled', 'true'),
+    ('otel', 'queue_size', 10000),
+    ('otel', 'queue_consumers', 5),
+    ('otel', 'retry_enabled', 'true'),
+    ('otel', 'retry_initial_interval', 5),
+    ('otel', 'retry_max_interval', 30),
+    ('otel', 'retry_max_elapsed_time', 300),
+    ('otel', 'wal_directory', ''),
+    ('otel', 'wal_buffer_size', 300),
+    ('otel', 'wal_truncate_frequency', 60),
+    # Self telemetry
+    ('otel', 'self_telemetry', 'true'),
+    ('otel', 'telemetry_port', 8889),
+    ('cloudwatch', 'optimize_windows', 'true'),
+    # Exporter JVM
+    ('cloudwatch', 'jvm_heap_mb', 0),
+    ('cloudwatch', 'jvm_gc', 'auto'),
+    ('cloudwatch', 'jvm_options', ''),
+)
+
+# Environment variables overriding config.yml: variable, section, key and type
+ENV_OVERRIDES = (
+    # Open telemetry
+    ('SCRAPE_INTERVAL', 'otel', 'scrape_interval', int),
+    ('LOGZIO_REGION', 'otel', 'logzio_region', str),
+    ('TOKEN', 'otel', 'token', str),
+    ('P8S_LOGZIO_NAME', 'otel', 'p8s_logzio_name', str),
+    ('CUSTOM_LISTENER', 'otel', 'custom_listener', str),
+    ('REMOTE_TIMEOUT', 'otel', 'remote_timeout', int),
+    ('SCRAPE_TIMEOUT', 'otel', 'scrape_timeout', int),
+    ('LOG_LEVEL', 'otel', 'log_level', str),
+    ('LOGZIO_LOG_LEVEL', 'otel', 'logzio_log_level', str),
+    ('AWS_ACCESS_KEY_ID', 'otel', 'AWS_ACCESS_KEY_ID', str),
+    ('AWS_SECRET_ACCESS_KEY', 'otel', 'AWS_SECRET_ACCESS_KEY', str),
+    # Cloudwatch exporter
+    ('DELAY_SECONDS', 'cloudwatch', 'delay_seconds', int),
+    ('RANGE_SECONDS', 'cloudwatch', 'range_seconds', int),
+    ('PERIOD_SECONDS', 'cloudwatch', 'period_seconds', int),
+    ('SET_TIMESTAMP', 'cloudwatch', 'set_timestamp', str),
+    ('AWS_REGION', 'cloudwatch', 'region', str),
+    ('AWS_NAMESPACES', 'cloudwatch', 'aws_namespaces', str),
+    ('CUSTOM_CONFIG', 'cloudwatch', 'custom_config', str),
+    ('AWS_ROLE_ARN', 'cloudwatch', 'role_arn', str),
+    ('PLAN_RESOURCES_PER_METRIC', 'cloudwatch', 'plan_resources_per_metric', int),
+    ('MAX_REQUESTS_PER_SCRAPE', 'cloudwatch', 'max_requests_per_scrape', int),
+    ('BUDGET_ACTION', 'cloudwatch', 'budget_action', str),
+    ('AWS_REGIONS', 'cloudwatch', 'regions', str),
+    ('AWS_ROLE_ARNS', 'cloudwatch', 'role_arns', str),
+    ('SHARDS', 'cloudwatch', 'shards', to_shards),
+    ('ENGINE', 'cloudwatch', 'engine', str),
+    ('NATIVE_CONCURRENCY', 'cloudwatch', 'native_concurrency', int),
+    ('NAMESPACE_TIERS', 'cloudwatch', 'namespace_tiers', to_mapping),
+    ('TAG_DISCOVERY', 'cloudwatch', 'tag_discovery', str),
+    ('TAG_DISCOVERY_TTL', 'cloudwatch', 'tag_discovery_ttl', int),
+    ('METRIC_INCLUDE', 'otel', 'metric_include', to_list),
+    ('METRIC_EXCLUDE', 'otel', 'metric_exclude', to_list),
+    ('LABEL_EXCLUDE', 'otel', 'label_exclude', to_list),
+    ('DROP_STATISTICS', 'cloudwatch', 'drop_statistics', to_list),
+    ('MAX_SERIES_PER_METRIC', 'cloudwatch', 'max_series_per_metric', int),
+    ('BATCH_SEND_SIZE', 'otel', 'batch_send_size', int),
+    ('BATCH_MAX_SIZE', 'otel', 'batch_max_size', int),
+    ('BATCH_TIMEOUT', 'otel', 'batch_timeout', int),
+    ('QUEUE_ENABLED', 'otel', 'queue_enabled', str),
+    ('QUEUE_SIZE', 'otel', 'queue_size', int),
+    ('QUEUE_CONSUMERS', 'otel', 'queue_consumers', int),
+    ('RETRY_ENABLED', 'otel', 'retry_enabled', str),
+    ('RETRY_INITIAL_INTERVAL', 'otel', 'retry_initial_interval', int),
+    ('RETRY_MAX_INTERVAL', 'otel', 'retry_max_interval', int),
+    ('RETRY_MAX_ELAPSED_TIME', 'otel', 'retry_max_elapsed_time', int),
+    ('WAL_DIRECTORY', 'otel', 'wal_directory', str),
+    ('WAL_BUFFER_SIZE', 'otel', 'wal_buffer_size', int),
+    ('WAL_TRUNCATE_FREQUENCY', 'otel', 'wal_truncate_frequency', int),
+    ('SELF_TELEMETRY', 'otel', 'self_telemetry', str),
+    ('TELEMETRY_PORT', 'otel', 'telemetry_port', int),
+    ('OPTIMIZE_WINDOWS', 'cloudwatch', 'optimize_windows', str),
+    ('JVM_HEAP_MB', 'cloudwatch', 'jvm_heap_mb', int),
+    ('JVM_GC', 'cloudwatch', 'jvm_gc', str),
+    ('JVM_OPTIONS', 'cloudwatch', 'jvm_options', str),
+)
+
+# Validated settings: section, key and validator
+SCHEMA = (
+    ('otel', 'token', iv.is_valid_logzio_token),
+    ('otel', 'p8s_logzio_name', iv.is_valid_p8s_logzio_name),
+    ('otel', 'logzio_region', iv.is_valid_logzio_region_code),
+    ('otel', 'scrape_interval', iv.is_valid_interval),
+    ('otel', 'scrape_timeout', iv.is_valid_interval),
+    ('cloudwatch', 'region', iv.is_valid_aws_region),
+    ('cloudwatch', 'delay_seconds', iv.is_valid_interval),
+    ('cloudwatch', 'range_seconds', iv.is_valid_interval),
+    ('cloudwatch', 'period_seconds', iv.is_valid_interval),
+    ('cloudwatch', 'plan_resources_per_metric', iv.is_valid_positive_int),
+    ('cloudwatch', 'max_requests_per_scrape', iv.is_valid_budget),
+    ('cloudwatch', 'budget_action', iv.is_valid_budget_action),
+    ('cloudwatch', 'shards', iv.is_valid_shards),
+    ('cloudwatch', 'engine', iv.is_valid_engine),
+    ('cloudwatch', 'native_concurrency', iv.is_valid_positive_int),
+    ('cloudwatch', 'tag_discovery', iv.is_valid_switch),
+    ('cloudwatch', 'tag_discovery_ttl', iv.is_valid_positive_int),
+    ('otel', 'metric_include', iv.is_valid_patterns),
+    ('otel', 'metric_exclude', iv.is_valid_patterns),
+    ('otel', 'label_exclude', iv.is_valid_labels),
+    ('cloudwatch', 'drop_statistics', iv.is_valid_statistics),
+    ('cloudwatch', 'max_series_per_metric', iv.is_valid_limit),
+    ('otel', 'batch_timeout', iv.is_valid_positive_int),
+    ('otel', 'queue_enabled', iv.is_valid_switch),
+    ('otel', 'queue_size', iv.is_valid_positive_int),
+    ('otel', 'queue_consumers', iv.is_valid_positive_int),
+    ('otel', 'retry_enabled', iv.is_valid_switch),
+    ('otel', 'wal_directory', iv.is_valid_directory),
+    ('otel', 'wal_buffer_size', iv.is_valid_positive_int),
+    ('otel', 'wal_truncate_frequency', iv.is_valid_positive_int),
+    ('otel', 'self_telemetry', iv.is_valid_switch),
+    ('otel', 'telemetry_port', iv.is_valid_port),
+    ('cloudwatch', 'optimize_windows', iv.is_valid_switch),
+    ('cloudwatch', 'jvm_heap_mb', iv.is_valid_limit),
+    ('cloudwatch', 'jvm_gc', iv.is_valid_jvm_gc),
+    ('cloudwatch', 'jvm_options', iv.is_valid_jvm_options),
+)
 
 
 class Config:
     def __init__(self, configPath):
         # Try to load from config file
-        with open(configPath) as f:
-            dataMap = yaml.safe_load(f)
-            self.__dict__.update(**dataMap)
-        # Try to load from env variables
-        # Open telemetry:
-        if environ.get('SCRAPE_INTERVAL') is not None:
-            self.otel['scrape_interval'] = int(environ.get('SCRAPE_INTERVAL'))
-        if environ.get('LOGZIO_REGION') is not None:
-            self.otel['logzio_region'] = environ.get('LOGZIO_REGION')
-        if environ.get('TOKEN') is not None:
-            self.otel['token'] = environ.get('TOKEN')
-        if environ.get('P8S_LOGZIO_NAME') is not None:
-            self.otel['p8s_logzio_name'] = environ.get('P8S_LOGZIO_NAME')
-        if environ.get('CUSTOM_LISTENER') is not None:
-            self.otel['custom_listener'] = environ.get('CUSTOM_LISTENER')
-        if environ.get('REMOTE_TIMEOUT') is not None:
-            self.otel['remote_timeout'] = int(environ.get('REMOTE_TIMEOUT'))
-        if environ.get('SCRAPE_TIMEOUT') is not None:
-            self.otel['scrape_timeout'] = int(environ.get('SCRAPE_TIMEOUT'))
-        if environ.get('LOG_LEVEL') is not None:
-            self.otel['log_level'] = environ.get('LOG_LEVEL')
-        if environ.get('LOGZIO_LOG_LEVEL') is not None:
-            self.otel['logzio_log_level'] = environ.get('LOGZIO_LOG_LEVEL')
-        if environ.get('AWS_ACCESS_KEY_ID') is not None:
-            self.otel['AWS_ACCESS_KEY_ID'] = environ.get('AWS_ACCESS_KEY_ID')
-        if environ.get('AWS_SECRET_ACCESS_KEY') is not None:
-            self.otel['AWS_SECRET_ACCESS_KEY'] = environ.get('AWS_SECRET_ACCESS_KEY')
-
-        # Cloudwatch exporter:
-        if environ.get('DELAY_SECONDS') is not None:
-            self.cloudwatch['delay_seconds'] = int(environ.get('DELAY_SECONDS'))
-        if environ.get('RANGE_SECONDS') is not None:
-            self.cloudwatch['range_seconds'] = int(environ.get('RANGE_SECONDS'))
-        if environ.get('PERIOD_SECONDS') is not None:
-            self.cloudwatch['period_seconds'] = int(environ.get('PERIOD_SECONDS'))
-        if environ.get('SET_TIMESTAMP') is not None:
-            self.cloudwatch['set_timestamp'] = environ.get('SET_TIMESTAMP')
-        if environ.get('AWS_REGION') is not None:
-            self.cloudwatch['region'] = environ.get('AWS_REGION')
-        if environ.get('AWS_NAMESPACES') is not None:
-            self.cloudwatch['aws_namespaces'] = environ.get('AWS_NAMESPACES')
-        if environ.get('CUSTOM_CONFIG') is not None:
-            self.cloudwatch['custom_config'] = environ.get('CUSTOM_CONFIG')
-        if environ.get('AWS_ROLE_ARN') is not None:
-            self.cloudwatch['role_arn'] = environ.get('AWS_ROLE_ARN')
-
-    # Validates user input
+        dataMap = yaml_io.load_file(configPath)
+        self.__dict__.update(**dataMap)
+        for section, key, default in DEFAULTS:
+            getattr(self, section).setdefault(key, default)
+        # Try to load from env variables. Values that can't be converted are reported by validate
+        self.envErrors = {}
+        for variable, section, key, valueType in ENV_OVERRIDES:
+            value = environ.get(variable)
+            if value is None:
+                continue
+            try:
+                getattr(self, section)[key] = valueType(value)
+            except ValueError as e:
+                self.envErrors[(section, key)] = f'{variable}: invalid value {value!r} ({e})'
+
+    # Validates user input in a single pass and raises a ConfigError with every error found.
+    # Returns the valid and the unsupported namespaces
     def validate(self) -> (list, list):
-        iv.is_valid_aws_region(self.cloudwatch['region'])
-        iv.is_valid_logzio_token(self.otel['token'])
-        iv.is_valid_p8s_logzio_name(self.otel['p8s_logzio_name'])
-        iv.is_valid_logzio_region_code(self.otel['logzio_region'])
-        iv.is_valid_interval(self.otel['scrape_interval'])
-        iv.is_valid_interval(self.cloudwatch['delay_seconds'])
-        iv.is_valid_interval(self.cloudwatch['range_seconds'])
-        iv.is_valid_interval(self.cloudwatch['period_seconds'])
-        iv.is_valid_interval(self.otel['scrape_timeout'])
-        if self.cloudwatch['custom_config'] == 'true':
-            return [], []
-        else:
-            return iv.is_valid_aws_namespaces(self.cloudwatch['aws_namespaces'])
+        errors = list(self.envErrors.values())
+        for section, key, validator in SCHEMA:
+            if (section, key) in self.envErrors:
+                continue
+            values = getattr(self, section)
+            if key not in values:
+                errors.append(f'{section}.{key} is missing')
+                continue
+            self.check(errors, f'{section}.{key}', validator, values[key])
+        targetsErrors = len(errors)
+        for key in ('regions', 'role_arns'):
+            self.check(errors, f'cloudwatch.{key}', iv.is_valid_list, self.cloudwatch[key])
+        if len(errors) == targetsErrors:
+            # Targets repeat regions and roles, each is validated once
+            for region in dict.fromkeys(self.splitList(self.cloudwatch['regions'])):
+                self.check(errors, 'cloudwatch.regions', iv.is_valid_aws_region, region)
+            roleArns = self.splitList(self.cloudwatch['role_arns']) or [self.cloudwatch.get('role_arn', '')]
+            for roleArn in dict.fromkeys(roleArns):
+                if roleArn != '':
+                    self.check(errors, 'cloudwatch.role_arns', iv.is_valid_role_arn, roleArn)
+        self.check(errors, 'otel.batch_send_size', iv.is_valid_batch, self.otel['batch_send_size'],
+                   self.otel['batch_max_size'])
+        self.check(errors, 'otel.retry_initial_interval', iv.is_valid_retry, self.otel['retry_initial_interval'],
+                   self.otel['retry_max_interval'], self.otel['retry_max_elapsed_time'])
+        tiersErrors = len(errors)
+        for key in ('tiers', 'namespace_tiers'):
+            self.check(errors, f'cloudwatch.{key}', iv.is_valid_mapping, self.cloudwatch[key])
+        if len(errors) == tiersErrors:
+            for tier, settings in self.cloudwatch['tiers'].items():
+                self.check(errors, 'cloudwatch.tiers', iv.is_valid_tier, tier, settings)
+            for namespace, tier in self.cloudwatch['namespace_tiers'].items():
+                if tier != DEFAULT_TIER and tier not in self.cloudwatch['tiers']:
+                    errors.append(f'cloudwatch.namespace_tiers: {namespace} is assigned to undefined tier {tier}')
+        namespaces = [], []
+        # A custom configuration may be merged with selected namespaces
+        if self.cloudwatch['custom_config'] != 'true' or self.cloudwatch['aws_namespaces'] not in ('', []):
+            namespaces = self.check(errors, 'cloudwatch.aws_namespaces', iv.is_valid_aws_namespaces,
+                                    self.cloudwatch['aws_namespaces'])
+        if errors:
+            raise ConfigError(errors)
+        return namespaces
+
+    # Runs a validator and records its error
+    @staticmethod
+    def check(errors, name, validator, *values):
+        try:
+            return validator(*values)
+        except (TypeError, ValueError) as e:
+            errors.append(f'{name}: {e}')
+
+    # Returns the matrix of regions and roles to collect from, a single target unless regions or role_arns are set.
+    # A custom configuration keeps its own region and role unless regions or role_arns are set. Repeated regions and
+    # roles are collected once, roles sharing an account are told apart by their name
+    def getTargets(self, custom=None) -> list:
+        custom = custom or {}
+        regions = self.splitList(self.cloudwatch['regions']) or [custom.get('region') or self.cloudwatch['region']]
+        roleArns = self.splitList(self.cloudwatch['role_arns']) or \
+            [custom.get('role_arn') or self.cloudwatch['role_arn']]
+        roleArns = list(dict.fromkeys(roleArns))
+        accounts = [self.getAccountId(roleArn) for roleArn in roleArns]
+        targets = []
+        for region in dict.fromkeys(regions):
+            for roleArn, account in zip(roleArns, accounts):
+                name = f'{region}-{account}'
+                if accounts.count(account) > 1:
+                    name += f'-{roleArn.rsplit("/", 1)[-1]}'
+                targets.append({
+                    'name': name if len(roleArns) > 1 else region,
+                    'region': region,
+                    'role_arn': roleArn,
+                    'account': account
+                })
+        return targets
+
+    # Returns the tier of a metric: the namespace tier from the config, or the metric's own tier.
+    # Tiers that are not configured fall back to the default tier
+    def getMetricTier(self, metric) -> str:
+        tier = self.cloudwatch['namespace_tiers'].get(metric['aws_namespace'].strip(), metric.get('tier'))
+        if tier in self.cloudwatch['tiers']:
+            return tier
+        return DEFAULT_TIER
+
+    # Returns the scrape settings of a tier, missing values fall back to the global settings
+    def getTierSettings(self, tier) -> dict:
+        settings = {
+            'scrape_interval': self.otel['scrape_interval'],
+            'period_seconds': self.cloudwatch['period_seconds'],
+            'range_seconds': self.cloudwatch['range_seconds'],
+            'delay_seconds': self.cloudwatch['delay_seconds']
+        }
+        settings.update(self.cloudwatch['tiers'].get(tier) or {})
+        return settings
+
+    # Returns the number of exporter processes per target, auto uses the cpu limit of the container, or the number of
+    # cores without a limit
+    def getShardCount(self, cgroupPath=jvm_sizing.CGROUP_PATH) -> int:
+        if self.cloudwatch['shards'] == 'auto':
+            cpus = jvm_sizing.read_cgroup_limits(cgroupPath)['cpus']
+            return math.ceil(cpus) if cpus else os.cpu_count() or 1
+        return self.cloudwatch['shards']
+
+    # Returns the account id of a role arn (arn:aws:iam::<account>:role/<name>)
+    @staticmethod
+    def getAccountId(roleArn) -> str:
+        parts = roleArn.split(':')
+        if len(parts) > 4 and parts[4] != '':
+            return parts[4]
+        return 'default'
+
+    @staticmethod
+    def splitList(value) -> list:
+        if type(value) is str:
+            return [v for v in value.replace(' ', '').split(',') if v != '']
+        return list(value or [])
 
     # Returns the listener url based on the region input
     def getListenerUrl(self) -> str:
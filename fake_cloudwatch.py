@@ -0,0 +1,244 @@
+"""
+This module is a fake CloudWatch, STS and tagging API, used to load test the generated configurations without AWS
+"""
+import argparse
+import datetime
+import http.server
+import json
+import logging
+import random
+import threading
+import time
+import urllib.parse
+from xml.sax.saxutils import escape
+
+ACCOUNT_ID = '1' * 12
+LIST_METRICS_PAGE_SIZE = 500
+MAX_METRIC_DATA_QUERIES = 500
+MAX_DATAPOINTS = 1440
+DEFAULT_RESOURCES_PER_PAGE = 50
+CLOUDWATCH_XMLNS = 'http://monitoring.amazonaws.com/doc/2010-08-01/'
+
+logger = logging.getLogger(__name__)
+
+
+# resource_value returns the dimension value, and resource id, of the nth resource
+def resource_value(n):
+    return f'resource-{n}'
+
+
+# parse_time parses a query protocol timestamp, with or without milliseconds
+def parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def format_time(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# members returns the values of a query protocol list parameter (Prefix.member.N[.suffix]), in order
+def members(params, prefix, suffix=''):
+    values = []
+    position = 1
+    while f'{prefix}.member.{position}{suffix}' in params:
+        values.append(params[f'{prefix}.member.{position}{suffix}'])
+        position += 1
+    return values
+
+
+class FakeCloudWatch:
+    def __init__(self, resources=100, latency=0.0, throttleRate=0.0, seed=0) -> None:
+        # Resources, so dimension sets, of every metric
+        self.resources = resources
+        # Injected response latency in seconds, and share of requests answered with a throttling error
+        self.latency = latency
+        self.throttleRate = throttleRate
+        self.random = random.Random(seed)
+        # Requests and throttled requests per action
+        self.requests = {}
+        self.throttled = {}
+        self.lock = threading.Lock()
+
+    # Handles an API request, returns the response status and body
+    def handle(self, body, headers) -> tuple:
+        if self.latency:
+            time.sleep(self.latency)
+        target = headers.get('x-amz-target')
+        if target:
+            action = target.split('.')[-1]
+            params = json.loads(body or b'{}')
+        else:
+            params = dict(urllib.parse.parse_qsl(body.decode()))
+            action = params.get('Action', '')
+        with self.lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            throttle = self.throttleRate and self.random.random() < self.throttleRate
+            if throttle:
+                self.throttled[action] = self.throttled.get(action, 0) + 1
+        if throttle:
+            return self.error(400, 'ThrottlingException' if target else 'Throttling', 'Rate exceeded', bool(target))
+        handlers = {'ListMetrics': self.listMetrics, 'GetMetricStatistics': self.getMetricStatistics,
+                    'GetMetricData': self.getMetricData, 'AssumeRole': self.assumeRole,
+                    'AssumeRoleWithWebIdentity': self.assumeRole, 'GetResources': self.getResources}
+        if action not in handlers:
+            return self.error(400, 'InvalidAction', f'{action} is not supported', bool(target))
+        try:
+            return 200, handlers[action](params)
+        except ValueError as e:
+            return self.error(400, 'ValidationError', str(e), bool(target))
+
+    @staticmethod
+    def error(status, code, message, jsonProtocol) -> tuple:
+        if jsonProtocol:
+            return status, json.dumps({'__type': code, 'message': message}).encode()
+        return status, f'<ErrorResponse><Error><Type>Sender</Type><Code>{code}</Code><Message>{escape(message)}' \
+                       f'</Message></Error></ErrorResponse>'.encode()
+
+    # Every metric has a dimension set per resource, with the requested dimension names
+    def listMetrics(self, params) -> bytes:
+        names = members(params, 'Dimensions', '.Name')
+        filters = dict(zip(names, members(params, 'Dimensions', '.Value')))
+        start = int(params.get('NextToken') or 0)
+        end = min(start + LIST_METRICS_PAGE_SIZE, self.resources)
+        metrics = []
+        for n in range(start, end):
+            dimensions = {name: resource_value(n) for name in names}
+            if any(dimensions[name] != value for name, value in filters.items()):
+                continue
+            dimensionsXml = ''.join(f'<member><Name>{escape(name)}</Name><Value>{value}</Value></member>'
+                                    for name, value in dimensions.items())
+            metrics.append(f'<member><Namespace>{escape(params.get("Namespace", ""))}</Namespace>'
+                           f'<MetricName>{escape(params.get("MetricName", ""))}</MetricName>'
+                           f'<Dimensions>{dimensionsXml}</Dimensions></member>')
+        token = f'<NextToken>{end}</NextToken>' if end < self.resources else ''
+        return f'<ListMetricsResponse xmlns="{CLOUDWATCH_XMLNS}"><ListMetricsResult><Metrics>{"".join(metrics)}' \
+               f'</Metrics>{token}</ListMetricsResult></ListMetricsResponse>'.encode()
+
+    # Returns a datapoint per period of the requested range, up to the API limit
+    def getMetricStatistics(self, params) -> bytes:
+        start, end = parse_time(params['StartTime']), parse_time(params['EndTime'])
+        period = int(params['Period'])
+        count = int((end - start).total_seconds()) // period
+        if count > MAX_DATAPOINTS:
+            raise ValueError(f'Requested {count} datapoints, the limit is {MAX_DATAPOINTS}')
+        statistics = members(params, 'Statistics')
+        extended = members(params, 'ExtendedStatistics')
+        datapoints = []
+        for position in range(count):
+            timestamp = start + datetime.timedelta(seconds=position * period)
+            values = ''.join(f'<{statistic}>{position + 1.0}</{statistic}>' for statistic in statistics)
+            if extended:
+                values += '<ExtendedStatistics>' + ''.join(
+                    f'<entry><key>{escape(statistic)}</key><value>{position + 1.0}</value></entry>'
+                    for statistic in extended) + '</ExtendedStatistics>'
+            datapoints.append(f'<member><Timestamp>{format_time(timestamp)}</Timestamp>{values}'
+                              f'<Unit>None</Unit></member>')
+        return f'<GetMetricStatisticsResponse xmlns="{CLOUDWATCH_XMLNS}"><GetMetricStatisticsResult>' \
+               f'<Label>{escape(params.get("MetricName", ""))}</Label><Datapoints>{"".join(datapoints)}' \
+               f'</Datapoints></GetMetricStatisticsResult></GetMetricStatisticsResponse>'.encode()
+
+    # Returns the latest datapoint of every query
+    def getMetricData(self, params) -> bytes:
+        ids = members(params, 'MetricDataQueries', '.Id')
+        if len(ids) > MAX_METRIC_DATA_QUERIES:
+            raise ValueError(f'{len(ids)} queries exceed the limit of {MAX_METRIC_DATA_QUERIES}')
+        end = parse_time(params['EndTime'])
+        results = []
+        for position, queryId in enumerate(ids, 1):
+            period = int(params.get(f'MetricDataQueries.member.{position}.MetricStat.Period', 60))
+            timestamp = format_time(end - datetime.timedelta(seconds=period))
+            results.append(f'<member><Id>{escape(queryId)}</Id><Timestamps><member>{timestamp}</member></Timestamps>'
+                           f'<Values><member>{float(position)}</member></Values><StatusCode>Complete</StatusCode>'
+                           f'</member>')
+        return f'<GetMetricDataResponse xmlns="{CLOUDWATCH_XMLNS}"><GetMetricDataResult><MetricDataResults>' \
+               f'{"".join(results)}</MetricDataResults></GetMetricDataResult></GetMetricDataResponse>'.encode()
+
+    # Returns credentials valid for an hour, for AssumeRole and AssumeRoleWithWebIdentity
+    @staticmethod
+    def assumeRole(params) -> bytes:
+        action = params['Action']
+        expiration = format_time(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1))
+        return f'<{action}Response><{action}Result><Credentials><AccessKeyId>fake</AccessKeyId>' \
+               f'<SecretAccessKey>fake</SecretAccessKey><SessionToken>fake</SessionToken>' \
+               f'<Expiration>{expiration}</Expiration></Credentials></{action}Result></{action}Response>'.encode()
+
+    # Returns credentials valid for an hour, like the container credentials endpoint
+    def containerCredentials(self) -> bytes:
+        with self.lock:
+            self.requests['ContainerCredentials'] = self.requests.get('ContainerCredentials', 0) + 1
+        expiration = format_time(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1))
+        return json.dumps({'AccessKeyId': 'fake', 'SecretAccessKey': 'fake', 'Token': 'fake',
+                           'Expiration': expiration}).encode()
+
+    # Every resource type has the same resources, tagged with their name
+    def getResources(self, params) -> bytes:
+        resourceType = (params.get('ResourceTypeFilters') or ['fake:resource'])[0]
+        service, _, typeName = resourceType.partition(':')
+        start = int(params.get('PaginationToken') or 0)
+        end = min(start + int(params.get('ResourcesPerPage') or DEFAULT_RESOURCES_PER_PAGE), self.resources)
+        resources = [{'ResourceARN': f'arn:aws:{service}:us-east-1:{ACCOUNT_ID}:{typeName or "resource"}/'
+                                     f'{resource_value(n)}',
+                      'Tags': [{'Key': 'Name', 'Value': resource_value(n)}]} for n in range(start, end)]
+        return json.dumps({'ResourceTagMappingList': resources,
+                           'PaginationToken': str(end) if end < self.resources else ''}).encode()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'requests': dict(self.requests), 'throttled': dict(self.throttled)}
+
+    def render(self) -> str:
+        stats = self.stats()
+        lines = []
+        for name, key, help in (('fake_cloudwatch_requests_total', 'requests', 'API requests by action.'),
+                                ('fake_cloudwatch_throttled_total', 'throttled', 'API requests throttled on purpose.')):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} counter')
+            for action, count in sorted(stats[key].items()):
+                lines.append(f'{name}{{action="{action}"}} {float(count)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Serves the fake API: POST requests are API calls, GET /credentials returns container credentials and GET /metrics
+# exposes its counters
+def serve(fake, port) -> http.server.ThreadingHTTPServer:
+    class FakeCloudWatchHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            status, body = fake.handle(self.rfile.read(int(self.headers.get('Content-Length', 0))), self.headers)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/x-amz-json-1.1' if self.headers.get('x-amz-target')
+                             else 'text/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path not in ('/metrics', '/credentials'):
+                self.send_error(404)
+                return
+            body = fake.render().encode() if self.path == '/metrics' else fake.containerCredentials()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8' if self.path == '/metrics'
+                             else 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return http.server.ThreadingHTTPServer(('', port), FakeCloudWatchHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int)
+    parser.add_argument('--resources', type=int, default=100, help='resources (dimension sets) of every metric')
+    parser.add_argument('--latency', type=float, default=0.0, help='response latency in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests throttled')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s\t\t%(levelname)s\t[%(name)s]\t%(filename)s:%(lineno)d\t%(message)s',
+                        level='INFO')
+    server = serve(FakeCloudWatch(args.resources, args.latency, args.throttle_rate), args.port)
+    logger.info(f'Serving a fake CloudWatch API with {args.resources} resources per metric on port {args.port}, '
+                f'set AWS_ENDPOINT_URL=http://localhost:{args.port}/')
+    server.serve_forever()
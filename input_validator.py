@@ -2,15 +2,32 @@
 This module is for validating user's input
 """
 import re
-from testdata.data import aws_namespaces, aws_regions
+from namespace_catalog import get_catalog
+from testdata.data import aws_regions
+
+# Lookups and patterns are built once at import
+AWS_REGIONS = frozenset(aws_regions)
+LOGZIO_REGIONS = frozenset(["au", "ca", "eu", "nl", "uk", "us", "wa"])
+BUDGET_ACTIONS = frozenset(['warn', 'fail'])
+ENGINES = frozenset(['exporter', 'native'])
+JVM_GCS = frozenset(['auto', 'serial', 'parallel', 'g1'])
+TIER_SETTINGS = frozenset(['scrape_interval', 'period_seconds', 'range_seconds', 'delay_seconds'])
+STATISTICS = frozenset(['SampleCount', 'Average', 'Sum', 'Minimum', 'Maximum'])
+# Percentiles, trimmed means, winsorized means, trimmed counts and sums (p99, tm90, wm99.5, tc(10%:90%), ...)
+EXTENDED_STATISTIC_REGEX = re.compile(r'^((p|tm|wm|tc|ts)\d{1,3}(\.\d+)?|'
+                                      r'(tm|wm|tc|ts|pr|TM|WM|TC|TS|PR)\(\d*(\.\d+)?%?:\d*(\.\d+)?%?\))$')
+LABEL_REGEX = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+TOKEN_REGEX = re.compile(r"\b[a-zA-Z]{32}\b")
+ROLE_ARN_REGEX = re.compile(r'^arn:aws[a-z\-]*:iam::[0-9]{12}:role\/.+$')
+CUSTOM_LISTENER_REGEX = re.compile(
+    r'^(http|https):\/\/(([a-z0-9]|[a-z0-9][a-z0-9\-]*[a-z0-9])\.)*([a-z0-9]|[a-z0-9][a-z0-9\-]*[a-z0-9])(:[0-9]+)?$')
 
 
 # is_valid_logzio_token checks if a given token is a valid logz.io token
 def is_valid_logzio_token(token):
     if type(token) is not str:
         raise TypeError("Token should be a string")
-    regex = r"\b[a-zA-Z]{32}\b"
-    match_obj = re.search(regex, token)
+    match_obj = TOKEN_REGEX.search(token)
     if match_obj is not None and match_obj.group() is not None:
         if any(char.islower() for char in token) and any(char.isupper() for char in token):
             return True
@@ -22,9 +39,8 @@ def is_valid_logzio_token(token):
 def is_valid_logzio_region_code(logzio_region_code):
     if logzio_region_code is None or type(logzio_region_code) is not str:
         raise TypeError("Logzio region code should be a string")
-    valid_logzio_regions = ["au", "ca", "eu", "nl", "uk", "us", "wa"]
     if logzio_region_code != "":
-        if logzio_region_code not in valid_logzio_regions:
+        if logzio_region_code not in LOGZIO_REGIONS:
             raise ValueError("invalid logzio region code: {}. cannot start monitoring".format(logzio_region_code))
     return True
 
@@ -46,24 +62,225 @@ def is_valid_interval(interval):
         raise ValueError('Parameter should be in multiplies of 60')
 
 
+def is_valid_positive_int(value):
+    if value is None or type(value) is not int:
+        raise TypeError("Parameter should be an integer")
+    if value <= 0:
+        raise ValueError('Parameter should be a positive integer')
+
+
+def is_valid_port(port):
+    if port is None or type(port) is not int:
+        raise TypeError("Port should be an integer")
+    if port <= 0 or port > 65535:
+        raise ValueError(f'{port} is not a valid port')
+
+
+# is_valid_budget checks the requests budget, 0 disables the budget
+def is_valid_budget(budget):
+    if budget is None or type(budget) is not int:
+        raise TypeError("Budget should be an integer")
+    if budget < 0:
+        raise ValueError('Budget should not be negative')
+
+
+# is_valid_limit checks an optional limit, 0 disables the limit
+def is_valid_limit(limit):
+    if limit is None or type(limit) is not int:
+        raise TypeError("Limit should be an integer")
+    if limit < 0:
+        raise ValueError('Limit should not be negative')
+
+
+# is_valid_patterns checks a list of regular expressions
+def is_valid_patterns(patterns):
+    if type(patterns) is not list:
+        raise TypeError("Patterns should be a list")
+    for pattern in patterns:
+        if type(pattern) is not str:
+            raise TypeError("Pattern should be a string")
+        try:
+            re.compile(pattern)
+        except re.error as e:
+            raise ValueError(f'Invalid pattern {pattern}: {e}')
+
+
+# is_valid_labels checks a list of prometheus label names
+def is_valid_labels(labels):
+    if type(labels) is not list:
+        raise TypeError("Labels should be a list")
+    for label in labels:
+        if type(label) is not str or LABEL_REGEX.match(label) is None:
+            raise ValueError(f'Invalid label name: {label}')
+
+
+# is_valid_statistics checks a list of cloudwatch statistics, extended statistics are percentiles like p99
+def is_valid_statistics(statistics):
+    if type(statistics) is not list:
+        raise TypeError("Statistics should be a list")
+    for statistic in statistics:
+        if statistic not in STATISTICS and (type(statistic) is not str or EXTENDED_STATISTIC_REGEX.match(statistic) is None):
+            raise ValueError(f'{statistic} is not a cloudwatch statistic')
+
+
+# is_valid_directory checks an optional absolute directory path
+def is_valid_directory(path):
+    if type(path) is not str:
+        raise TypeError("Directory should be a string")
+    if path != '' and not path.startswith('/'):
+        raise ValueError(f'{path} should be an absolute path')
+
+
+# is_valid_batch checks the batch processor sizes, a max size of 0 doesn't limit the batches
+def is_valid_batch(send_size, max_size):
+    is_valid_positive_int(send_size)
+    is_valid_limit(max_size)
+    if max_size and max_size < send_size:
+        raise ValueError('Batch max size should not be lower than the batch send size')
+
+
+# is_valid_retry checks the retry intervals, a max elapsed time of 0 retries forever
+def is_valid_retry(initial_interval, max_interval, max_elapsed_time):
+    is_valid_positive_int(initial_interval)
+    is_valid_positive_int(max_interval)
+    is_valid_limit(max_elapsed_time)
+    if initial_interval > max_interval:
+        raise ValueError('Retry initial interval should not be greater than the max interval')
+    if max_elapsed_time and max_interval > max_elapsed_time:
+        raise ValueError('Retry max interval should not be greater than the max elapsed time')
+
+
+def is_valid_budget_action(action):
+    if type(action) is not str:
+        raise TypeError("Budget action should be a string")
+    if action not in BUDGET_ACTIONS:
+        raise ValueError(f'{action} budget action is not supported')
+
+
+# is_valid_shards checks the number of exporter shards, auto derives it from the number of cores
+def is_valid_shards(shards):
+    if shards == 'auto':
+        return
+    if shards is None or type(shards) is not int:
+        raise TypeError("Shards should be an integer or auto")
+    if shards <= 0:
+        raise ValueError('Shards should be a positive integer')
+
+
+# is_valid_switch checks a "true" / "false" setting
+def is_valid_switch(value):
+    if type(value) is not str:
+        raise TypeError("Parameter should be a string")
+    if value not in ['true', 'false']:
+        raise ValueError(f'{value} should be true or false')
+
+
+def is_valid_engine(engine):
+    if type(engine) is not str:
+        raise TypeError("Engine should be a string")
+    if engine not in ENGINES:
+        raise ValueError(f'{engine} engine is not supported')
+
+
+def is_valid_jvm_gc(gc):
+    if type(gc) is not str:
+        raise TypeError("JVM garbage collector should be a string")
+    if gc not in JVM_GCS:
+        raise ValueError(f'{gc} garbage collector is not supported')
+
+
+# is_valid_jvm_options checks space separated JVM options
+def is_valid_jvm_options(options):
+    if type(options) is not str:
+        raise TypeError("JVM options should be a string")
+    for option in options.split():
+        if not option.startswith('-'):
+            raise ValueError(f'{option} is not a JVM option')
+
+
+# is_valid_mapping checks a mapping setting, like the scrape tiers
+def is_valid_mapping(value):
+    if type(value) is not dict:
+        raise TypeError(f'{value!r} should be a mapping')
+
+
+# is_valid_list checks a list setting, like the target regions, given as a list or a comma separated string
+def is_valid_list(value):
+    if value is not None and type(value) not in (str, list):
+        raise TypeError(f'{value!r} should be a list or a comma separated string')
+
+
+# is_valid_tier checks a scrape tier's settings, every setting is optional
+def is_valid_tier(tier, settings):
+    if type(tier) is not str:
+        raise TypeError("Tier name should be a string")
+    if settings is None:
+        return
+    if type(settings) is not dict:
+        raise TypeError(f'{tier} tier settings should be a mapping')
+    for key, value in settings.items():
+        if key not in TIER_SETTINGS:
+            raise ValueError(f'{key} is not a supported setting of {tier} tier')
+        is_valid_interval(value)
+
+
+# is_valid_window checks the request window settings of a cloudwatch exporter configuration or metric entry,
+# every setting is optional
+def is_valid_window(values):
+    for key in ('period_seconds', 'range_seconds'):
+        if key in values:
+            is_valid_interval(values[key])
+    if 'delay_seconds' in values:
+        is_valid_limit(values['delay_seconds'])
+
+
+# is_valid_custom_metric checks a metric entry of a custom cloudwatch exporter configuration
+def is_valid_custom_metric(metric):
+    if type(metric) is not dict:
+        raise TypeError("Metric entry should be a mapping")
+    for key in ('aws_namespace', 'aws_metric_name'):
+        if type(metric.get(key)) is not str or metric[key].strip() == '':
+            raise ValueError(f'{key} is missing')
+    dimensions = metric.get('aws_dimensions') or []
+    if type(dimensions) is not list or any(type(dimension) is not str for dimension in dimensions):
+        raise TypeError("aws_dimensions should be a list of strings")
+    # Entries without statistics get the default statistics
+    for key in ('aws_statistics', 'aws_extended_statistics'):
+        try:
+            is_valid_statistics(metric.get(key) or [])
+        except (TypeError, ValueError) as e:
+            raise type(e)(f'{key}: {e}')
+    is_valid_window(metric)
+
+
 def is_valid_aws_region(aws_region):
     if aws_region is None or type(aws_region) is not str:
         raise TypeError("AWS region parameter should be a string")
-    if aws_region not in aws_regions:
+    if aws_region not in AWS_REGIONS:
         raise ValueError(f'{aws_region} is not supported')
 
 
+def is_valid_role_arn(role_arn):
+    if type(role_arn) is not str:
+        raise TypeError("Role arn should be a string")
+    if ROLE_ARN_REGEX.search(role_arn) is None:
+        raise ValueError(f'Invalid role arn: {role_arn}')
+
+
 def is_valid_aws_namespaces(namespaces):
     if type(namespaces) is str:
         aws_namespaces_list = namespaces.replace(' ', '').split(',')
     elif type(namespaces) is list:
         aws_namespaces_list = namespaces
+    else:
+        raise TypeError("AWS namespaces should be a string or a list")
 
     if aws_namespaces_list == ['']:
         raise ValueError('Cant find aws namespaces')
+    catalog = get_catalog()
     to_remove = []
     for n in aws_namespaces_list:
-        if n not in aws_namespaces:
+        if not catalog.hasNamespace(n):
             to_remove.append(n)
     ns_list = sorted(list(set(aws_namespaces_list) - set(to_remove)))
     if ns_list:
@@ -80,8 +297,7 @@ def is_valid_p8s_logzio_name(p8s):
 def is_valid_custom_listener(listener):
     if type(listener) is not str:
         raise TypeError("Custom listener should be a string")
-    regex = r'^(http|https):\/\/(([a-z0-9]|[a-z0-9][a-z0-9\-]*[a-z0-9])\.)*([a-z0-9]|[a-z0-9][a-z0-9\-]*[a-z0-9])(:[0-9]+)?$'
-    match_obj = re.search(regex, listener)
+    match_obj = CUSTOM_LISTENER_REGEX.search(listener)
     if match_obj is not None and match_obj.group() is not None:
         return True
     else:
@@ -0,0 +1,71 @@
+"""
+This module sizes the cloudwatch exporter JVMs from the container's cgroup limits and the series they scrape
+"""
+import math
+import os
+
+CGROUP_PATH = '/sys/fs/cgroup'
+# cgroup v1 reports an unlimited memory as a value close to the max int64
+UNLIMITED_MEMORY = 1 << 62
+# Memory left to the opentelemetry collector and builder
+RESERVED_MB = 256
+# Share of an exporter's memory given to the heap, the rest is metaspace, thread stacks and code cache
+HEAP_SHARE = 0.6
+BASE_HEAP_MB = 64
+HEAP_KB_PER_SERIES = 4
+MIN_HEAP_MB = 32
+# Heaps from this size, with at least 2 cpus per exporter, use the parallel collector
+PARALLEL_GC_MIN_HEAP_MB = 512
+GC_OPTIONS = {'serial': '-XX:+UseSerialGC', 'parallel': '-XX:+UseParallelGC', 'g1': '-XX:+UseG1GC'}
+
+
+def read_file(path):
+    try:
+        with open(path, 'r') as cgroupFile:
+            return cgroupFile.read().strip()
+    except OSError:
+        return None
+
+
+# read_cgroup_limits returns the memory limit in MB and the cpu limit of the container, None when unlimited.
+# Both cgroup v2 and v1 are supported
+def read_cgroup_limits(root=CGROUP_PATH) -> dict:
+    memory = read_file(os.path.join(root, 'memory.max'))
+    if memory is None:
+        memory = read_file(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+    memoryMb = int(memory) // (1024 * 1024) if memory and memory.isdigit() and int(memory) < UNLIMITED_MEMORY \
+        else None
+    cpus = None
+    cpuMax = read_file(os.path.join(root, 'cpu.max'))
+    if cpuMax is not None:
+        quota, _, period = cpuMax.partition(' ')
+    else:
+        quota = read_file(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'))
+        period = read_file(os.path.join(root, 'cpu', 'cpu.cfs_period_us'))
+    if quota and period and quota.isdigit() and period.isdigit() and int(period) > 0:
+        cpus = int(quota) / int(period)
+    return {'memory_mb': memoryMb, 'cpus': cpus}
+
+
+# size_jvm returns the heap size, garbage collector and options of one of several exporters scraping an estimated
+# number of series. heapMb and gc override the computed values, options are appended
+def size_jvm(series, exporters, limits, heapMb=0, gc='auto', options=()) -> dict:
+    cpus = limits['cpus'] / exporters if limits['cpus'] else None
+    estimate = BASE_HEAP_MB + math.ceil(series * HEAP_KB_PER_SERIES / 1024)
+    maxHeap = None
+    if limits['memory_mb']:
+        maxHeap = max(int((limits['memory_mb'] - RESERVED_MB) / exporters * HEAP_SHARE), MIN_HEAP_MB)
+    heap = heapMb or (min(estimate, maxHeap) if maxHeap else estimate)
+    if gc == 'auto':
+        gc = 'parallel' if heap >= PARALLEL_GC_MIN_HEAP_MB and (cpus is None or cpus >= 2) else 'serial'
+    jvmOptions = [f'-Xmx{heap}m', f'-Xms{min(heap, BASE_HEAP_MB)}m', GC_OPTIONS[gc]]
+    if cpus is not None:
+        processors = max(math.floor(cpus), 1)
+        jvmOptions.append(f'-XX:ActiveProcessorCount={processors}')
+        if gc != 'serial':
+            jvmOptions.append(f'-XX:ParallelGCThreads={processors}')
+    # Class data sharing: loads the JDK classes from the archive dumped at image build, when it exists
+    jvmOptions.append('-Xshare:auto')
+    jvmOptions.extend(options)
+    return {'heap_mb': heap, 'estimated_heap_mb': estimate, 'max_heap_mb': maxHeap, 'gc': gc,
+            'options': jvmOptions}
@@ -0,0 +1,300 @@
+"""
+This module load tests the generated configurations against the fake CloudWatch API and the fake remote write endpoint,
+and compares their throughput to a baseline
+"""
+import argparse
+import json
+import logging
+import os
+import shlex
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from builder import Builder, COLLECTOR_BINARY
+import fake_cloudwatch
+import remote_write_sink
+from supervisor import is_port_open
+from telemetry import parse_accepted_points, COLLECTOR_METRICS_URL
+import yaml_io
+
+DEFAULT_CONFIG_PATH = './testdata/test-config.yml'
+DEFAULT_BASELINE_PATH = './load_test_baseline.json'
+DEFAULT_THRESHOLD = 0.5
+DEFAULT_SCRAPES = 3
+DEFAULT_RESOURCES = 50
+STARTUP_TIMEOUT = 60
+SCRAPE_TIMEOUT = 300
+# Results that regress when they grow, and when they drop
+LOWER_IS_BETTER = ('scrape_duration_seconds', 'requests_per_scrape', 'peak_rss_mb')
+HIGHER_IS_BETTER = ('series_per_scrape', 'series_per_second')
+# Results that don't depend on the machine, any degradation of them is a regression. Timings and memory are only comparable
+# to a baseline recorded on the same machine
+COUNTS = ('requests_per_scrape', 'series_per_scrape')
+
+logger = logging.getLogger(__name__)
+
+
+def free_port() -> int:
+    with socket.socket() as portSocket:
+        portSocket.bind(('', 0))
+        return portSocket.getsockname()[1]
+
+
+# peak_rss_mb returns the peak resident memory of a process and its children, None if it can't be read
+def peak_rss_mb(pid):
+    pids = [pid]
+    try:
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                with open(f'/proc/{entry}/stat') as statFile:
+                    if int(statFile.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+    except OSError:
+        return None
+    total = 0
+    for processId in pids:
+        try:
+            with open(f'/proc/{processId}/status') as statusFile:
+                total += next(int(line.split()[1]) for line in statusFile if line.startswith('VmHWM:'))
+        except (OSError, StopIteration):
+            continue
+    return round(total / 1024, 1) if total else None
+
+
+# count_series returns the cloudwatch series of an exporter scrape, without the exporter's own metrics
+def count_series(text) -> int:
+    return sum(1 for line in text.splitlines() if line and not line.startswith(('#', 'cloudwatch_')))
+
+
+class LoadTest:
+    def __init__(self, configPath, workDir, resources=DEFAULT_RESOURCES, latency=0.0, throttleRate=0.0) -> None:
+        self.configPath = configPath
+        self.workDir = workDir
+        self.fake = fake_cloudwatch.FakeCloudWatch(resources, latency, throttleRate)
+        self.sink = remote_write_sink.RemoteWriteSink()
+        self.servers = []
+        self.endpoint = None
+        self.sinkUrl = None
+        self.builder = None
+        # Environment replaced while the load test runs
+        self.savedEnviron = {}
+
+    def start(self) -> None:
+        for name, server in (('endpoint', fake_cloudwatch.serve(self.fake, 0)),
+                             ('sinkUrl', remote_write_sink.serve(self.sink, 0))):
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+            setattr(self, name, f'http://localhost:{server.server_address[1]}/')
+        # Builder's tag discovery and the exporters it runs call the fake API
+        environ = {'AWS_ENDPOINT_URL': self.endpoint, 'AWS_ACCESS_KEY_ID': 'fake', 'AWS_SECRET_ACCESS_KEY': 'fake'}
+        self.savedEnviron = {name: os.environ.get(name) for name in environ}
+        os.environ.update(environ)
+
+    def stop(self) -> None:
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        for name, value in self.savedEnviron.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+    # Generates the configurations with the native engine, since cloudwatch exporter has no endpoint override.
+    # Returns the generation time and the estimated requests for the fake's resources
+    def generate(self, scrapeInterval=None) -> dict:
+        self.builder = Builder(self.configPath, otelConfigPath=os.path.join(self.workDir, 'otel-config.yml'),
+                               cloudwatchConfigPath=os.path.join(self.workDir, 'cloudwatch.yml'))
+        self.builder.logger.setLevel(logging.WARNING)
+        config = self.builder.config
+        config.cloudwatch['engine'] = 'native'
+        config.cloudwatch['plan_resources_per_metric'] = self.fake.resources
+        config.otel['custom_listener'] = self.sinkUrl.rstrip('/')
+        if scrapeInterval:
+            config.otel['scrape_interval'] = config.otel['scrape_timeout'] = scrapeInterval
+        started = time.perf_counter()
+        if not self.builder.generate(force=True):
+            raise RuntimeError('Generation failed, the estimated requests exceed the budget')
+        duration = time.perf_counter() - started
+        plan = self.builder.planCloudwatchConfiguration()
+        return {'generate_seconds': duration, 'jobs': len(self.builder.jobs),
+                'estimated_requests_per_scrape': plan['requests'], 'estimated_series_per_scrape': plan['series']}
+
+    # Returns the requests sent to the fake API so far, by action
+    def countRequests(self) -> dict:
+        return self.fake.stats()['requests']
+
+    # Runs an exporter per generated job and scrapes them all at once, like the collector does
+    def runExporters(self, scrapes=DEFAULT_SCRAPES) -> dict:
+        processes = []
+        try:
+            ports = []
+            for job in self.builder.jobs:
+                port = free_port()
+                command = shlex.split(self.builder.getExecCommand(job).replace('{{port}}', str(port)))
+                # The exporters run with this interpreter
+                command[0] = sys.executable if command[0] == 'python3' else command[0]
+                processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+                ports.append(port)
+            for process, port in zip(processes, ports):
+                self.waitForPort(process, port)
+            durations, requests, series, errors = [], [], 0, 0
+            for _ in range(scrapes):
+                before = self.countRequests()
+                started = time.perf_counter()
+                texts = self.scrapeAll(ports)
+                durations.append(time.perf_counter() - started)
+                actions = {action: count - before.get(action, 0) for action, count in self.countRequests().items()}
+                requests.append(sum(actions.values()))
+                series = sum(count_series(text) for text in texts if text is not None)
+                errors += sum(1 for text in texts if text is None or 'cloudwatch_exporter_scrape_error 1' in text)
+            rss = [peak_rss_mb(process.pid) for process in processes]
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+        duration = statistics.median(durations)
+        return {'scrapes': scrapes, 'scrape_duration_seconds': duration, 'max_scrape_duration_seconds': max(durations),
+                'requests_per_scrape': statistics.median(requests), 'last_scrape_requests': actions,
+                'throttled_requests': sum(self.fake.stats()['throttled'].values()), 'series_per_scrape': series,
+                'series_per_second': series / duration if duration else 0.0, 'scrape_errors': errors,
+                'peak_rss_mb': sum(rss) if None not in rss else None}
+
+    @staticmethod
+    def waitForPort(process, port) -> None:
+        deadline = time.time() + STARTUP_TIMEOUT
+        while not is_port_open(port):
+            if process.poll() is not None or time.time() > deadline:
+                raise RuntimeError(f'Exporter {" ".join(process.args)} did not start')
+            time.sleep(0.1)
+
+    # Scrapes the exporters concurrently, returns their metrics, None for failed scrapes
+    @staticmethod
+    def scrapeAll(ports) -> list:
+        texts = [None] * len(ports)
+
+        def scrape(position):
+            try:
+                with urllib.request.urlopen(f'http://localhost:{ports[position]}/metrics',
+                                            timeout=SCRAPE_TIMEOUT) as response:
+                    texts[position] = response.read().decode('utf-8')
+            except OSError as e:
+                logger.error(f'Scrape of port {ports[position]} failed: {e}')
+
+        threads = [threading.Thread(target=scrape, args=(position,)) for position in range(len(ports))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return texts
+
+    # Runs the collector with the generated configuration for a duration, and measures what it accepted and wrote
+    def runCollector(self, duration) -> dict:
+        otelConfigPath = self.builder.otelConfigPath
+        values = yaml_io.load_file(otelConfigPath)
+        for name, receiver in values['receivers'].items():
+            if name.startswith('prometheus_exec'):
+                receiver['env'] = list(receiver.get('env') or []) + [
+                    {'name': 'AWS_ENDPOINT_URL', 'value': self.endpoint}]
+        self.builder.writeConfiguration(otelConfigPath, values)
+        process = subprocess.Popen([COLLECTOR_BINARY, '--config', otelConfigPath], stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+        try:
+            time.sleep(duration)
+            with urllib.request.urlopen(COLLECTOR_METRICS_URL, timeout=10) as response:
+                points = parse_accepted_points(response.read().decode('utf-8'))
+            rss = peak_rss_mb(process.pid)
+        finally:
+            process.terminate()
+            process.wait()
+        sinkStats = self.sink.stats()
+        return {'duration_seconds': duration, 'accepted_points_per_second': sum(points.values()) / duration,
+                'remote_write_requests': sinkStats['requests'],
+                'remote_write_bytes_per_second': sinkStats['bytes'] / duration, 'collector_peak_rss_mb': rss}
+
+
+# compare_results returns the regressions of a run, as the ratio of the worse to the better value: counts worse than
+# the baseline and, if timings is set, timings and memory worse than the baseline by more than the threshold
+def compare_results(baseline, results, threshold=DEFAULT_THRESHOLD, timings=False) -> dict:
+    regressions = {}
+    for name in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        if not baseline.get(name) or results.get(name) is None or (name not in COUNTS and not timings):
+            continue
+        ratio = results[name] / baseline[name] if name in LOWER_IS_BETTER else \
+            baseline[name] / max(results[name], 1e-9)
+        if ratio > (1 if name in COUNTS else 1 + threshold):
+            regressions[name] = ratio
+    return regressions
+
+
+def format_results(results, baseline=None) -> str:
+    lines = [f'{"result":<34}{"value":>14}{"baseline":>14}{"change":>10}']
+    for name, value in results.items():
+        if isinstance(value, dict):
+            value = ', '.join(f'{key}={count}' for key, count in sorted(value.items()))
+            lines.append(f'{name:<34}{value}')
+            continue
+        change = ''
+        base = (baseline or {}).get(name)
+        if base and value is not None:
+            change = f'{(value / base - 1) * 100:+.1f}%'
+        value = f'{value:.3f}' if isinstance(value, float) else str(value)
+        base = f'{base:.3f}' if isinstance(base, float) else ('' if base is None else str(base))
+        lines.append(f'{name:<34}{value:>14}{base:>14}{change:>10}')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH, help='builder config, environment overrides apply')
+    parser.add_argument('--resources', type=int, default=DEFAULT_RESOURCES,
+                        help='resources (dimension sets) of every metric')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API response latency in seconds')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of fake API requests throttled')
+    parser.add_argument('--scrapes', type=int, default=DEFAULT_SCRAPES)
+    parser.add_argument('--collector', type=int, metavar='SECONDS',
+                        help=f'also run {COLLECTOR_BINARY} for SECONDS and measure the remote write throughput')
+    parser.add_argument('--save', metavar='PATH', help='store the results as a JSON baseline')
+    parser.add_argument('--compare', action='store_true',
+                        help='compare the results to the baseline and fail on regressions')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE_PATH, help='JSON baseline to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='allowed degradation of the timings and memory before a regression, as a ratio')
+    parser.add_argument('--timings', action='store_true',
+                        help='also compare the timings and memory, to a baseline recorded on this machine')
+    args = parser.parse_args()
+    logging.basicConfig(level='WARNING')
+    workDir = tempfile.mkdtemp()
+    loadTest = LoadTest(args.config, workDir, args.resources, args.latency, args.throttle_rate)
+    try:
+        loadTest.start()
+        loadTestResults = loadTest.generate(60 if args.collector else None)
+        loadTestResults.update(loadTest.runExporters(args.scrapes))
+        if args.collector:
+            loadTestResults.update(loadTest.runCollector(args.collector))
+    finally:
+        loadTest.stop()
+        shutil.rmtree(workDir)
+    baselineResults = None
+    if args.compare:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        if baseline.get('resources') != args.resources:
+            sys.exit(f'The baseline was recorded with {baseline.get("resources")} resources per metric')
+        baselineResults = baseline['results']
+    print(format_results(loadTestResults, baselineResults))
+    if args.save:
+        with open(args.save, 'w') as baselineFile:
+            json.dump({'python': sys.version.split()[0], 'resources': args.resources, 'results': loadTestResults},
+                      baselineFile, indent=2, sort_keys=True)
+    if baselineResults is not None:
+        regressions = compare_results(baselineResults, loadTestResults, args.threshold, args.timings)
+        for name, ratio in regressions.items():
+            print(f'Regression: {name} is {ratio:.2f}x worse than the baseline')
+        sys.exit(1 if regressions or loadTestResults['scrape_errors'] else 0)
@@ -0,0 +1,61 @@
+"""
+This module coalesces duplicate cloudwatch exporter metric entries
+"""
+import json
+
+STATISTICS_KEYS = ('aws_statistics', 'aws_extended_statistics')
+# Statistics of entries listing neither aws_statistics nor aws_extended_statistics, like cloudwatch exporter
+DEFAULT_STATISTICS = ('Sum', 'SampleCount', 'Minimum', 'Maximum', 'Average')
+
+
+# metric_key returns the identity of a metric entry: entries with the same key only differ in their statistics
+def metric_key(metric):
+    selection = {k: v for k, v in metric.items()
+                 if k not in STATISTICS_KEYS + ('aws_namespace', 'aws_metric_name', 'aws_dimensions')}
+    return (metric['aws_namespace'].strip(),
+            metric['aws_metric_name'].strip(),
+            tuple(sorted(metric.get('aws_dimensions') or [])),
+            json.dumps(selection, sort_keys=True))
+
+
+# metric_statistics returns the statistics a metric entry requests, the default statistics if it lists none
+def metric_statistics(metric) -> list:
+    if not any(key in metric for key in STATISTICS_KEYS):
+        return list(DEFAULT_STATISTICS)
+    return (metric.get('aws_statistics') or []) + (metric.get('aws_extended_statistics') or [])
+
+
+# entry_requests returns the exporter requests a metric entry issues per scrape, for a given number of resources
+def entry_requests(metric, resources=1):
+    list_metrics = 1 if metric.get('aws_dimensions') else 0
+    tag_resources = 1 if metric.get('aws_tag_select') else 0
+    return list_metrics + tag_resources + resources
+
+
+# merge_statistics unions the statistics of a metric entry into a target entry with the same key. An entry without
+# statistics stands for the default statistics
+def merge_statistics(target, metric):
+    if not any(key in metric for key in STATISTICS_KEYS):
+        metric = dict(metric, aws_statistics=list(DEFAULT_STATISTICS))
+    if not any(key in target for key in STATISTICS_KEYS):
+        target['aws_statistics'] = list(DEFAULT_STATISTICS)
+    for stats_key in STATISTICS_KEYS:
+        if stats_key in metric:
+            stats = list(target.get(stats_key) or [])
+            stats.extend(s for s in metric[stats_key] or [] if s not in stats)
+            target[stats_key] = stats
+
+
+# merge_metrics coalesces entries with the same key and unions their statistics.
+# Returns the merged list, in first-seen order, and the number of exporter requests saved per scrape
+def merge_metrics(metrics):
+    merged = {}
+    saved = 0
+    for metric in metrics:
+        key = metric_key(metric)
+        if key not in merged:
+            merged[key] = dict(metric)
+            continue
+        merge_statistics(merged[key], metric)
+        saved += entry_requests(metric)
+    return list(merged.values()), saved
@@ -0,0 +1,125 @@
+"""
+This module compiles the cw_namespaces definitions into one indexed artifact
+"""
+import functools
+import hashlib
+import json
+import logging
+import os
+import yaml_io
+
+CATALOG_VERSION = 1
+DEFAULT_NAMESPACES_PATH = './cw_namespaces/'
+CATALOG_FILE_NAME = 'catalog.json'
+
+logger = logging.getLogger(__name__)
+
+
+class NamespaceCatalog:
+    def __init__(self, pathToNameSpaces=DEFAULT_NAMESPACES_PATH, artifactPath=None) -> None:
+        self.pathToNameSpaces = pathToNameSpaces
+        self.artifactPath = artifactPath or os.path.join(pathToNameSpaces, CATALOG_FILE_NAME)
+        self.hash = self.hashSources(pathToNameSpaces)
+        self.index = self.loadArtifact()
+        if self.index is None:
+            self.index = self.compile(pathToNameSpaces, self.hash)
+            self.writeArtifact()
+        # Decoded metric entries, filled lazily per namespace
+        self._entries = {}
+
+    # Returns a hash of the namespace files content, used to invalidate the artifact
+    @staticmethod
+    def hashSources(pathToNameSpaces) -> str:
+        digest = hashlib.sha256(f'catalog-v{CATALOG_VERSION}'.encode())
+        for fileName in sorted(os.listdir(pathToNameSpaces)):
+            if not fileName.endswith('.yml'):
+                continue
+            with open(os.path.join(pathToNameSpaces, fileName), 'rb') as namespaceFile:
+                digest.update(fileName.encode())
+                digest.update(namespaceFile.read())
+        return digest.hexdigest()
+
+    # Parses every namespace file and indexes its entries by namespace and metric name
+    @staticmethod
+    def compile(pathToNameSpaces, sourcesHash) -> dict:
+        namespaces = {}
+        for fileName in sorted(os.listdir(pathToNameSpaces)):
+            if not fileName.endswith('.yml'):
+                continue
+            with open(os.path.join(pathToNameSpaces, fileName), 'r') as namespaceFile:
+                namespaceYaml = yaml_io.load(namespaceFile) or []
+            if not namespaceYaml:
+                continue
+            namespace = namespaceYaml[0]['aws_namespace'].strip()
+            metrics = {}
+            for position, entry in enumerate(namespaceYaml):
+                metrics.setdefault(entry['aws_metric_name'], []).append(position)
+            namespaces[namespace] = {
+                'file': fileName,
+                'metrics': metrics,
+                # Entries are kept as raw json so loading the artifact doesn't decode them
+                'entries': [json.dumps(entry, sort_keys=True) for entry in namespaceYaml]
+            }
+        return {'version': CATALOG_VERSION, 'hash': sourcesHash, 'namespaces': namespaces}
+
+    # Loads the precompiled artifact, returns None if it is missing or stale
+    def loadArtifact(self):
+        try:
+            with open(self.artifactPath, 'r') as artifactFile:
+                index = json.load(artifactFile)
+        except (OSError, ValueError):
+            return None
+        if index.get('version') != CATALOG_VERSION or index.get('hash') != self.hash:
+            logger.info('Namespace catalog is stale, recompiling')
+            return None
+        return index
+
+    # Writes the compiled artifact next to the namespace files
+    def writeArtifact(self) -> None:
+        tmpPath = f'{self.artifactPath}.tmp'
+        try:
+            with open(tmpPath, 'w') as artifactFile:
+                json.dump(self.index, artifactFile)
+            os.replace(tmpPath, self.artifactPath)
+        except OSError as e:
+            logger.warning(f'Could not write namespace catalog to {self.artifactPath}: {e}')
+
+    # Returns a sorted list of the supported namespaces
+    def namespaces(self) -> list:
+        return sorted(self.index['namespaces'])
+
+    def hasNamespace(self, namespace) -> bool:
+        return namespace in self.index['namespaces']
+
+    # Returns the namespace file name without extension
+    def fileName(self, namespace) -> str:
+        return os.path.splitext(self.index['namespaces'][namespace]['file'])[0]
+
+    def metricNames(self, namespace) -> list:
+        return list(self.index['namespaces'][namespace]['metrics'])
+
+    # Returns all metric entries of a namespace, in file order
+    def getMetrics(self, namespace) -> list:
+        if namespace not in self._entries:
+            self._entries[namespace] = [json.loads(entry) for entry in
+                                        self.index['namespaces'][namespace]['entries']]
+        return [dict(entry) for entry in self._entries[namespace]]
+
+    # Returns the entries of a single metric, decoding only those entries
+    def getMetric(self, namespace, metricName) -> list:
+        namespaceIndex = self.index['namespaces'][namespace]
+        return [json.loads(namespaceIndex['entries'][position])
+                for position in namespaceIndex['metrics'].get(metricName, [])]
+
+
+# Returns the shared catalog for a namespaces directory
+@functools.lru_cache(maxsize=None)
+def get_catalog(pathToNameSpaces=DEFAULT_NAMESPACES_PATH) -> NamespaceCatalog:
+    return NamespaceCatalog(pathToNameSpaces)
+
+
+if __name__ == '__main__':
+    # Compile the artifact at image build time
+    logging.basicConfig(level='INFO')
+    catalog = NamespaceCatalog(DEFAULT_NAMESPACES_PATH)
+    logger.info(f'Compiled {len(catalog.namespaces())} namespaces to {catalog.artifactPath}')
@@ -0,0 +1,179 @@
+"""
+This module estimates the cloudwatch API cost of a generated exporter configuration
+"""
+import heapq
+import math
+import re
+from collector import MAX_QUERIES_PER_REQUEST, safe_name, to_snake_case
+from metric_merger import metric_statistics
+
+# AWS pricing for GetMetricStatistics and ListMetrics per 1,000 requests, and GetMetricData per 1,000 metrics requested
+PRICE_PER_1000_REQUESTS = 0.01
+SECONDS_PER_MONTH = 30 * 24 * 3600
+LIST_METRICS_PAGE_SIZE = 500
+GET_RESOURCES_PAGE_SIZE = 100
+PLAN_KEYS = ('list_metrics', 'get_metric_statistics', 'get_metric_data', 'get_metric_data_queries', 'get_resources',
+             'billable_requests', 'requests', 'datapoints', 'series')
+
+
+class Planner:
+    def __init__(self, config) -> None:
+        self.config = config
+
+    # Estimates the requests, datapoints and series a single metric entry produces per scrape
+    def planMetric(self, metric) -> dict:
+        resources = self.config.cloudwatch['plan_resources_per_metric']
+        settings = self.config.getTierSettings(self.config.getMetricTier(metric))
+        period = metric.get('period_seconds', settings['period_seconds'])
+        rangeSeconds = metric.get('range_seconds', settings['range_seconds'])
+        statistics = len(metric_statistics(metric))
+        native = self.config.cloudwatch['engine'] == 'native'
+        series = resources * self.countExportedStatistics(metric)
+        maxSeries = self.config.cloudwatch['max_series_per_metric']
+        dimensionSets = resources
+        if maxSeries and native and statistics:
+            dimensionSets = min(resources, max(maxSeries // statistics, 1))
+            series = min(series, max(maxSeries // statistics, 1) * statistics)
+        listMetrics = math.ceil(resources / LIST_METRICS_PAGE_SIZE) if metric.get('aws_dimensions') else 0
+        # Tag discovery resolves tag selections outside of the scrapes
+        tagSelect = metric.get('aws_tag_select') and self.config.cloudwatch['tag_discovery'] != 'true'
+        getResources = math.ceil(resources / GET_RESOURCES_PAGE_SIZE) if tagSelect else 0
+        if native:
+            # The native engine requests a query per statistic and dimension set. Queries sharing a namespace and
+            # window are batched by plan, a single metric needs the requests of its own queries
+            getMetricStatistics = 0
+            queries = dimensionSets * statistics
+            getMetricData = math.ceil(queries / MAX_QUERIES_PER_REQUEST)
+            # GetMetricData is billed per metric requested
+            billable = listMetrics + queries
+        else:
+            # The exporter requests all statistics of a dimension set in one GetMetricStatistics call
+            getMetricStatistics = resources
+            queries = getMetricData = 0
+            billable = listMetrics + getMetricStatistics
+        return {
+            'namespace': metric['aws_namespace'].strip(),
+            'list_metrics': listMetrics,
+            'get_metric_statistics': getMetricStatistics,
+            'get_metric_data': getMetricData,
+            'get_metric_data_queries': queries,
+            'get_resources': getResources,
+            'billable_requests': billable,
+            'requests': listMetrics + getMetricStatistics + getMetricData + getResources,
+            'datapoints': dimensionSets * statistics * max(rangeSeconds // period, 1),
+            'series': series,
+            'scrapes_per_month': SECONDS_PER_MONTH / settings['scrape_interval'],
+            'batch': (self.config.getMetricTier(metric), metric['aws_namespace'].strip(), rangeSeconds,
+                      metric.get('delay_seconds', settings['delay_seconds'])),
+        }
+
+    # Counts the statistics of a metric whose series pass the metric_include and metric_exclude filters
+    def countExportedStatistics(self, metric) -> int:
+        include = self.config.otel['metric_include']
+        exclude = self.config.otel['metric_exclude']
+        statistics = metric_statistics(metric)
+        if not include and not exclude:
+            return len(statistics)
+        prefix = f'{safe_name(to_snake_case(metric["aws_namespace"].strip()))}_' \
+                 f'{safe_name(to_snake_case(metric["aws_metric_name"]))}'
+        count = 0
+        for statistic in statistics:
+            name = f'{prefix}_{safe_name(to_snake_case(statistic))}'
+            if include and not any(re.search(pattern, name) for pattern in include):
+                continue
+            if any(re.search(pattern, name) for pattern in exclude):
+                continue
+            count += 1
+        return count
+
+    # Estimates the totals of a metrics list, per scrape and per month
+    def plan(self, metrics) -> dict:
+        total = dict.fromkeys(PLAN_KEYS, 0)
+        total['metrics'] = 0
+        requestsPerMonth = 0
+        billablePerMonth = 0
+        namespaces = {}
+        batches = {}
+        for metric in metrics:
+            metricPlan = self.planMetric(metric)
+            namespace = namespaces.setdefault(metricPlan['namespace'], {'metrics': 0, 'requests': 0, 'series': 0})
+            namespace['metrics'] += 1
+            namespace['requests'] += metricPlan['requests']
+            namespace['series'] += metricPlan['series']
+            total['metrics'] += 1
+            for key in PLAN_KEYS:
+                total[key] += metricPlan[key]
+            # Metrics of slower tiers are scraped less often
+            requestsPerMonth += metricPlan['requests'] * metricPlan['scrapes_per_month']
+            billablePerMonth += metricPlan['billable_requests'] * metricPlan['scrapes_per_month']
+            if metricPlan['get_metric_data_queries']:
+                batch = batches.setdefault(metricPlan['batch'], {'queries': 0, 'requests': 0,
+                                                                 'scrapes_per_month': metricPlan['scrapes_per_month']})
+                batch['queries'] += metricPlan['get_metric_data_queries']
+                batch['requests'] += metricPlan['get_metric_data']
+        # The native engine packs the queries of a namespace and window into GetMetricData requests of up to 500
+        for (_, namespace, _, _), batch in batches.items():
+            saved = batch['requests'] - math.ceil(batch['queries'] / MAX_QUERIES_PER_REQUEST)
+            for key in ('get_metric_data', 'requests'):
+                total[key] -= saved
+            namespaces[namespace]['requests'] -= saved
+            requestsPerMonth -= saved * batch['scrapes_per_month']
+        # Every target (region and account) runs the same metrics
+        targets = len(self.config.getTargets())
+        for key in PLAN_KEYS:
+            total[key] *= targets
+        for namespace in namespaces.values():
+            namespace['requests'] *= targets
+            namespace['series'] *= targets
+        total['targets'] = targets
+        total['scrape_interval'] = self.config.otel['scrape_interval']
+        total['requests_per_month'] = int(requestsPerMonth * targets)
+        total['monthly_cost'] = round(billablePerMonth * targets / 1000 * PRICE_PER_1000_REQUESTS, 2)
+        total['namespaces'] = namespaces
+        return total
+
+    # Splits metrics into shards of balanced estimated requests (longest processing time first).
+    # Metrics keep their relative order within a shard
+    def shardMetrics(self, metrics, shards) -> list:
+        shards = max(min(shards, len(metrics)), 1)
+        costs = [self.planMetric(metric)['requests'] for metric in metrics]
+        loads = [(0, shard) for shard in range(shards)]
+        assignment = [0] * len(metrics)
+        for position in sorted(range(len(metrics)), key=lambda p: costs[p], reverse=True):
+            load, shard = heapq.heappop(loads)
+            assignment[position] = shard
+            heapq.heappush(loads, (load + costs[position], shard))
+        return [[metric for position, metric in enumerate(metrics) if assignment[position] == shard]
+                for shard in range(shards)]
+
+    # Returns an error message if the plan exceeds the configured requests budget
+    def checkBudget(self, plan):
+        budget = self.config.cloudwatch['max_requests_per_scrape']
+        if budget and plan['requests'] > budget:
+            return f'Estimated {plan["requests"]} cloudwatch requests per scrape exceed the budget of {budget}'
+        return None
+
+    # Renders a plan as a readable report
+    @staticmethod
+    def formatPlan(plan) -> str:
+        lines = [f'{"namespace":<28}{"metrics":>10}{"requests":>12}{"series":>10}']
+        for name, namespace in sorted(plan['namespaces'].items()):
+            lines.append(f'{name:<28}{namespace["metrics"]:>10}{namespace["requests"]:>12}{namespace["series"]:>10}')
+        lines.append(f'{"total":<28}{plan["metrics"]:>10}{plan["requests"]:>12}{plan["series"]:>10}')
+        lines.append(f'Targets: {plan["targets"]}')
+        lines.append(f'Requests per scrape: {plan["requests"]} (ListMetrics: {plan["list_metrics"]}, '
+                     f'GetMetricStatistics: {plan["get_metric_statistics"]}, GetMetricData: {plan["get_metric_data"]} '
+                     f'for {plan["get_metric_data_queries"]} queries, GetResources: {plan["get_resources"]})')
+        lines.append(f'Datapoints per scrape: {plan["datapoints"]}')
+        lines.append(f'Series per scrape, after the metric filters and series caps: {plan["series"]}')
+        lines.append(f'Requests per month: {plan["requests_per_month"]}')
+        lines.append(f'Estimated monthly API cost: ${plan["monthly_cost"]}')
+        return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from builder import Builder
+
+    builder = Builder('./config_files/config.yml')
+    builder.config.cloudwatch['aws_namespaces'], _ = builder.config.validate()
+    print(Planner(builder.config).formatPlan(builder.planCloudwatchConfiguration()))
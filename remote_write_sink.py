@@ -0,0 +1,102 @@
+"""
+This module is a fake prometheus remote write endpoint, used to check the throughput of the remote write pipeline
+"""
+import argparse
+import http.server
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteWriteSink:
+    def __init__(self, latency=0.0, errorRate=0.0) -> None:
+        # Injected response latency in seconds, and share of requests answered with 503 to exercise the retries
+        self.latency = latency
+        self.errorRate = errorRate
+        self.started = time.time()
+        self.requests = 0
+        self.failures = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    # Records a write request, returns the response status
+    def write(self, body, headers) -> int:
+        if self.latency:
+            time.sleep(self.latency)
+        if headers.get('Content-Encoding') != 'snappy' or \
+                not headers.get('Content-Type', '').startswith('application/x-protobuf'):
+            return 400
+        with self.lock:
+            if self.errorRate and random.random() < self.errorRate:
+                self.failures += 1
+                return 503
+            self.requests += 1
+            self.bytes += len(body)
+        return 204
+
+    def stats(self) -> dict:
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {'requests': self.requests, 'failures': self.failures, 'bytes': self.bytes,
+                    'requests_per_second': self.requests / elapsed, 'bytes_per_second': self.bytes / elapsed}
+
+    def render(self) -> str:
+        stats = self.stats()
+        lines = []
+        for name, key, help in (('remote_write_sink_requests_total', 'requests', 'Accepted write requests.'),
+                                ('remote_write_sink_failures_total', 'failures', 'Write requests failed on purpose.'),
+                                ('remote_write_sink_bytes_total', 'bytes', 'Compressed bytes received.')):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {float(stats[key])}')
+        return '\n'.join(lines) + '\n'
+
+
+# Serves the sink: POST requests are writes, GET /metrics exposes its counters
+def serve(sink, port) -> http.server.ThreadingHTTPServer:
+    class SinkHandler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(sink.write(body, self.headers))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = sink.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return http.server.ThreadingHTTPServer(('', port), SinkHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('port', type=int)
+    parser.add_argument('--latency', type=float, default=0.0, help='response latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--report-interval', type=int, default=10, help='seconds between throughput reports')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s\t\t%(levelname)s\t[%(name)s]\t%(filename)s:%(lineno)d\t%(message)s',
+                        level='INFO')
+    remoteWriteSink = RemoteWriteSink(args.latency, args.error_rate)
+    server = serve(remoteWriteSink, args.port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Receiving remote write requests on port {args.port}')
+    while True:
+        time.sleep(args.report_interval)
+        sinkStats = remoteWriteSink.stats()
+        logger.info(f'{sinkStats["requests"]} requests ({sinkStats["requests_per_second"]:.2f}/s), '
+                    f'{sinkStats["bytes"]} bytes ({sinkStats["bytes_per_second"]:.0f}/s), '
+                    f'{sinkStats["failures"]} failed on purpose')
@@ -0,0 +1,180 @@
+"""
+This module runs the opentelemetry collector, restarts it with exponential backoff when it fails and stops it gracefully
+"""
+import logging
+import socket
+import subprocess
+import threading
+import time
+import urllib.request
+
+HEALTH_CHECK_URL = 'http://localhost:13133/'
+DEFAULT_INTERVAL = 10
+DEFAULT_INITIAL_BACKOFF = 1
+DEFAULT_MAX_BACKOFF = 300
+DEFAULT_STOP_TIMEOUT = 60
+# Seconds after a start before failed health checks count, the exporters start a JVM
+DEFAULT_START_PERIOD = 60
+# Consecutive failed checks before a running collector is restarted
+DEFAULT_UNHEALTHY_THRESHOLD = 3
+
+logger = logging.getLogger(__name__)
+
+
+# is_port_open returns True if a local port accepts connections, without sending a request
+def is_port_open(port, timeout=2) -> bool:
+    try:
+        socket.create_connection(('localhost', port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+
+class Supervisor:
+    def __init__(self, startProcess, exporterPorts=None, healthUrl=HEALTH_CHECK_URL, telemetry=None,
+                 initialBackoff=DEFAULT_INITIAL_BACKOFF, maxBackoff=DEFAULT_MAX_BACKOFF,
+                 stopTimeout=DEFAULT_STOP_TIMEOUT, startPeriod=DEFAULT_START_PERIOD,
+                 unhealthyThreshold=DEFAULT_UNHEALTHY_THRESHOLD) -> None:
+        # Starts the collector and returns its process
+        self.startProcess = startProcess
+        # Returns the ports of the exporters run by the collector
+        self.exporterPorts = exporterPorts or (lambda: [])
+        self.healthUrl = healthUrl
+        self.telemetry = telemetry
+        self.initialBackoff = initialBackoff
+        self.maxBackoff = maxBackoff
+        self.stopTimeout = stopTimeout
+        self.startPeriod = startPeriod
+        self.unhealthyThreshold = unhealthyThreshold
+        self.process = None
+        self.startedAt = None
+        # Consecutive failed starts, reset once the collector stays healthy for maxBackoff seconds
+        self.failures = 0
+        self.unhealthyChecks = 0
+        # Time and reason of the failure the collector is recovering from
+        self.failedAt = None
+        self.failureReason = None
+        # Exporter ports that didn't accept connections at the last check
+        self.closedPorts = set()
+        self.restarts = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if telemetry is not None:
+            telemetry.addSource(self.render)
+
+    def start(self) -> None:
+        self.process = self.startProcess()
+        self.startedAt = time.time()
+        self.unhealthyChecks = 0
+        self.closedPorts = set()
+
+    # Stops the collector with SIGTERM, so it flushes the queued remote write data, and kills it after the stop timeout
+    def terminate(self) -> None:
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(self.stopTimeout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f'Collector did not stop within {self.stopTimeout} seconds, killing it')
+            self.process.kill()
+            self.process.wait()
+
+    # Restarts the collector. Reloads restart it right away, failures after the backoff delay
+    def restart(self, reason) -> None:
+        with self.lock:
+            self.restarts[reason] = self.restarts.get(reason, 0) + 1
+        self.terminate()
+        if reason != 'reload':
+            self.failures += 1
+            if self.failedAt is None:
+                self.failedAt = time.time()
+                self.failureReason = reason
+            delay = min(self.initialBackoff * 2 ** (self.failures - 1), self.maxBackoff)
+            logger.warning(f'Restarting the collector in {delay} seconds after failure #{self.failures} ({reason})')
+            if self.stopped.wait(delay):
+                return
+        self.start()
+
+    # Returns the reason the collector is unhealthy, None if it's healthy
+    def getFailure(self):
+        if self.process.poll() is not None:
+            return 'exit'
+        try:
+            urllib.request.urlopen(self.healthUrl, timeout=5).close()
+        except OSError:
+            return 'unhealthy'
+        return None
+
+    # Logs the exporters that stop or start accepting connections. The collector restarts the exporters that crash
+    # itself, so a closed exporter port doesn't restart the collector
+    def checkExporters(self) -> None:
+        closedPorts = {port for port in self.exporterPorts() if not is_port_open(port)}
+        for port in sorted(closedPorts - self.closedPorts):
+            logger.warning(f'Exporter on port {port} does not accept connections')
+        for port in sorted(self.closedPorts - closedPorts):
+            logger.info(f'Exporter on port {port} accepts connections again')
+        with self.lock:
+            self.closedPorts = closedPorts
+
+    # Checks the collector once and restarts it if it exited, or failed the health checks past its start period
+    def check(self) -> None:
+        failure = self.getFailure()
+        now = time.time()
+        if failure is None:
+            self.unhealthyChecks = 0
+            if self.failedAt is not None:
+                recovery = now - self.failedAt
+                logger.info(f'Collector recovered from {self.failureReason} in {recovery:.1f} seconds')
+                if self.telemetry is not None:
+                    self.telemetry.record('recovery', recovery, reason=self.failureReason)
+                self.failedAt = None
+            if self.failures and now - self.startedAt >= self.maxBackoff:
+                self.failures = 0
+            if now - self.startedAt >= self.startPeriod:
+                self.checkExporters()
+            return
+        if failure == 'exit':
+            logger.error(f'Collector exited with code {self.process.returncode}')
+            self.restart(failure)
+            return
+        if now - self.startedAt < self.startPeriod:
+            return
+        self.unhealthyChecks += 1
+        logger.warning(f'Collector health check failed ({failure}), {self.unhealthyChecks}/{self.unhealthyThreshold}')
+        if self.unhealthyChecks >= self.unhealthyThreshold:
+            self.restart(failure)
+
+    # Asks the supervision loop to stop the collector, safe to call from a signal handler
+    def stop(self) -> None:
+        self.stopped.set()
+
+    # Stops the collector and returns its exit code
+    def shutdown(self) -> int:
+        logger.info('Stopping the collector')
+        self.terminate()
+        return self.process.returncode if self.process is not None else 0
+
+    # Runs the collector until stop is called, returns its exit code
+    def run(self, interval=DEFAULT_INTERVAL) -> int:
+        self.start()
+        while not self.stopped.wait(interval):
+            self.check()
+        return self.shutdown()
+
+    def render(self) -> str:
+        with self.lock:
+            restarts = sorted(self.restarts.items())
+            closedPorts = len(self.closedPorts)
+        lines = ['# HELP supervisor_restarts_total Collector restarts by reason.',
+                 '# TYPE supervisor_restarts_total counter']
+        for reason, count in restarts:
+            lines.append(f'supervisor_restarts_total{{reason="{reason}"}} {float(count)}')
+        lines.append('# HELP supervisor_collector_up 1 if the collector process is running.')
+        lines.append('# TYPE supervisor_collector_up gauge')
+        up = self.process is not None and self.process.poll() is None
+        lines.append(f'supervisor_collector_up {float(up)}')
+        lines.append('# HELP supervisor_exporters_down Exporters that did not accept connections at the last check.')
+        lines.append('# TYPE supervisor_exporters_down gauge')
+        lines.append(f'supervisor_exporters_down {float(closedPorts)}')
+        return '\n'.join(lines) + '\n'
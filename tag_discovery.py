@@ -0,0 +1,142 @@
+"""
+This module resolves aws_tag_select entries to resource ids with the tagging API, cached per selection and target
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from aws_client import AwsClient, AwsError
+
+GET_RESOURCES_TARGET = 'ResourceGroupsTaggingAPI_20170126.GetResources'
+DEFAULT_TTL = 3600
+
+logger = logging.getLogger(__name__)
+
+
+# resource_id returns the resource id of an arn, the way cloudwatch exporter matches it to a dimension value: the last
+# part of the arn, after the resource type if it's separated by a slash (app/my-alb/50dc6c495c0c9188 for a load balancer)
+def resource_id(arn):
+    resource = arn.rsplit(':', 1)[-1]
+    return resource.split('/', 1)[-1]
+
+
+# selection_key identifies a tag selection of a target, metrics with the same key share the resolved ids
+def selection_key(region, roleArn, tagSelect):
+    return json.dumps([region, roleArn, tagSelect.get('resource_type_selection'),
+                       tagSelect.get('tag_selections') or {}], sort_keys=True)
+
+
+class TagDiscovery:
+    def __init__(self, ttl=DEFAULT_TTL, cachePath=None, clientFactory=None) -> None:
+        self.ttl = ttl
+        self.cachePath = cachePath
+        self.clientFactory = clientFactory or (lambda region: AwsClient(region))
+        # Resolved selections: key -> {'ids': [...], 'fetched': timestamp}
+        self.cache = self.loadCache()
+        # Selections used since the last save, the others are pruned
+        self.used = set()
+        self.clients = {}
+
+    def loadCache(self) -> dict:
+        if not self.cachePath or not os.path.exists(self.cachePath):
+            return {}
+        try:
+            with open(self.cachePath, 'r') as cacheFile:
+                return json.load(cacheFile)
+        except ValueError:
+            logger.warning(f'Ignoring invalid tag discovery cache {self.cachePath}')
+            return {}
+
+    # Writes the cache, keeping only the selections used since the last save
+    def save(self) -> None:
+        self.cache = {key: entry for key, entry in self.cache.items() if key in self.used}
+        self.used = set()
+        if not self.cachePath:
+            return
+        tmpPath = f'{self.cachePath}.tmp'
+        with open(tmpPath, 'w') as cacheFile:
+            json.dump(self.cache, cacheFile, sort_keys=True)
+        os.replace(tmpPath, self.cachePath)
+
+    # Returns True if a cached selection is older than the ttl
+    def isStale(self, now=None) -> bool:
+        now = now or time.time()
+        return any(now - entry['fetched'] >= self.ttl for entry in self.cache.values())
+
+    # Returns a hash of the resolved ids, part of the generation inputs
+    def hash(self) -> str:
+        ids = {key: entry['ids'] for key, entry in self.cache.items()}
+        return hashlib.sha256(json.dumps(ids, sort_keys=True).encode()).hexdigest()
+
+    def getClient(self, region, roleArn) -> AwsClient:
+        if (region, roleArn) not in self.clients:
+            client = self.clientFactory(region)
+            if roleArn:
+                client = client.assumeRole(roleArn)
+            self.clients[(region, roleArn)] = client
+        return self.clients[(region, roleArn)]
+
+    # Lists the ids of the resources matching a tag selection, following every page
+    def fetch(self, client, tagSelect) -> list:
+        payload = {'ResourcesPerPage': 100}
+        if tagSelect.get('resource_type_selection'):
+            payload['ResourceTypeFilters'] = [tagSelect['resource_type_selection']]
+        tagFilters = [{'Key': key, 'Values': values}
+                      for key, values in sorted((tagSelect.get('tag_selections') or {}).items())]
+        if tagFilters:
+            payload['TagFilters'] = tagFilters
+        ids = []
+        while True:
+            result = client.callJson('tagging', GET_RESOURCES_TARGET, payload)
+            ids.extend(resource_id(mapping['ResourceARN']) for mapping in result.get('ResourceTagMappingList', []))
+            token = result.get('PaginationToken')
+            if not token:
+                return sorted(set(ids))
+            payload['PaginationToken'] = token
+
+    # Returns the ids of a tag selection, from the cache unless it expired. Returns None if it can't be resolved
+    def resolve(self, region, roleArn, tagSelect, now=None):
+        now = now or time.time()
+        key = selection_key(region, roleArn, tagSelect)
+        self.used.add(key)
+        entry = self.cache.get(key)
+        if entry is not None and now - entry['fetched'] < self.ttl:
+            return entry['ids']
+        try:
+            ids = self.fetch(self.getClient(region, roleArn), tagSelect)
+        except AwsError as e:
+            logger.error(f'Failed to discover {tagSelect.get("resource_type_selection")} resources in {region}: {e}')
+            # Keep serving the previous ids until the tagging API recovers
+            return entry['ids'] if entry is not None else None
+        logger.info(f'Discovered {len(ids)} {tagSelect.get("resource_type_selection")} resources in {region}')
+        self.cache[key] = {'ids': ids, 'fetched': now}
+        return ids
+
+    # Replaces the tag selections of metrics with dimension selections of the resolved ids, so the exporter doesn't
+    # call GetResources on every scrape. Metrics without matching resources are dropped
+    def applyToMetrics(self, metrics, region, roleArn) -> list:
+        applied = []
+        for metric in metrics:
+            tagSelect = metric.get('aws_tag_select')
+            if not tagSelect or not tagSelect.get('resource_id_dimension'):
+                applied.append(metric)
+                continue
+            ids = self.resolve(region, roleArn, tagSelect)
+            if ids is None:
+                applied.append(metric)
+                continue
+            dimension = tagSelect['resource_id_dimension']
+            dimensionSelect = dict(metric.get('aws_dimension_select') or {})
+            if dimension in dimensionSelect:
+                selected = set(dimensionSelect[dimension])
+                ids = [i for i in ids if i in selected]
+            if not ids:
+                logger.info(f'No {tagSelect.get("resource_type_selection")} resources match the tag selection of '
+                            f'{metric["aws_namespace"]} {metric["aws_metric_name"]} in {region}')
+                continue
+            dimensionSelect[dimension] = ids
+            metric = {key: value for key, value in metric.items() if key != 'aws_tag_select'}
+            metric['aws_dimension_select'] = dimensionSelect
+            applied.append(metric)
+        return applied
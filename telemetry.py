@@ -0,0 +1,129 @@
+"""
+This module times the phases of builder and the collector startup, logs them as JSON and serves them as metrics
+"""
+import contextlib
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.request
+
+COLLECTOR_METRICS_URL = 'http://localhost:8888/metrics'
+ACCEPTED_POINTS_METRIC = 'otelcol_receiver_accepted_metric_points'
+
+logger = logging.getLogger(__name__)
+
+
+# parse_accepted_points returns the metric points accepted by each receiver, from the collector's own metrics
+def parse_accepted_points(text) -> dict:
+    points = {}
+    for line in text.splitlines():
+        if not line.startswith(ACCEPTED_POINTS_METRIC):
+            continue
+        labels, _, value = line.rpartition('} ')
+        for label in labels.split('{', 1)[-1].split(','):
+            key, _, labelValue = label.partition('=')
+            if key == 'receiver':
+                receiver = labelValue.strip('"')
+                points[receiver] = points.get(receiver, 0) + float(value)
+    return points
+
+
+class Telemetry:
+    def __init__(self) -> None:
+        self.started = time.time()
+        # Phase durations: phase -> {'count': ..., 'sum': ..., 'last': ...}
+        self.phases = {}
+        # Functions rendering more metrics, served with the phases
+        self.sources = []
+        self.lock = threading.Lock()
+
+    def addSource(self, render) -> None:
+        self.sources.append(render)
+
+    # Records the duration of a phase, logged as a JSON line
+    def record(self, phase, duration, level=logging.INFO, **fields) -> None:
+        with self.lock:
+            stats = self.phases.setdefault(phase, {'count': 0, 'sum': 0.0, 'last': 0.0})
+            stats['count'] += 1
+            stats['sum'] += duration
+            stats['last'] = duration
+        if logger.isEnabledFor(level):
+            logger.log(level, json.dumps(dict(fields, event='phase', phase=phase, duration_seconds=round(duration, 6)),
+                                         sort_keys=True))
+
+    # Times the enclosed block as a phase
+    @contextlib.contextmanager
+    def span(self, phase, level=logging.INFO, **fields):
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.record(phase, time.perf_counter() - started, level, status=status, **fields)
+
+    # Waits for the collector to start and for the first scrape accepted by each receiver, and records them as the
+    # collector_start and first_scrape phases. The collector's own metrics are polled, so the exporters are not
+    # scraped again. Returns the receivers that scraped before the timeout
+    def measureStartup(self, receivers, started, timeout=900, interval=1, url=COLLECTOR_METRICS_URL) -> list:
+        pending = set(receivers)
+        collectorStarted = False
+        while time.time() - started < timeout:
+            try:
+                with urllib.request.urlopen(url, timeout=interval) as response:
+                    points = parse_accepted_points(response.read().decode('utf-8'))
+            except OSError:
+                time.sleep(interval)
+                continue
+            if not collectorStarted:
+                collectorStarted = True
+                self.record('collector_start', time.time() - started)
+            for receiver in sorted(pending):
+                if points.get(receiver, 0) > 0:
+                    pending.discard(receiver)
+                    self.record('first_scrape', time.time() - started, receiver=receiver)
+            if not pending:
+                break
+            time.sleep(interval)
+        if pending:
+            logger.warning(f'No successful scrape of {sorted(pending)} after {timeout} seconds')
+        return [receiver for receiver in receivers if receiver not in pending]
+
+    def render(self) -> str:
+        with self.lock:
+            phases = sorted(self.phases.items())
+        lines = ['# HELP builder_phase_duration_seconds Time spent in each phase of builder and the collector startup.',
+                 '# TYPE builder_phase_duration_seconds summary']
+        for phase, stats in phases:
+            lines.append(f'builder_phase_duration_seconds_sum{{phase="{phase}"}} {stats["sum"]}')
+            lines.append(f'builder_phase_duration_seconds_count{{phase="{phase}"}} {float(stats["count"])}')
+        lines.append('# HELP builder_phase_last_duration_seconds Duration of the last run of each phase.')
+        lines.append('# TYPE builder_phase_last_duration_seconds gauge')
+        for phase, stats in phases:
+            lines.append(f'builder_phase_last_duration_seconds{{phase="{phase}"}} {stats["last"]}')
+        lines.append('# HELP builder_start_time_seconds Start time of builder since unix epoch in seconds.')
+        lines.append('# TYPE builder_start_time_seconds gauge')
+        lines.append(f'builder_start_time_seconds {self.started}')
+        return '\n'.join(lines) + '\n' + ''.join(render() for render in self.sources)
+
+
+# Serves the phase metrics over http
+def serve(telemetry, port) -> http.server.ThreadingHTTPServer:
+    class TelemetryHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = telemetry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return http.server.ThreadingHTTPServer(('', port), TelemetryHandler)
@@ -1,5 +1,3 @@
 aws_regions = ['us-east-1', 'us-east-2', 'us-west-1', 'us-west-2', 'af-south-1', 'ap-east-1', 'ap-south-1',
                     'ap-northeast-2', 'ap-southeast-1', 'ap-southeast-2', 'ap-northeast-1', 'eu-central-1', 'eu-west-1', 'eu-west-2', 'eu-south-1', 'eu-west-3', 'eu-north-1', 'me-south-1', 'sa-east-1', 'ca-central-1', 'us-gov-west-1', 'us-gov-east-1']
 
-aws_namespaces = ['AWS/SSM-RunCommand', 'AWS/Logs', 'AWS/ApplicationELB','AWS/NetworkELB', 'AWS/ELB', 'AWS/EC2', 'AWS/AutoScaling', 'AWS/S3', 'AWS/ECS', 'AWS/RDS',
-                                'AWS/EBS', 'AWS/CloudFront', 'AWS/SQS', 'AWS/Kafka', 'AWS/EFS', 'AWS/Kinesis', 'AWS/Lambda', 'AWS/Route53', 'AWS/DynamoDB', 'AWS/ElastiCache', 'AWS/SNS', 'AWS/Redshift', 'AWS/Fargate', 'AWS/Athena', 'AWS/ApiGateway', 'AWS/AmazonMQ', 'AWS/AppRunner', 'AWS/Firehose', 'AWS/VPN', 'AWS/WAF', 'AWS/WAFV2', 'AWS/NATGateway', 'AWS/DDoSProtection', 'AWS/FSx', 'AWS/Billing', 'CloudWatchSynthetics']
@@ -1,12 +1,45 @@
+import datetime
+import hashlib
+import http.server
+import io
+import json
+import logging
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.parse
+import urllib.request
 
 import yaml
 
 from builder import Builder
-from config import Config
+from config import Config, ConfigError
 import input_validator as iv
-from testdata.data import aws_namespaces as ns_list
+from metric_merger import merge_metrics
+from planner import Planner
+from aws_client import AwsClient, AwsError
+from collector import Collector
+from benchmarks import Benchmarks, compare_results
+from namespace_catalog import NamespaceCatalog, get_catalog
+from tag_discovery import TagDiscovery, resource_id
+import remote_write_sink
+import telemetry
+import jvm_sizing
+from window_optimizer import RESOLUTION_KEYS, optimize_window, check_window
+from supervisor import Supervisor
+import fake_cloudwatch
+import load_test
+import yaml_io
+
+ns_list = get_catalog().namespaces()
 
 
 class TestBuilder(unittest.TestCase):
@@ -118,11 +151,516 @@ class TestBuilder(unittest.TestCase):
         except Exception as e:
             self.fail(f'Unexpected error {e}')
 
+    def test_multi_target_configuration(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            shutil.copy('./testdata/cloudwatch-test.yml', os.path.join(tmpDir, 'cloudwatch.yml'))
+            shutil.copy('./testdata/default-otel.yml', os.path.join(tmpDir, 'otel.yml'))
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.config.cloudwatch['regions'] = 'us-east-1,eu-west-1'
+            builder.config.cloudwatch['role_arns'] = ['arn:aws:iam::111111111111:role/cw',
+                                                      'arn:aws:iam::222222222222:role/cw']
+            builder.updateCloudwatchConfiguration('./cw_namespaces/')
+            builder.updateOtelConfiguration()
+            self.assertEqual(len(builder.jobs), 4)
+            with open(os.path.join(tmpDir, 'cloudwatch-eu-west-1-222222222222.yml')) as cw:
+                values = yaml.safe_load(cw)
+                self.assertEqual(values['region'], 'eu-west-1')
+                self.assertEqual(values['role_arn'], 'arn:aws:iam::222222222222:role/cw')
+                self.assertEqual(values['metrics'], builder.metrics)
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            self.assertNotIn('prometheus_exec', values['receivers'])
+            receiver = values['receivers']['prometheus_exec/us-east-1-222222222222']
+            self.assertEqual(receiver['port'], 9107)
+            self.assertTrue(receiver['exec'].endswith('cloudwatch-us-east-1-222222222222.yml'))
+            self.assertEqual(receiver['scrape_interval'], '300s')
+            pipeline = values['service']['pipelines']['metrics/us-east-1-222222222222']
+            self.assertEqual(pipeline['exporters'], ['logging', 'prometheusremotewrite'])
+            labels = values['processors'][pipeline['processors'][0]]['transforms'][0]['operations']
+            self.assertIn({'action': 'add_label', 'new_label': 'account', 'new_value': '222222222222'}, labels)
+            self.assertIn({'action': 'add_label', 'new_label': 'region', 'new_value': 'us-east-1'}, labels)
+            self.assertEqual(builder.planCloudwatchConfiguration()['targets'], 4)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_sharded_configuration(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            shutil.copy('./testdata/cloudwatch-test.yml', os.path.join(tmpDir, 'cloudwatch.yml'))
+            shutil.copy('./testdata/default-otel.yml', os.path.join(tmpDir, 'otel.yml'))
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.config.cloudwatch['shards'] = 3
+            builder.updateCloudwatchConfiguration('./cw_namespaces/')
+            builder.updateOtelConfiguration()
+            self.assertEqual([job['name'] for job in builder.jobs], ['shard0', 'shard1', 'shard2'])
+            shardMetrics = [job['values']['metrics'] for job in builder.jobs]
+            self.assertCountEqual([m for metrics in shardMetrics for m in metrics], builder.metrics)
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            self.assertEqual(sorted(values['service']['pipelines']),
+                             ['metrics/self', 'metrics/shard0', 'metrics/shard1', 'metrics/shard2'])
+            self.assertEqual(values['receivers']['prometheus_exec/shard2']['port'], 9108)
+            self.assertEqual(values['service']['pipelines']['metrics/shard0']['processors'], ['batch'])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_tiered_configuration(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            shutil.copy('./testdata/cloudwatch-test.yml', os.path.join(tmpDir, 'cloudwatch.yml'))
+            shutil.copy('./testdata/default-otel.yml', os.path.join(tmpDir, 'otel.yml'))
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.config.cloudwatch['aws_namespaces'] = ['AWS/Billing', 'AWS/EC2', 'AWS/S3']
+            builder.config.cloudwatch['tiers'] = {'slow': {'scrape_interval': 3600, 'period_seconds': 3600,
+                                                           'range_seconds': 21600}}
+            builder.config.cloudwatch['namespace_tiers'] = {'AWS/EC2': 'slow', 'AWS/Billing': 'slow'}
+            builder.config.validate()
+            builder.updateCloudwatchConfiguration('./cw_namespaces/')
+            builder.updateOtelConfiguration()
+            self.assertEqual([job['name'] for job in builder.jobs], ['normal', 'slow'])
+            with open(os.path.join(tmpDir, 'cloudwatch-slow.yml')) as cw:
+                values = yaml.safe_load(cw)
+            self.assertEqual(values['period_seconds'], 3600)
+            self.assertEqual(values['range_seconds'], 21600)
+            self.assertEqual(values['delay_seconds'], 600)
+            slowMetrics = {(m['aws_namespace'], m['aws_metric_name']) for m in values['metrics']}
+            self.assertIn(('AWS/Billing', 'EstimatedCharges'), slowMetrics)
+            self.assertIn(('AWS/EC2', 'CPUUtilization'), slowMetrics)
+            # The namespace files don't assign tiers, only the config does
+            self.assertNotIn(('AWS/S3', 'BucketSizeBytes'), slowMetrics)
+            self.assertEqual(builder.config.getMetricTier({'aws_namespace': 'AWS/S3', 'tier': 'slow'}), 'slow')
+            self.assertFalse(any('tier' in m for m in values['metrics']))
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            self.assertEqual(values['receivers']['prometheus_exec/slow']['scrape_interval'], '3600s')
+            self.assertEqual(values['receivers']['prometheus_exec/normal']['scrape_interval'], '300s')
+            builder.config.cloudwatch['namespace_tiers'] = {'AWS/EC2': 'fast'}
+            self.assertRaises(ValueError, builder.config.validate)
+            builder.config.cloudwatch['tiers']['slow']['scrape_interval'] = 61
+            self.assertRaises(ValueError, builder.config.validate)
+            builder.config.cloudwatch['tiers']['slow']['scrape_interval'] = 3600
+            builder.config.cloudwatch['tiers'] = 5
+            with self.assertRaises(ValueError) as raised:
+                builder.config.validate()
+            self.assertIn('cloudwatch.tiers: 5 should be a mapping', raised.exception.errors)
+            builder.config.cloudwatch['tiers'] = {}
+            builder.config.cloudwatch['namespace_tiers'] = ['AWS/S3']
+            self.assertRaises(ValueError, builder.config.validate)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_reload(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            configPath = os.path.join(tmpDir, 'config.yml')
+            shutil.copy('./testdata/test-config.yml', configPath)
+            shutil.copy('./testdata/cloudwatch-test.yml', os.path.join(tmpDir, 'cloudwatch.yml'))
+            shutil.copy('./testdata/default-otel.yml', os.path.join(tmpDir, 'otel.yml'))
+            builder = Builder(configPath, otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            self.assertTrue(builder.generate())
+            self.assertEqual(builder.reload(), [])
+            with open(configPath) as config:
+                content = config.read()
+            # A namespace change only reloads the exporter
+            with open(configPath, 'w') as config:
+                config.write(content.replace('["AWS/Lambda","AWS/EC2"]', '["AWS/Lambda","AWS/EC2","AWS/S3"]'))
+            changes = builder.reload()
+            self.assertEqual([job['port'] for job in changes], [9106])
+            with open(os.path.join(tmpDir, 'cloudwatch.yml')) as cw:
+                values = yaml.safe_load(cw)
+            self.assertIn('AWS/S3', {m['aws_namespace'] for m in values['metrics']})
+            self.assertEqual(len([m for m in values['metrics'] if m['aws_metric_name'] == 'CPUUtilization']), 1)
+            # A scrape interval change restarts the collector
+            with open(configPath, 'w') as config:
+                config.write(content.replace('scrape_interval: 300', 'scrape_interval: 600'))
+            self.assertEqual(builder.reload(), 'collector')
+            # An invalid configuration keeps the running one
+            before = builder.readGeneratedFiles()
+            with open(configPath, 'w') as config:
+                config.write(content.replace('"us-east-1"', '"no-such-region"'))
+            self.assertEqual(builder.reload(), [])
+            self.assertEqual(builder.readGeneratedFiles(), before)
+            self.assertEqual(builder.config.cloudwatch['region'], 'us-east-1')
+            # A half saved, or missing, configuration file keeps the running one
+            with open(configPath, 'w') as config:
+                config.write(content[:content.index('[')] + '["AWS/Lambda",')
+            self.assertEqual(builder.reload(), [])
+            self.assertEqual(builder.readGeneratedFiles(), before)
+            os.remove(configPath)
+            self.assertEqual(builder.reload(), [])
+            self.assertEqual(builder.readGeneratedFiles(), before)
+            self.assertEqual(builder.config.cloudwatch['region'], 'us-east-1')
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_refresh_tag_discovery(self):
+        builder = Builder('./testdata/test-config.yml')
+        builder.discovery = unittest.mock.Mock(**{'isStale.side_effect': [False, True]})
+        supervisor = unittest.mock.Mock(**{'stopped.wait.side_effect': [False, False, True]})
+        # Without watching the configuration, stale resources are refreshed from the supervisor loop
+        with unittest.mock.patch.object(builder, 'reload', return_value=[]) as reload:
+            builder.watch(supervisor, 0, watchConfig=False)
+        reload.assert_called_once_with(None, False)
+        self.assertEqual(supervisor.check.call_count, 2)
+        supervisor.shutdown.assert_called_once()
+
+    def test_idempotent_generation(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            paths = {'otelConfigPath': os.path.join(tmpDir, 'otel.yml'),
+                     'cloudwatchConfigPath': os.path.join(tmpDir, 'cloudwatch.yml')}
+            builder = Builder('./testdata/test-config.yml', **paths)
+            self.assertTrue(builder.generate())
+            with open(paths['cloudwatchConfigPath']) as cw:
+                generated = cw.read()
+            self.assertTrue(os.path.exists(os.path.join(tmpDir, '.builder-stamp.json')))
+            # A restart with the same inputs skips generation and keeps the jobs
+            builder = Builder('./testdata/test-config.yml', **paths)
+            self.assertTrue(builder.generate())
+            self.assertIsNone(builder.metrics)
+            self.assertEqual(builder.jobs[0]['port'], 9106)
+            # Without the stamp, the output is regenerated from the templates rather than extended
+            os.remove(os.path.join(tmpDir, '.builder-stamp.json'))
+            builder = Builder('./testdata/test-config.yml', **paths)
+            self.assertTrue(builder.generate())
+            self.assertIsNotNone(builder.metrics)
+            with open(paths['cloudwatchConfigPath']) as cw:
+                self.assertEqual(cw.read(), generated)
+            # A modified output is regenerated
+            with open(paths['cloudwatchConfigPath'], 'w') as cw:
+                cw.write('metrics: []')
+            builder = Builder('./testdata/test-config.yml', **paths)
+            self.assertTrue(builder.generate())
+            with open(paths['cloudwatchConfigPath']) as cw:
+                self.assertEqual(cw.read(), generated)
+            self.assertFalse(builder.writeConfiguration(paths['cloudwatchConfigPath'], yaml.safe_load(generated)))
+            # An invalid environment override fails even if the inputs are otherwise unchanged
+            with unittest.mock.patch.dict(os.environ, {'SCRAPE_INTERVAL': 'abc'}):
+                builder = Builder('./testdata/test-config.yml', **paths)
+                self.assertRaises(ConfigError, builder.generate)
+            # Auto shards without a cgroup cpu limit follow the cpu count, which is part of the inputs
+            builder.config.cloudwatch['shards'] = 'auto'
+            builder.cgroupPath = tmpDir
+            with unittest.mock.patch('os.cpu_count', return_value=2):
+                inputsHash = builder.hashInputs()
+            with unittest.mock.patch('os.cpu_count', return_value=4):
+                self.assertNotEqual(builder.hashInputs(), inputsHash)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_validate_reports_all_errors(self):
+        os.environ['SCRAPE_INTERVAL'] = 'five minutes'
+        os.environ['NAMESPACE_TIERS'] = 'AWS/EC2'
+        try:
+            test_config = Config('./testdata/test-config.yml')
+        finally:
+            del os.environ['SCRAPE_INTERVAL']
+            del os.environ['NAMESPACE_TIERS']
+        test_config.otel['token'] = 'invalid'
+        test_config.cloudwatch['regions'] = ['us-east-1', 'no-such-region'] * 100
+        test_config.cloudwatch['engine'] = 'boto'
+        test_config.cloudwatch['aws_namespaces'] = 'AWS/NoSuch'
+        with self.assertRaises(ConfigError) as context:
+            test_config.validate()
+        errors = context.exception.errors
+        self.assertEqual(len(errors), 6)
+        self.assertTrue(any(error.startswith('SCRAPE_INTERVAL: invalid value') for error in errors))
+        self.assertTrue(any(error.startswith('NAMESPACE_TIERS: invalid value') for error in errors))
+        self.assertIn('cloudwatch.regions: no-such-region is not supported', errors)
+        self.assertIn('cloudwatch.engine: boto engine is not supported', errors)
+        self.assertIn('cloudwatch.aws_namespaces: No valid aws namespaces', errors)
+        self.assertIn('otel.token: Invalid token: invalid', errors)
+
+    def test_cardinality_limits(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            shutil.copy('./testdata/default-otel.yml', os.path.join(tmpDir, 'otel.yml'))
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.config.cloudwatch['aws_namespaces'] = ['AWS/EC2', 'AWS/Lambda']
+            builder.config.cloudwatch['regions'] = ['us-east-1', 'us-east-2']
+            builder.config.otel['metric_exclude'] = ['^aws_lambda_']
+            builder.config.otel['label_exclude'] = ['instance']
+            builder.config.cloudwatch['drop_statistics'] = ['Maximum']
+            builder.config.validate()
+            unfiltered = Planner(Config('./testdata/test-config.yml')).plan(
+                [m for ns in ['AWS/EC2', 'AWS/Lambda'] for m in get_catalog().getMetrics(ns)])
+            builder.updateCloudwatchConfiguration()
+            builder.updateOtelConfiguration()
+            self.assertFalse(any('Maximum' in m.get('aws_statistics', []) for m in builder.metrics))
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            self.assertEqual(values['processors']['filter/cardinality'],
+                             {'metrics': {'exclude': {'match_type': 'regexp', 'metric_names': ['^aws_lambda_']}}})
+            self.assertEqual(values['processors']['transform/cardinality'],
+                             {'metrics': {'queries': ['delete_key(attributes, "instance")']}})
+            self.assertEqual(values['service']['pipelines']['metrics/us-east-1']['processors'],
+                             ['filter/cardinality', 'transform/cardinality', 'metricstransform/us-east-1', 'batch'])
+            plan = builder.planCloudwatchConfiguration()
+            self.assertEqual(plan['namespaces']['AWS/Lambda']['series'], 0)
+            self.assertLess(plan['series'], unfiltered['series'] * 2)
+            builder.config.otel['metric_include'] = ['(']
+            builder.config.cloudwatch['drop_statistics'] = ['Median']
+            with self.assertRaises(ConfigError) as context:
+                builder.config.validate()
+            self.assertEqual(len(context.exception.errors), 2)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_optimize_windows(self):
+        settings = {'scrape_interval': 300, 'period_seconds': 300, 'range_seconds': 600, 'delay_seconds': 600}
+        self.assertEqual(optimize_window(60, 0, settings),
+                         {'period_seconds': 300, 'range_seconds': 300, 'delay_seconds': 600})
+        self.assertEqual(optimize_window(60, 0, dict(settings, period_seconds=900))['period_seconds'], 300)
+        self.assertEqual(optimize_window(60, 900, dict(settings, period_seconds=120)),
+                         {'period_seconds': 120, 'range_seconds': 120, 'delay_seconds': 900})
+        daily = optimize_window(86400, 0, settings)
+        self.assertEqual(daily['period_seconds'], 86400)
+        self.assertIn('288 scrapes in a row', check_window(86400, 0, daily, 300))
+        self.assertIn('shorter than their 300s resolution', check_window(300, 0, dict(settings, period_seconds=60), 300))
+        self.assertIsNone(check_window(60, 0, optimize_window(60, 0, settings), 300))
+        tmpDir = tempfile.mkdtemp()
+        try:
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.updateCloudwatchConfiguration()
+            lambdaMetric = [m for m in builder.metrics if m['aws_metric_name'] == 'Invocations'][0]
+            self.assertNotIn('resolution_seconds', lambdaMetric)
+            # Only the range differs from the global settings
+            self.assertEqual({key: lambdaMetric.get(key) for key in ['period_seconds', 'range_seconds']},
+                             {'period_seconds': None, 'range_seconds': 300})
+            # A single datapoint per statistic instead of range_seconds / period_seconds
+            unoptimized = Planner(builder.config).plan(builder.buildMetrics([]))
+            self.assertEqual(builder.planCloudwatchConfiguration()['datapoints'] * 2, unoptimized['datapoints'])
+            # Without the optimizer, the settings that can't provide a fresh datapoint are reported
+            builder.config.cloudwatch['optimize_windows'] = 'false'
+            builder.config.cloudwatch['period_seconds'] = 60
+            with self.assertLogs(builder.logger, logging.WARNING) as logs:
+                builder.updateCloudwatchConfiguration()
+            self.assertTrue(any('AWS/EC2 metrics' in line and '300s resolution' in line for line in logs.output))
+            self.assertFalse(any('range_seconds' in m for m in builder.metrics))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_custom_configuration(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            customPath = os.path.join(tmpDir, 'cloudwatch.yml')
+            invocations = {key: value for key, value in get_catalog().getMetric('AWS/Lambda', 'Invocations')[0].items()
+                           if key not in RESOLUTION_KEYS}
+            custom = {'region': 'us-west-2', 'period_seconds': 300, 'metrics': [
+                {'aws_namespace': 'Custom/App', 'aws_metric_name': 'Requests', 'aws_dimensions': ['Service'],
+                 'aws_statistics': ['Sum', 'SampleCount']},
+                {'aws_namespace': 'AWS/EC2', 'aws_statistics': ['Average']},
+                {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_statistics': ['Median']},
+                {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_statistics': ['SampleCount']},
+                dict(invocations, aws_statistics=['Maximum']),
+                {'aws_namespace': 'Custom/App', 'aws_metric_name': 'Latency', 'aws_extended_statistics': ['tm99']},
+                {'aws_namespace': 'Custom/App', 'aws_metric_name': 'Errors'}]}
+            with open(customPath, 'w') as customFile:
+                yaml_io.dump(custom, customFile)
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=customPath)
+            builder.config.cloudwatch['custom_config'] = 'true'
+            builder.config.cloudwatch['aws_namespaces'] = ['AWS/Lambda']
+            builder.config.cloudwatch['drop_statistics'] = ['SampleCount']
+            lambdaMetrics = len(builder.dropStatistics(builder.buildMetrics([])))
+            with self.assertLogs(builder.logger, logging.INFO) as logs:
+                builder.updateCustomCloudwatchConfiguration()
+            self.assertEqual(len([line for line in logs.output if 'Skipping entry' in line]), 2)
+            self.assertTrue(any('7 entries, 2 invalid, 1 left without statistics, 1 merged' in line
+                                for line in logs.output))
+            # The custom configuration is left as is, the single job gets its own file
+            self.assertEqual(yaml_io.load_file(customPath), custom)
+            self.assertEqual([job['path'] for job in builder.jobs], [os.path.join(tmpDir, 'cloudwatch-generated.yml')])
+            generated = yaml_io.load_file(builder.jobs[0]['path'])
+            # Without regions and role_arns, the custom configuration keeps its own region
+            self.assertEqual((generated['region'], generated['period_seconds']), ('us-west-2', 300))
+            self.assertFalse(any('of the custom configuration is replaced' in line for line in logs.output))
+            self.assertEqual(len(generated['metrics']), 3 + lambdaMetrics)
+            self.assertEqual(generated['metrics'][0]['aws_statistics'], ['Sum'])
+            # Entries without statistics get the default statistics, less the dropped ones
+            errors = [m for m in generated['metrics'] if m['aws_metric_name'] == 'Errors'][0]
+            self.assertEqual(errors['aws_statistics'], ['Sum', 'Minimum', 'Maximum', 'Average'])
+            self.assertEqual(Planner(builder.config).planMetric({'aws_namespace': 'Custom/App',
+                                                                 'aws_metric_name': 'Errors'})['series'],
+                             5 * builder.config.cloudwatch['plan_resources_per_metric'])
+            iv.is_valid_statistics(['p99.9', 'tm(10%:90%)', 'wm90', 'tc99', 'ts99', 'PR(:300)'])
+            self.assertRaises(ValueError, iv.is_valid_statistics, ['median'])
+            merged = [m for m in generated['metrics'] if m['aws_metric_name'] == 'Invocations']
+            self.assertEqual(merged[0]['aws_statistics'], ['Sum', 'Maximum'])
+            self.assertEqual(builder.planCloudwatchConfiguration()['metrics'], 3 + lambdaMetrics)
+            self.assertEqual(builder.planCloudwatchConfiguration(), builder.streamCustomConfiguration(False))
+            # Every target gets every metric, spread across the shards
+            builder.config.cloudwatch['regions'] = ['us-east-1', 'eu-west-1']
+            builder.config.cloudwatch['shards'] = 2
+            with self.assertLogs(builder.logger, logging.INFO) as logs:
+                builder.updateCustomCloudwatchConfiguration()
+            self.assertTrue(any('region us-west-2 of the custom configuration is replaced' in line
+                                for line in logs.output))
+            self.assertEqual([job['name'] for job in builder.jobs],
+                             ['us-east-1-shard0', 'us-east-1-shard1', 'eu-west-1-shard0', 'eu-west-1-shard1'])
+            for region in ['us-east-1', 'eu-west-1']:
+                shards = [yaml_io.load_file(job['path']) for job in builder.jobs if job['name'].startswith(region)]
+                self.assertEqual({shard['region'] for shard in shards}, {region})
+                self.assertTrue(all(shard['metrics'] for shard in shards))
+                self.assertEqual(sum(len(shard['metrics']) for shard in shards), 3 + lambdaMetrics)
+            self.assertTrue(all(job['series'] > 0 for job in builder.jobs))
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_jvm_sizing(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            cgroupV2 = os.path.join(tmpDir, 'v2')
+            os.makedirs(cgroupV2)
+            with open(os.path.join(cgroupV2, 'memory.max'), 'w') as memory:
+                memory.write(f'{1024 * 1024 * 1024}\n')
+            with open(os.path.join(cgroupV2, 'cpu.max'), 'w') as cpu:
+                cpu.write('200000 100000\n')
+            limits = jvm_sizing.read_cgroup_limits(cgroupV2)
+            self.assertEqual(limits, {'memory_mb': 1024, 'cpus': 2.0})
+            cgroupV1 = os.path.join(tmpDir, 'v1')
+            for controller, name, value in [('memory', 'memory.limit_in_bytes', '9223372036854771712'),
+                                            ('cpu', 'cpu.cfs_quota_us', '-1'), ('cpu', 'cpu.cfs_period_us', '100000')]:
+                os.makedirs(os.path.join(cgroupV1, controller), exist_ok=True)
+                with open(os.path.join(cgroupV1, controller, name), 'w') as cgroupFile:
+                    cgroupFile.write(value)
+            self.assertEqual(jvm_sizing.read_cgroup_limits(cgroupV1), {'memory_mb': None, 'cpus': None})
+            sizing = jvm_sizing.size_jvm(10000, 1, limits)
+            self.assertEqual((sizing['heap_mb'], sizing['gc']), (104, 'serial'))
+            self.assertIn('-XX:ActiveProcessorCount=2', sizing['options'])
+            # The heap is capped by the exporter's share of the memory limit
+            self.assertEqual(jvm_sizing.size_jvm(1000000, 2, limits)['heap_mb'], 230)
+            self.assertEqual(jvm_sizing.size_jvm(1000000, 1, {'memory_mb': None, 'cpus': None})['gc'], 'parallel')
+            sizing = jvm_sizing.size_jvm(10000, 2, limits, 1024, 'g1', ['-XX:+ExitOnOutOfMemoryError'])
+            self.assertEqual(sizing['options'], ['-Xmx1024m', '-Xms64m', '-XX:+UseG1GC', '-XX:ActiveProcessorCount=1',
+                                                 '-XX:ParallelGCThreads=1', '-Xshare:auto',
+                                                 '-XX:+ExitOnOutOfMemoryError'])
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'),
+                              cloudwatchConfigPath=os.path.join(tmpDir, 'cloudwatch.yml'))
+            builder.cgroupPath = cgroupV2
+            builder.config.cloudwatch['jvm_options'] = '-XX:+ExitOnOutOfMemoryError'
+            self.assertTrue(builder.generate())
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            command = values['receivers']['prometheus_exec']['exec']
+            self.assertTrue(command.startswith('java -Xmx'))
+            self.assertTrue(command.endswith('-XX:+ExitOnOutOfMemoryError -jar '
+                                             'cloudwatch_exporter-0.14.3-jar-with-dependencies.jar {{port}} '
+                                             + os.path.normpath(os.path.join(tmpDir, 'cloudwatch.yml'))))
+            builder.config.cloudwatch['jvm_gc'] = 'zgc'
+            builder.config.cloudwatch['jvm_options'] = 'Xmx1g'
+            with self.assertRaises(ConfigError) as context:
+                builder.config.validate()
+            self.assertEqual(len(context.exception.errors), 2)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_remote_write_settings(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            builder = Builder('./testdata/test-config.yml', otelConfigPath=os.path.join(tmpDir, 'otel.yml'))
+            builder.config.otel['wal_directory'] = '/var/lib/otel/wal'
+            builder.config.otel['queue_consumers'] = 10
+            builder.updateOtelConfiguration()
+            with open(os.path.join(tmpDir, 'otel.yml')) as otel:
+                values = yaml.safe_load(otel)
+            exporter = values['exporters']['prometheusremotewrite']
+            self.assertEqual(exporter['remote_write_queue'], {'enabled': True, 'queue_size': 10000,
+                                                              'num_consumers': 10})
+            self.assertEqual(exporter['retry_on_failure']['max_elapsed_time'], '300s')
+            self.assertEqual(exporter['wal']['directory'], '/var/lib/otel/wal')
+            self.assertEqual(values['processors']['batch'], {'send_batch_size': 8192, 'timeout': '1s'})
+            self.assertEqual(values['service']['pipelines']['metrics']['processors'], ['batch'])
+            builder.config.otel['batch_max_size'] = 100
+            builder.config.otel['retry_initial_interval'] = 60
+            builder.config.otel['wal_directory'] = 'wal'
+            with self.assertRaises(ConfigError) as context:
+                builder.config.validate()
+            self.assertEqual(len(context.exception.errors), 3)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_remote_write_sink(self):
+        sink = remote_write_sink.RemoteWriteSink()
+        server = remote_write_sink.serve(sink, 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/api/v1/write'
+        headers = {'Content-Encoding': 'snappy', 'Content-Type': 'application/x-protobuf'}
+        try:
+            for _ in range(3):
+                urllib.request.urlopen(urllib.request.Request(url, data=b'x' * 100, headers=headers)).close()
+            sink.errorRate = 1.0
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(urllib.request.Request(url, data=b'x', headers=headers))
+            self.assertEqual(context.exception.code, 503)
+            stats = sink.stats()
+            self.assertEqual((stats['requests'], stats['bytes'], stats['failures']), (3, 300, 1))
+            self.assertIn('remote_write_sink_bytes_total 300.0', sink.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_shard_metrics(self):
+        test_config = Config('./testdata/test-config.yml')
+        planner = Planner(test_config)
+        metrics = [m for ns in ns_list for m in get_catalog().getMetrics(ns)]
+        shards = planner.shardMetrics(metrics, 4)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(sum(len(shard) for shard in shards), len(metrics))
+        requests = [planner.plan(shard)['requests'] for shard in shards]
+        self.assertLessEqual(max(requests) - min(requests), 3)
+        self.assertEqual(len(planner.shardMetrics(metrics[:2], 4)), 2)
+        test_config.cloudwatch['shards'] = 'auto'
+        self.assertEqual(test_config.getShardCount('/no-such-cgroup'), os.cpu_count())
+        tmpDir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpDir, 'cpu.max'), 'w') as cpu:
+                cpu.write('150000 100000\n')
+            self.assertEqual(test_config.getShardCount(tmpDir), 2)
+        finally:
+            shutil.rmtree(tmpDir)
+        self.assertRaises(ValueError, iv.is_valid_shards, 0)
+        self.assertRaises(TypeError, iv.is_valid_shards, '2')
+
+    def test_get_targets(self):
+        test_config = Config('./testdata/test-config.yml')
+        self.assertEqual(test_config.getTargets(),
+                         [{'name': 'us-east-1', 'region': 'us-east-1', 'role_arn': '', 'account': 'default'}])
+        roleArn = f'arn:aws:iam::{fake_cloudwatch.ACCOUNT_ID}:role/cw'
+        self.assertEqual(test_config.getTargets({'region': 'us-west-2', 'role_arn': roleArn}),
+                         [{'name': 'us-west-2', 'region': 'us-west-2', 'role_arn': roleArn,
+                           'account': fake_cloudwatch.ACCOUNT_ID}])
+        # Repeated regions and roles are collected once, roles of the same account are told apart by their name
+        test_config.cloudwatch['regions'] = ['us-east-1', 'us-east-1']
+        test_config.cloudwatch['role_arns'] = 'arn:aws:iam::111111111111:role/a, arn:aws:iam::111111111111:role/b, ' \
+                                              'arn:aws:iam::222222222222:role/a, arn:aws:iam::111111111111:role/a'
+        self.assertEqual([target['name'] for target in test_config.getTargets({'region': 'us-west-2'})],
+                         ['us-east-1-111111111111-a', 'us-east-1-111111111111-b', 'us-east-1-222222222222'])
+        test_config.cloudwatch['role_arns'] = []
+        test_config.cloudwatch['regions'] = ['us-east-1', 'no-such-region']
+        self.assertRaises(ValueError, test_config.validate)
+        test_config.cloudwatch['regions'] = ['us-east-1', 'us-east-2']
+        test_config.cloudwatch['role_arns'] = 'arn:aws:iam::111111111111:role/cw, test'
+        self.assertRaises(ValueError, test_config.validate)
+        # Settings that are neither lists nor strings are reported, not split
+        test_config.cloudwatch['role_arns'] = []
+        test_config.cloudwatch['regions'] = 5
+        with self.assertRaises(ConfigError) as context:
+            test_config.validate()
+        self.assertEqual(context.exception.errors, ['cloudwatch.regions: 5 should be a list or a comma separated string'])
+
     def test_update_otel_collector(self):
         try:
             builder = Builder('./testdata/test-config.yml', otelConfigPath='./testdata/otel-test.yml')
+            builder.updateOtelConfiguration()
             with open(builder.otelConfigPath, 'r+') as otel:
-                builder.updateOtelConfiguration()
                 values = yaml.safe_load(otel)
                 self.assertEqual(values['receivers']['prometheus_exec']['scrape_interval'], '300s')
                 self.assertEqual(values['receivers']['prometheus_exec']['scrape_timeout'], '300s')
@@ -142,6 +680,613 @@ class TestBuilder(unittest.TestCase):
             self.fail(f'Unexpected error {e}')
 
 
+class TestNamespaceCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.nsPath = os.path.join(self.tmpDir, 'cw_namespaces/')
+        shutil.copytree('./cw_namespaces/', self.nsPath, ignore=shutil.ignore_patterns('catalog.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_compile_catalog(self):
+        catalog = NamespaceCatalog(self.nsPath)
+        self.assertTrue(os.path.exists(catalog.artifactPath))
+        self.assertEqual(len(catalog.namespaces()), 36)
+        self.assertIn('CloudWatchSynthetics', catalog.namespaces())
+        self.assertEqual(catalog.fileName('AWS/EC2'), 'EC2')
+        with open(os.path.join(self.nsPath, 'EC2.yml')) as f:
+            self.assertEqual(catalog.getMetrics('AWS/EC2'), yaml.safe_load(f))
+        cpu = catalog.getMetric('AWS/EC2', 'CPUUtilization')
+        self.assertEqual(len(cpu), 1)
+        self.assertEqual(cpu[0]['aws_tag_select']['resource_type_selection'], 'ec2:instance')
+
+    def test_catalog_invalidation(self):
+        catalog = NamespaceCatalog(self.nsPath)
+        self.assertIsNotNone(NamespaceCatalog(self.nsPath).loadArtifact())
+        with open(os.path.join(self.nsPath, 'Custom.yml'), 'w') as f:
+            yaml.dump([{'aws_namespace': 'Custom/App', 'aws_metric_name': 'Requests', 'aws_dimensions': [],
+                        'aws_statistics': ['Sum']}], f)
+        recompiled = NamespaceCatalog(self.nsPath)
+        self.assertNotEqual(recompiled.hash, catalog.hash)
+        self.assertIn('Custom/App', recompiled.namespaces())
+        self.assertIn('Custom/App', NamespaceCatalog(self.nsPath).loadArtifact()['namespaces'])
+
+
+class TestYamlIo(unittest.TestCase):
+    def test_dump_hashed(self):
+        values = {'metrics': [{'aws_namespace': 'AWS/EC2', 'aws_statistics': ['Average']}], 'region': 'us-east-1'}
+        stream = io.StringIO()
+        contentHash = yaml_io.dump_hashed(values, stream)
+        self.assertEqual(contentHash, hashlib.sha256(stream.getvalue().encode()).hexdigest())
+        self.assertEqual(yaml_io.load(stream.getvalue()), values)
+        self.assertEqual(stream.getvalue(), yaml_io.dumps(values))
+
+    def test_stream_entries(self):
+        values = {}
+        stream = io.StringIO('region: us-east-1\nmetrics:\n- &entry {aws_metric_name: A}\n- *entry\n'
+                             '- {aws_metric_name: B}\nperiod_seconds: 60\n')
+        self.assertEqual([entry['aws_metric_name'] for entry in yaml_io.iter_entries(stream, 'metrics', values)],
+                         ['A', 'A', 'B'])
+        self.assertEqual(values, {'region': 'us-east-1', 'period_seconds': 60})
+        self.assertEqual(list(yaml_io.iter_entries(io.StringIO(''), 'metrics', {})), [])
+        with self.assertRaises(ValueError):
+            list(yaml_io.iter_entries(io.StringIO('- metrics'), 'metrics', {}))
+        stream = io.StringIO()
+        writer = yaml_io.SequenceWriter(stream, 'metrics', batchSize=2)
+        for position in range(5):
+            writer.append({'aws_metric_name': f'M{position}'})
+        contentHash = writer.close({'region': 'us-east-1', 'metrics': None})
+        self.assertEqual(contentHash, hashlib.sha256(stream.getvalue().encode()).hexdigest())
+        self.assertEqual(yaml_io.load(stream.getvalue()),
+                         {'region': 'us-east-1', 'metrics': [{'aws_metric_name': f'M{p}'} for p in range(5)]})
+        stream = io.StringIO()
+        yaml_io.SequenceWriter(stream, 'metrics').close({})
+        self.assertEqual(yaml_io.load(stream.getvalue()), {'metrics': []})
+
+    def test_debug_dump_is_lazy(self):
+        logger = logging.getLogger('test_yaml_io')
+        logger.setLevel(logging.INFO)
+        with unittest.mock.patch('yaml_io.dumps') as dumps:
+            yaml_io.debug_dump(logger, 'Configuration', {'metrics': []})
+            dumps.assert_not_called()
+            logger.setLevel(logging.DEBUG)
+            yaml_io.debug_dump(logger, 'Configuration', {'metrics': []})
+            dumps.assert_called_once()
+
+
+class TestMetricMerger(unittest.TestCase):
+    def test_merge_metrics(self):
+        metrics = [
+            {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+             'aws_statistics': ['Average']},
+            {'aws_namespace': 'AWS/EC2 ', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+             'aws_statistics': ['Maximum', 'Average']},
+            {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+             'aws_statistics': ['Sum'], 'aws_tag_select': {'resource_type_selection': 'ec2:instance',
+                                                           'resource_id_dimension': 'InstanceId'}},
+            {'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': [],
+             'aws_statistics': ['Average']},
+        ]
+        merged, saved = merge_metrics(metrics)
+        self.assertEqual(len(merged), 3)
+        self.assertEqual(merged[0]['aws_statistics'], ['Average', 'Maximum'])
+        self.assertEqual(saved, 2)
+        # Already merged metrics are stable
+        self.assertEqual(merge_metrics(merged), (merged, 0))
+        # Entries without statistics stand for the default statistics, on either side of the merge
+        defaults = {'aws_namespace': 'AWS/ELB', 'aws_metric_name': 'SurgeQueueLength'}
+        for entries in ([defaults, dict(defaults, aws_statistics=['Sum'])],
+                        [dict(defaults, aws_statistics=['Sum']), defaults]):
+            merged, _ = merge_metrics(entries)
+            self.assertEqual(sorted(merged[0]['aws_statistics']),
+                             ['Average', 'Maximum', 'Minimum', 'SampleCount', 'Sum'])
+
+    def test_merge_all_namespaces(self):
+        metrics = [m for ns in ns_list for m in get_catalog().getMetrics(ns)]
+        merged, saved = merge_metrics(metrics + metrics)
+        self.assertLess(len(merged), len(metrics))
+        self.assertGreater(saved, 0)
+
+
+class TestPlanner(unittest.TestCase):
+    def test_plan(self):
+        test_config = Config('./testdata/test-config.yml')
+        test_config.cloudwatch['plan_resources_per_metric'] = 10
+        metrics = get_catalog().getMetrics('AWS/EC2')
+        plan = Planner(test_config).plan(metrics)
+        self.assertEqual(plan['metrics'], len(metrics))
+        self.assertEqual(plan['get_metric_statistics'], 10 * len(metrics))
+        self.assertEqual(plan['list_metrics'], len(metrics))
+        self.assertEqual(plan['get_resources'], 1)
+        self.assertEqual(plan['requests'], 11 * len(metrics) + 1)
+        self.assertEqual(plan['series'], 10 * len(metrics))
+        # 600s range of 300s periods
+        self.assertEqual(plan['datapoints'], 2 * plan['series'])
+        # 8640 scrapes per month at 300s
+        self.assertEqual(plan['monthly_cost'], round(plan['billable_requests'] * 8640 / 1000 * 0.01, 2))
+        self.assertEqual(plan['namespaces']['AWS/EC2']['requests'], plan['requests'])
+        # Slower tiers are scraped less often
+        test_config.cloudwatch['tiers'] = {'slow': {'scrape_interval': 3000}}
+        test_config.cloudwatch['namespace_tiers'] = {'AWS/EC2': 'slow'}
+        self.assertEqual(Planner(test_config).plan(metrics)['requests_per_month'], plan['requests_per_month'] // 10)
+        # The native engine batches the queries of a namespace and window into GetMetricData requests of 500,
+        # and is billed per query
+        test_config.cloudwatch['engine'] = 'native'
+        test_config.cloudwatch['plan_resources_per_metric'] = 100
+        plan = Planner(test_config).plan(metrics)
+        self.assertEqual(plan['get_metric_statistics'], 0)
+        self.assertEqual(plan['get_metric_data_queries'], 100 * len(metrics))
+        self.assertEqual(plan['get_metric_data'], -(-100 * len(metrics) // 500))
+        self.assertEqual(plan['requests'], plan['list_metrics'] + plan['get_metric_data'] + plan['get_resources'])
+        self.assertEqual(plan['billable_requests'], plan['list_metrics'] + plan['get_metric_data_queries'])
+        self.assertEqual(Planner(test_config).planMetric(metrics[0])['get_metric_data'], 1)
+
+    def test_budget(self):
+        builder = Builder('./testdata/test-config.yml')
+        plan = builder.planCloudwatchConfiguration()
+        self.assertTrue(builder.checkBudget(plan))
+        builder.config.cloudwatch['max_requests_per_scrape'] = plan['requests'] - 1
+        self.assertTrue(builder.checkBudget(plan))
+        builder.config.cloudwatch['budget_action'] = 'fail'
+        self.assertFalse(builder.checkBudget(plan))
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_run(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            results = Benchmarks(tmpDir, repeat=1).run(['config_init', 'validate_namespaces_large'])
+        finally:
+            shutil.rmtree(tmpDir)
+        self.assertEqual(sorted(results), ['config_init', 'validate_namespaces_large'])
+        self.assertGreater(results['config_init']['best'], 0)
+
+    def test_compare_results(self):
+        baseline = {'config_init': {'best': 0.010}, 'config_validate': {'best': 0.010}}
+        results = {'config_init': {'best': 0.012}, 'config_validate': {'best': 0.020}, 'new_case': {'best': 1.0}}
+        self.assertEqual(compare_results(baseline, results, 0.5), {'config_validate': 2.0})
+        self.assertEqual(compare_results(baseline, results, 1.5), {})
+
+
+class StubCloudWatchHandler(http.server.BaseHTTPRequestHandler):
+    instances = 600
+    calls = []
+
+    def do_POST(self):
+        # Tagging API requests share the endpoint
+        if 'x-amz-target' in self.headers:
+            StubTaggingHandler.do_POST(self)
+            return
+        params = dict(urllib.parse.parse_qsl(self.rfile.read(int(self.headers['Content-Length'])).decode()))
+        self.calls.append(params)
+        if params['Action'] == 'ListMetrics':
+            start = int(params.get('NextToken', 0))
+            members = ''.join(f'<member><Namespace>{params["Namespace"]}</Namespace>'
+                              f'<MetricName>{params["MetricName"]}</MetricName><Dimensions><member>'
+                              f'<Name>InstanceId</Name><Value>i-{i}</Value></member></Dimensions></member>'
+                              for i in range(start, min(start + 500, self.instances)))
+            token = f'<NextToken>{start + 500}</NextToken>' if start + 500 < self.instances else ''
+            body = f'<ListMetricsResponse><ListMetricsResult><Metrics>{members}</Metrics>{token}' \
+                   f'</ListMetricsResult></ListMetricsResponse>'
+        else:
+            ids = [v for k, v in params.items() if k.endswith('.Id')]
+            members = ''.join(f'<member><Id>{i}</Id><Timestamps><member>2022-01-01T00:00:00Z</member>'
+                              f'<member>2022-01-01T00:05:00Z</member></Timestamps><Values><member>1.0</member>'
+                              f'<member>{i[1:]}.5</member></Values><StatusCode>Complete</StatusCode></member>'
+                              for i in ids)
+            body = f'<GetMetricDataResponse xmlns="http://monitoring.amazonaws.com/doc/2010-08-01/">' \
+                   f'<GetMetricDataResult><MetricDataResults>{members}</MetricDataResults></GetMetricDataResult>' \
+                   f'</GetMetricDataResponse>'
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestCollector(unittest.TestCase):
+    def setUp(self):
+        StubCloudWatchHandler.calls = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubCloudWatchHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_collect(self):
+        values = {'region': 'us-east-1', 'period_seconds': 300, 'range_seconds': 600, 'delay_seconds': 600,
+                  'metrics': get_catalog().getMetric('AWS/EC2', 'CPUUtilization')}
+        values['metrics'][0]['aws_statistics'] = ['Average', 'Maximum']
+        # Every listed instance, see test_tag_select for the tag selection
+        del values['metrics'][0]['aws_tag_select']
+        client = AwsClient('us-east-1', 'key', 'secret', endpoint=self.endpoint)
+        collector = Collector(values, client, concurrency=2)
+        text = collector.scrape()
+        actions = [call['Action'] for call in StubCloudWatchHandler.calls]
+        # 2 ListMetrics pages, 1200 queries packed in 3 GetMetricData requests
+        self.assertEqual(actions.count('ListMetrics'), 2)
+        self.assertEqual(actions.count('GetMetricData'), 3)
+        self.assertIn('# TYPE aws_ec2_cpuutilization_maximum gauge', text)
+        self.assertIn('aws_ec2_cpuutilization_average{job="aws_ec2",instance="",instance_id="i-0"} 1.5 '
+                      '1640995500000', text)
+        self.assertEqual(text.count('aws_ec2_cpuutilization_average{'), 600)
+        self.assertIn('cloudwatch_requests_total{action="getMetricData",namespace="AWS/EC2"} 3.0', text)
+        self.assertIn('cloudwatch_exporter_scrape_error 0.0', text)
+
+    def test_dimension_select(self):
+        values = {'region': 'us-east-1', 'metrics': [{
+            'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+            'aws_statistics': ['Average'], 'aws_dimension_select_regex': {'InstanceId': ['i-1.']},
+            'set_timestamp': False}]}
+        client = AwsClient('us-east-1', 'key', 'secret', endpoint=self.endpoint)
+        text = Collector(values, client).scrape()
+        self.assertEqual(text.count('aws_ec2_cpuutilization_average{'), 10)
+        self.assertIn('aws_ec2_cpuutilization_average{job="aws_ec2",instance="",instance_id="i-19"} 10.5\n', text)
+
+    def test_series_cap(self):
+        values = {'region': 'us-east-1', 'max_series_per_metric': 100, 'metrics': [{
+            'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+            'aws_statistics': ['Average', 'Maximum'], 'set_timestamp': False}]}
+        client = AwsClient('us-east-1', 'key', 'secret', endpoint=self.endpoint)
+        text = Collector(values, client).scrape()
+        self.assertEqual(text.count('aws_ec2_cpuutilization_average{'), 50)
+        self.assertIn('cloudwatch_exporter_series_capped 1100.0', text)
+
+    def test_tag_select(self):
+        StubTaggingHandler.calls = []
+        tagSelect = {'resource_type_selection': 'ec2:instance', 'resource_id_dimension': 'InstanceId',
+                     'tag_selections': {'Environment': ['production']}}
+        values = {'region': 'us-east-1', 'metrics': [{
+            'aws_namespace': 'AWS/EC2', 'aws_metric_name': name, 'aws_dimensions': ['InstanceId'],
+            'aws_statistics': ['Average'], 'aws_tag_select': tagSelect, 'set_timestamp': False}
+            for name in ['CPUUtilization', 'NetworkIn']]}
+        client = AwsClient('us-east-1', 'key', 'secret', endpoint=self.endpoint)
+        text = Collector(values, client).scrape()
+        # Only the 250 tagged instances of the 600 listed, the selection shared by both metrics is resolved once
+        self.assertEqual(text.count('aws_ec2_cpuutilization_average{'), 250)
+        self.assertEqual(text.count('aws_ec2_network_in_average{'), 250)
+        self.assertNotIn('instance_id="i-250"', text)
+        self.assertIn('cloudwatch_requests_total{action="getResources",namespace=""} 3.0', text)
+        self.assertEqual(StubTaggingHandler.calls[0][1]['TagFilters'],
+                         [{'Key': 'Environment', 'Values': ['production']}])
+
+    def test_native_engine_command(self):
+        builder = Builder('./testdata/test-config.yml')
+        builder.config.cloudwatch['engine'] = 'native'
+        job = {'path': './config_files/cloudwatch-shard0.yml'}
+        self.assertEqual(builder.getExecCommand(job),
+                         'python3 collector.py {{port}} config_files/cloudwatch-shard0.yml --concurrency 8')
+        self.assertRaises(ValueError, iv.is_valid_engine, 'boto')
+
+
+class StubTaggingHandler(http.server.BaseHTTPRequestHandler):
+    instances = 250
+    calls = []
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        StubTaggingHandler.calls.append((self.headers['x-amz-target'], payload))
+        start = int(payload.get('PaginationToken') or 0)
+        end = min(start + payload['ResourcesPerPage'], StubTaggingHandler.instances)
+        result = {'ResourceTagMappingList': [
+            {'ResourceARN': f'arn:aws:ec2:us-east-1:111111111111:instance/i-{i}', 'Tags': []} for i in range(start, end)
+        ], 'PaginationToken': str(end) if end < StubTaggingHandler.instances else ''}
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTagDiscovery(unittest.TestCase):
+    def setUp(self):
+        StubTaggingHandler.calls = []
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubTaggingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        endpoint = f'http://127.0.0.1:{self.server.server_address[1]}/'
+        self.clientFactory = lambda region: AwsClient(region, 'key', 'secret', endpoint=endpoint)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_resource_id(self):
+        self.assertEqual(resource_id('arn:aws:ec2:us-east-1:111111111111:instance/i-1'), 'i-1')
+        self.assertEqual(resource_id('arn:aws:lambda:us-east-1:111111111111:function:my-function'), 'my-function')
+        self.assertEqual(resource_id('arn:aws:sqs:us-east-1:111111111111:my-queue'), 'my-queue')
+        self.assertEqual(resource_id('arn:aws:elasticloadbalancing:us-east-1:111111111111:loadbalancer/app/my-alb/'
+                                     '50dc6c495c0c9188'), 'app/my-alb/50dc6c495c0c9188')
+
+    def test_apply_to_metrics(self):
+        discovery = TagDiscovery(ttl=600, clientFactory=self.clientFactory)
+        tagSelect = {'resource_type_selection': 'ec2:instance', 'resource_id_dimension': 'InstanceId',
+                     'tag_selections': {'Environment': ['production']}}
+        metrics = [{'aws_namespace': 'AWS/EC2', 'aws_metric_name': name, 'aws_dimensions': ['InstanceId'],
+                    'aws_tag_select': tagSelect} for name in ['CPUUtilization', 'NetworkIn']]
+        metrics[1]['aws_dimension_select'] = {'InstanceId': ['i-1', 'i-2', 'i-1000']}
+        applied = discovery.applyToMetrics(metrics, 'us-east-1', '')
+        # Both metrics share one paged resolution
+        self.assertEqual(len(StubTaggingHandler.calls), 3)
+        target, payload = StubTaggingHandler.calls[0]
+        self.assertEqual(target, 'ResourceGroupsTaggingAPI_20170126.GetResources')
+        self.assertEqual(payload['ResourceTypeFilters'], ['ec2:instance'])
+        self.assertEqual(payload['TagFilters'], [{'Key': 'Environment', 'Values': ['production']}])
+        self.assertEqual(len(applied[0]['aws_dimension_select']['InstanceId']), 250)
+        self.assertEqual(applied[1]['aws_dimension_select']['InstanceId'], ['i-1', 'i-2'])
+        self.assertFalse(any('aws_tag_select' in metric for metric in applied))
+        # Cached until the ttl expires
+        discovery.applyToMetrics(metrics, 'us-east-1', '')
+        self.assertEqual(len(StubTaggingHandler.calls), 3)
+        self.assertFalse(discovery.isStale())
+        self.assertTrue(discovery.isStale(time.time() + 600))
+        discovery.resolve('us-east-1', '', tagSelect, time.time() + 600)
+        self.assertEqual(len(StubTaggingHandler.calls), 6)
+
+    def test_builder_discovery(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            paths = {'otelConfigPath': os.path.join(tmpDir, 'otel.yml'),
+                     'cloudwatchConfigPath': os.path.join(tmpDir, 'cloudwatch.yml')}
+            builder = Builder('./testdata/test-config.yml', **paths)
+            builder.config.cloudwatch['tag_discovery'] = 'true'
+            builder.discovery = TagDiscovery(clientFactory=self.clientFactory,
+                                             cachePath=os.path.join(tmpDir, '.tag-discovery.json'))
+            self.assertTrue(builder.generate())
+            with open(paths['cloudwatchConfigPath']) as cw:
+                values = yaml.safe_load(cw)
+            cpu = [m for m in values['metrics'] if m['aws_metric_name'] == 'CPUUtilization'][0]
+            self.assertNotIn('aws_tag_select', cpu)
+            self.assertEqual(len(cpu['aws_dimension_select']['InstanceId']), 250)
+            self.assertEqual(Planner(builder.config).planMetric(get_catalog().getMetric('AWS/EC2', 'CPUUtilization')[0])
+                             ['get_resources'], 0)
+            self.assertEqual(len(StubTaggingHandler.calls), 3)
+            # A restart reuses the cached resources and skips generation
+            builder = Builder('./testdata/test-config.yml', **paths)
+            builder.config.cloudwatch['tag_discovery'] = 'true'
+            self.assertTrue(builder.generate())
+            self.assertIsNone(builder.metrics)
+            self.assertEqual(len(StubTaggingHandler.calls), 3)
+        finally:
+            shutil.rmtree(tmpDir)
+
+
+class StubCollectorHandler(http.server.BaseHTTPRequestHandler):
+    # Points accepted by each receiver, served as the collector's own metrics
+    points = {}
+
+    def do_GET(self):
+        body = ''.join(f'otelcol_receiver_accepted_metric_points{{receiver="{receiver}",service_name="otelcol"}} '
+                       f'{value}\n' for receiver, value in self.points.items()).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_generation_phases(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            paths = {'otelConfigPath': os.path.join(tmpDir, 'otel.yml'),
+                     'cloudwatchConfigPath': os.path.join(tmpDir, 'cloudwatch.yml')}
+            builder = Builder('./testdata/test-config.yml', **paths)
+            builder.config.otel['metric_include'] = ['^aws_ec2_']
+            profilePath = os.path.join(tmpDir, 'generate.prof')
+            self.assertTrue(builder.profileGenerate(profilePath))
+            self.assertTrue(os.path.exists(profilePath))
+            for phase in ['config_load', 'stamp_check', 'validate', 'namespaces', 'cloudwatch_configuration', 'plan',
+                          'otel_configuration', 'yaml_dump']:
+                self.assertIn(phase, builder.telemetry.phases)
+            self.assertEqual(builder.telemetry.phases['yaml_dump']['count'], 2)
+            metrics = builder.telemetry.render()
+            self.assertIn('builder_phase_duration_seconds_count{phase="validate"} 1.0', metrics)
+            self.assertIn('# TYPE builder_phase_last_duration_seconds gauge', metrics)
+            with open(paths['otelConfigPath']) as otel:
+                values = yaml.safe_load(otel)
+            self.assertEqual(values['service']['telemetry']['metrics']['address'], '0.0.0.0:8888')
+            self.assertEqual([config['static_configs'][0]['targets'] for config in
+                              values['receivers']['prometheus/self']['config']['scrape_configs']],
+                             [['localhost:8888'], ['localhost:8889']])
+            self.assertEqual(values['service']['pipelines']['metrics/self'],
+                             {'receivers': ['prometheus/self'], 'processors': ['batch'],
+                              'exporters': ['prometheusremotewrite']})
+            # The exporter metrics of the dashboard are kept by the metric filter
+            self.assertEqual(values['processors']['filter/cardinality']['metrics']['include']['metric_names'],
+                             ['^aws_ec2_', '^cloudwatch_(exporter_.*|requests_total|scrape_duration_seconds)$'])
+            # Disabled, the collector configuration is left as is
+            builder.config.otel['self_telemetry'] = 'false'
+            builder.updateOtelConfiguration()
+            with open(paths['otelConfigPath']) as otel:
+                values = yaml.safe_load(otel)
+            self.assertNotIn('prometheus/self', values['receivers'])
+            self.assertNotIn('metrics', values['service']['telemetry'])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def test_measure_startup(self):
+        StubCollectorHandler.points = {'prometheus_exec/us-east-1': 120.0, 'prometheus_exec/us-east-2': 0.0}
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubCollectorHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            instance = telemetry.Telemetry()
+            scraped = instance.measureStartup(['prometheus_exec/us-east-1', 'prometheus_exec/us-east-2'],
+                                              time.time(), timeout=0.5, interval=0.1,
+                                              url=f'http://127.0.0.1:{server.server_address[1]}/metrics')
+            self.assertEqual(scraped, ['prometheus_exec/us-east-1'])
+            self.assertEqual(instance.phases['collector_start']['count'], 1)
+            self.assertEqual(instance.phases['first_scrape']['count'], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestSupervisor(unittest.TestCase):
+    def setUp(self):
+        StubCollectorHandler.points = {}
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubCollectorHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.healthUrl = f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_restart_and_shutdown(self):
+        closedSocket = socket.socket()
+        closedSocket.bind(('127.0.0.1', 0))
+        closedPort = closedSocket.getsockname()[1]
+        closedSocket.close()
+        exporterPorts = []
+        instance = telemetry.Telemetry()
+        supervisor = Supervisor(lambda: subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(60)']),
+                                lambda: exporterPorts, healthUrl=self.healthUrl, telemetry=instance,
+                                initialBackoff=0.01, stopTimeout=5, startPeriod=0, unhealthyThreshold=2)
+        supervisor.start()
+        try:
+            supervisor.check()
+            self.assertEqual(supervisor.restarts, {})
+            # A crashed collector is restarted after the backoff and its recovery is measured
+            first = supervisor.process
+            first.kill()
+            first.wait()
+            supervisor.check()
+            self.assertIsNot(supervisor.process, first)
+            self.assertEqual((supervisor.restarts, supervisor.failures), ({'exit': 1}, 1))
+            supervisor.check()
+            self.assertEqual(instance.phases['recovery']['count'], 1)
+            # An exporter that stops listening is logged and reported, the collector restarts its exporters itself
+            exporterPorts.append(closedPort)
+            with self.assertLogs('supervisor', 'WARNING'):
+                supervisor.check()
+            supervisor.check()
+            self.assertEqual((supervisor.restarts, supervisor.failures), ({'exit': 1}, 1))
+            self.assertIn('supervisor_exporters_down 1.0', instance.render())
+            exporterPorts.remove(closedPort)
+            supervisor.check()
+            self.assertIn('supervisor_exporters_down 0.0', instance.render())
+            self.assertIn('supervisor_collector_up 1.0', instance.render())
+        finally:
+            supervisor.stop()
+            returncode = supervisor.shutdown()
+        # Stopped with SIGTERM, so it can flush its queues
+        self.assertEqual(returncode, -15)
+
+
+class TestLoadTest(unittest.TestCase):
+    def test_fake_cloudwatch(self):
+        fake = fake_cloudwatch.FakeCloudWatch(resources=600)
+        server = fake_cloudwatch.serve(fake, 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            endpoint = f'http://127.0.0.1:{server.server_address[1]}/'
+            client = AwsClient('us-east-1', 'key', 'secret', endpoint=endpoint, retries=0)
+            values = {'region': 'us-east-1', 'metrics': [{
+                'aws_namespace': 'AWS/EC2', 'aws_metric_name': 'CPUUtilization', 'aws_dimensions': ['InstanceId'],
+                'aws_statistics': ['Average', 'Maximum'], 'set_timestamp': False}]}
+            text = Collector(values, client).scrape()
+            self.assertEqual(load_test.count_series(text), 1200)
+            self.assertEqual(fake.stats()['requests'], {'ListMetrics': 2, 'GetMetricData': 3})
+            result = client.query('monitoring', 'GetMetricStatistics', {
+                'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization', 'Dimensions.member.1.Name': 'InstanceId',
+                'Dimensions.member.1.Value': 'resource-1', 'StartTime': '2022-01-01T00:00:00Z',
+                'EndTime': '2022-01-01T00:10:00.000Z', 'Period': '300', 'Statistics.member.1': 'Sum',
+                'ExtendedStatistics.member.1': 'p99'})
+            self.assertEqual([point.findtext('Sum') for point in result.iterfind('.//Datapoints/member')],
+                             ['1.0', '2.0'])
+            self.assertEqual(result.findtext('.//ExtendedStatistics/entry/key'), 'p99')
+            resources = client.callJson('tagging', 'ResourceGroupsTaggingAPI_20170126.GetResources',
+                                        {'ResourceTypeFilters': ['ec2:instance'], 'ResourcesPerPage': 100})
+            self.assertEqual(resource_id(resources['ResourceTagMappingList'][0]['ResourceARN']), 'resource-0')
+            self.assertEqual(resources['PaginationToken'], '100')
+            # Throttled requests fail with the errors the client retries
+            fake.throttleRate = 1.0
+            with self.assertRaises(AwsError) as error:
+                client.query('monitoring', 'ListMetrics', {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization'})
+            self.assertEqual(error.exception.code, 'Throttling')
+            with self.assertRaises(AwsError) as error:
+                client.callJson('tagging', 'ResourceGroupsTaggingAPI_20170126.GetResources', {})
+            self.assertEqual(error.exception.code, 'ThrottlingException')
+            self.assertEqual(fake.stats()['throttled'], {'ListMetrics': 1, 'GetResources': 1})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_credentials(self):
+        fake = fake_cloudwatch.FakeCloudWatch(resources=1)
+        server = fake_cloudwatch.serve(fake, 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        tmpDir = tempfile.mkdtemp()
+        try:
+            endpoint = f'http://127.0.0.1:{server.server_address[1]}/'
+            params = {'Namespace': 'AWS/EC2', 'MetricName': 'CPUUtilization'}
+            # Assumed role credentials are assumed again before they expire
+            client = AwsClient('us-east-1', 'key', 'secret', endpoint=endpoint, retries=0)
+            assumed = client.assumeRole('arn:aws:iam::111111111111:role/cw')
+            assumed.query('monitoring', 'ListMetrics', params)
+            self.assertEqual(fake.stats()['requests']['AssumeRole'], 1)
+            assumed.expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+            assumed.query('monitoring', 'ListMetrics', params)
+            self.assertEqual(fake.stats()['requests']['AssumeRole'], 2)
+            # Without static keys, credentials come from a web identity token, then the container endpoint
+            tokenPath = os.path.join(tmpDir, 'token')
+            with open(tokenPath, 'w') as token:
+                token.write('token\n')
+            environ = {'AWS_WEB_IDENTITY_TOKEN_FILE': tokenPath, 'AWS_ROLE_ARN': 'arn:aws:iam::111111111111:role/cw'}
+            with unittest.mock.patch.dict(os.environ, environ, clear=True):
+                AwsClient('us-east-1', endpoint=endpoint, retries=0).query('monitoring', 'ListMetrics', params)
+            self.assertEqual(fake.stats()['requests']['AssumeRoleWithWebIdentity'], 1)
+            with unittest.mock.patch.dict(os.environ, {'AWS_CONTAINER_CREDENTIALS_FULL_URI': f'{endpoint}credentials'},
+                                          clear=True):
+                client = AwsClient('us-east-1', endpoint=endpoint, retries=0)
+                client.query('monitoring', 'ListMetrics', params)
+                client.query('monitoring', 'ListMetrics', params)
+            self.assertEqual(fake.stats()['requests']['ContainerCredentials'], 1)
+            self.assertEqual(client.sessionToken, 'fake')
+            with unittest.mock.patch.dict(os.environ, {'AWS_EC2_METADATA_DISABLED': 'true'}, clear=True):
+                with self.assertRaises(AwsError) as error:
+                    AwsClient('us-east-1', endpoint=endpoint, retries=0).query('monitoring', 'ListMetrics', params)
+            self.assertEqual(error.exception.code, 'NoCredentials')
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(tmpDir)
+
+    def test_run(self):
+        tmpDir = tempfile.mkdtemp()
+        loadTest = load_test.LoadTest('./testdata/test-config.yml', tmpDir, resources=20)
+        try:
+            loadTest.start()
+            results = loadTest.generate()
+            results.update(loadTest.runExporters(scrapes=2))
+        finally:
+            loadTest.stop()
+            shutil.rmtree(tmpDir)
+        self.assertNotIn('AWS_ENDPOINT_URL', os.environ)
+        self.assertEqual(results['scrape_errors'], 0)
+        # Every series and request of the plan, GetMetricData batches included
+        self.assertEqual(results['series_per_scrape'], results['estimated_series_per_scrape'])
+        self.assertEqual(results['requests_per_scrape'], results['estimated_requests_per_scrape'])
+        self.assertEqual(set(results['last_scrape_requests']), {'ListMetrics', 'GetMetricData', 'GetResources'})
+        self.assertGreater(results['series_per_second'], 0)
+        worse = dict(results, requests_per_scrape=results['requests_per_scrape'] * 2,
+                     series_per_scrape=results['series_per_scrape'] // 2)
+        self.assertEqual(sorted(load_test.compare_results(results, worse)), ['requests_per_scrape', 'series_per_scrape'])
+        self.assertEqual(load_test.compare_results(results, results), {})
+        # Timings depend on the machine, they are only compared on request
+        slower = dict(results, scrape_duration_seconds=results['scrape_duration_seconds'] * 3)
+        self.assertEqual(load_test.compare_results(results, slower), {})
+        self.assertEqual(list(load_test.compare_results(results, slower, timings=True)), ['scrape_duration_seconds'])
+
+
 class TestInput(unittest.TestCase):
     def test_is_valid_logzio_token(self):
         # Fail Type
@@ -210,6 +1355,16 @@ class TestInput(unittest.TestCase):
         self.assertTupleEqual(iv.is_valid_aws_namespaces('AWS/RDS, AWS/RDS,  AWS/Lambda,AWS/Lambda,AWS/Cloudfront'),
                               (['AWS/Lambda', 'AWS/RDS'], ['AWS/Cloudfront']))
 
+    def test_is_valid_budget(self):
+        self.assertRaises(TypeError, iv.is_valid_budget, '100')
+        self.assertRaises(ValueError, iv.is_valid_budget, -1)
+        self.assertRaises(ValueError, iv.is_valid_budget_action, 'ignore')
+        try:
+            iv.is_valid_budget(0)
+            iv.is_valid_budget_action('fail')
+        except (TypeError, ValueError) as e:
+            self.fail(f'Unexpected error {e}')
+
     def test_is_valid_p8s_logzio_name(self):
         # Fail Type
         non_valid_types = [-2, None, 4j, ['string', 'string']]
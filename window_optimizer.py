@@ -0,0 +1,37 @@
+"""
+This module derives the request window of a metric from the resolution it's published at
+"""
+# Resolution metadata of the namespace files, not part of the exporter configuration
+RESOLUTION_KEYS = ('resolution_seconds', 'publish_delay_seconds')
+WINDOW_KEYS = ('period_seconds', 'range_seconds', 'delay_seconds')
+
+
+# optimize_window returns the window fetching a single complete datapoint per scrape: the period is the configured
+# period rounded up to a multiple of the resolution, but not longer than the scrape interval, the range is one period
+# and the delay covers the publish delay
+def optimize_window(resolution, publishDelay, settings) -> dict:
+    scrapeInterval = settings['scrape_interval']
+    period = -(-max(settings['period_seconds'], resolution) // resolution) * resolution
+    if resolution <= scrapeInterval:
+        period = min(period, scrapeInterval // resolution * resolution)
+    else:
+        period = resolution
+    return {'period_seconds': period, 'range_seconds': period,
+            'delay_seconds': max(settings['delay_seconds'], publishDelay)}
+
+
+# check_window returns why a window doesn't provide a fresh datapoint on every scrape, None if it does
+def check_window(resolution, publishDelay, window, scrapeInterval):
+    if window['period_seconds'] < resolution:
+        return f'period_seconds {window["period_seconds"]} is shorter than their {resolution}s resolution, ' \
+               f'most scrapes get no datapoint'
+    if window['range_seconds'] < window['period_seconds']:
+        return f'range_seconds {window["range_seconds"]} is shorter than period_seconds {window["period_seconds"]}, ' \
+               f'scrapes get no datapoint'
+    if window['delay_seconds'] < publishDelay:
+        return f'delay_seconds {window["delay_seconds"]} is shorter than their {publishDelay}s publish delay, ' \
+               f'the latest datapoint is incomplete'
+    if resolution > scrapeInterval:
+        return f'they are published every {resolution}s but scraped every {scrapeInterval}s, ' \
+               f'{-(-resolution // scrapeInterval)} scrapes in a row get the same datapoint. Assign them to a slower tier'
+    return None
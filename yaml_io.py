@@ -0,0 +1,126 @@
+"""
+This module is the yaml serialization layer, it uses the libyaml C loader and dumper when they are available
+"""
+import hashlib
+import logging
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+    LIBYAML = True
+
+    # The C loader composes whole documents, the composer mixed in builds the node of a single entry
+    class EntryLoader(yaml.composer.Composer, SafeLoader):
+        def __init__(self, stream) -> None:
+            SafeLoader.__init__(self, stream)
+            yaml.composer.Composer.__init__(self)
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+    EntryLoader = SafeLoader
+    LIBYAML = False
+
+# Entries dumped at once by SequenceWriter
+WRITE_BATCH_SIZE = 500
+
+
+def load(stream):
+    return yaml.load(stream, Loader=SafeLoader)
+
+
+def load_file(path):
+    with open(path, 'r', encoding='utf-8') as yamlFile:
+        return load(yamlFile)
+
+
+# dump streams values to a file object
+def dump(values, stream) -> None:
+    yaml.dump(values, stream, Dumper=SafeDumper)
+
+
+def dumps(values) -> str:
+    return yaml.dump(values, Dumper=SafeDumper)
+
+
+class HashingWriter:
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        self.digest = hashlib.sha256()
+
+    def write(self, text) -> None:
+        self.digest.update(text.encode('utf-8'))
+        self.stream.write(text)
+
+    def flush(self) -> None:
+        self.stream.flush()
+
+
+# dump_hashed streams values to a file object and returns the sha256 of the written content
+def dump_hashed(values, stream) -> str:
+    writer = HashingWriter(stream)
+    dump(values, writer)
+    return writer.digest.hexdigest()
+
+
+# iter_entries streams the entries of a sequence under a top level key of a yaml mapping, one at a time, so the
+# memory doesn't grow with the sequence. The other top level keys are collected in values
+def iter_entries(stream, key, values):
+    loader = EntryLoader(stream)
+    try:
+        loader.get_event()
+        if loader.check_event(yaml.StreamEndEvent):
+            return
+        loader.get_event()
+        if not loader.check_event(yaml.MappingStartEvent):
+            raise ValueError('The top level should be a mapping')
+        loader.get_event()
+        while not loader.check_event(yaml.MappingEndEvent):
+            name = loader.construct_document(loader.compose_node(None, None))
+            if name != key or not loader.check_event(yaml.SequenceStartEvent):
+                values[name] = loader.construct_document(loader.compose_node(None, None))
+                continue
+            loader.get_event()
+            while not loader.check_event(yaml.SequenceEndEvent):
+                yield loader.construct_document(loader.compose_node(None, None))
+            loader.get_event()
+    finally:
+        loader.dispose()
+
+
+class SequenceWriter:
+    def __init__(self, stream, key, batchSize=WRITE_BATCH_SIZE) -> None:
+        self.writer = HashingWriter(stream)
+        self.key = key
+        self.batchSize = batchSize
+        self.batch = []
+        self.count = 0
+
+    # Appends an entry to the sequence, entries are dumped in batches
+    def append(self, entry) -> None:
+        self.batch.append(entry)
+        if len(self.batch) >= self.batchSize:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.batch:
+            return
+        if self.count == 0:
+            self.writer.write(f'{self.key}:\n')
+        self.count += len(self.batch)
+        dump(self.batch, self.writer)
+        self.batch = []
+
+    # Writes the remaining entries and the other keys, returns the sha256 of the written content
+    def close(self, values) -> str:
+        self.flush()
+        values = {name: value for name, value in values.items() if name != self.key}
+        if self.count == 0:
+            values[self.key] = []
+        if values:
+            dump(values, self.writer)
+        return self.writer.digest.hexdigest()
+
+
+# debug_dump logs values as yaml, only rendering them if the logger is enabled for debug
+def debug_dump(logger, message, values) -> None:
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'{message}:\n{dumps(values)}')